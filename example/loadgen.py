@@ -0,0 +1,647 @@
+#!/usr/bin/python3
+#
+# loadgen.py
+#
+# Load generator for miniserver.py. It simulates a number of terminals
+# connected to the server, some of them typing (and measuring the time
+# between a key and its echo), some of them running a command that
+# produces a lot of output, and reports throughput, echo latency and
+# CPU and memory usage of the server (read from its "/metrics" page).
+# The results can also be written as JSON, to compare different
+# versions of the server.
+#
+# With "-idle-sessions", the program measures instead the cost of idle
+# sessions: it starts the given number of sessions (each one with its
+# shell), leaves them alone, and reports the memory and the tasks of
+# the server per session.
+#
+# HTTP clients follow the same cadence as the AnsiTermHttpDriver class
+# of xwterm.js: a size request, then data requests ("?console") every
+# "fastRefresh" milliseconds, or soon after a key ("immediateRefresh"),
+# or long poll requests; one POST at a time, keys typed in the meantime
+# are sent together. WebSocket clients use the JSON or the binary
+# protocol.
+#
+# Requirements:
+#  python >= 3.8
+#  aiohttp (pip install aiohttp)
+#  websockets (pip install websockets)
+#
+# Example:
+#  ./loadgen.py -clients 50 -output-clients 5 -transport ws -duration 30 -json results.json
+#  ./loadgen.py -idle-sessions 10000
+#
+
+VERSION = '1.0'
+
+import sys
+import asyncio
+import collections
+import codecs
+import json
+import random
+import re
+import string
+import time
+import datetime
+
+import aiohttp
+import websockets
+
+TRANSPORTS = [ 'http', 'ws', 'ws-binary' ]
+
+DEFAULT_HTTP_URL = 'http://127.0.0.1:8000'
+DEFAULT_WS_URL = 'ws://127.0.0.1:8001'
+DEFAULT_TRANSPORT = 'http'
+DEFAULT_CLIENTS = 10
+DEFAULT_OUTPUT_CLIENTS = 0
+DEFAULT_DURATION = 30
+DEFAULT_RAMP = 5
+DEFAULT_TYPING_RATE = 5 # keys per second, per client
+DEFAULT_LINE_LENGTH = 40 # keys typed before Enter
+DEFAULT_OUTPUT_COMMAND = 'while :; do seq 1 100000; done'
+DEFAULT_SIZE = '25x80'
+DEFAULT_LONG_POLL = 0 # milliseconds, 0 = periodic polling
+DEFAULT_IDLE_SESSIONS = 0 # 0 = normal test
+DEFAULT_IDLE_SETTLE = 5 # seconds
+
+# Idle sessions test: requests in progress at the same time, and idle
+# timeout asked for the sessions (seconds), so they survive the test.
+IDLE_CONCURRENCY = 20
+IDLE_TIMEOUT = 3600
+
+# AnsiTermHttpDriver defaults (milliseconds)
+IMMEDIATE_REFRESH = 70
+FAST_REFRESH = 500
+SLOW_REFRESH = 2000
+
+# Time allowed to the shell to show its prompt (seconds)
+STARTUP_TIMEOUT = 15
+# The prompt is considered complete when the output stops for this long (seconds)
+STARTUP_QUIET = 0.5
+# Keys not echoed within this time are counted as lost (seconds)
+ECHO_TIMEOUT = 5
+# Period of the samples of the server metrics (seconds)
+METRICS_PERIOD = 1
+
+WS_TAG_DATA = b'\x00'
+WS_TAG_SIZE = b'\x01'
+
+# Escape sequences, removed from the output before looking for the echo of the keys
+SEQUENCES = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[^\[\]]|[\x00-\x1f\x7f]')
+
+http_url = DEFAULT_HTTP_URL
+ws_url = DEFAULT_WS_URL
+transport = DEFAULT_TRANSPORT
+nclients = DEFAULT_CLIENTS
+noutput_clients = DEFAULT_OUTPUT_CLIENTS
+duration = DEFAULT_DURATION
+ramp = DEFAULT_RAMP
+typing_rate = DEFAULT_TYPING_RATE
+line_length = DEFAULT_LINE_LENGTH
+output_command = DEFAULT_OUTPUT_COMMAND
+screen_size = DEFAULT_SIZE
+long_poll = DEFAULT_LONG_POLL
+idle_sessions = DEFAULT_IDLE_SESSIONS
+idle_settle = DEFAULT_IDLE_SETTLE
+metrics_url = None
+json_file = None
+quiet = False
+# Messages and report (on the standard error with "-json -")
+report = sys.stdout
+
+
+def percentile(values, p):
+    # "values" must be sorted
+    if not values:
+        return None
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+class Client:
+
+    # A simulated terminal. Subclasses implement the transport:
+    # "connect", "send" and "close"; received output goes to "on_output".
+
+    def __init__(self, n, role):
+        self.n = n
+        self.role = role
+        self.connected = False
+        self.error = None
+        self.keys = collections.deque() # (key, time) waiting for their echo
+        self.latencies = []
+        self.sent_keys = 0
+        self.lost_keys = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.last_output = 0
+
+    def on_output(self, text, size):
+        now = time.perf_counter()
+        self.bytes_in += size
+        self.messages_in += 1
+        if not text:
+            return
+        self.last_output = now
+        keys = self.keys
+        while keys and now - keys[0][1] > ECHO_TIMEOUT:
+            keys.popleft()
+            self.lost_keys += 1
+        if not keys:
+            return
+        for c in SEQUENCES.sub('', text):
+            if not keys:
+                break
+            if c == keys[0][0]:
+                self.latencies.append(now - keys.popleft()[1])
+
+    def drop_keys(self):
+        # Keys whose echo will not be waited for anymore.
+        self.lost_keys += len(self.keys)
+        self.keys.clear()
+
+    async def started(self):
+        # Waits for the prompt of the shell.
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < STARTUP_TIMEOUT:
+            await asyncio.sleep(0.1)
+            if self.last_output and time.perf_counter() - self.last_output > STARTUP_QUIET:
+                return True
+        return False
+
+    async def type_keys(self, deadline):
+        # Random lowercase letters in a shell comment, so that nothing is executed.
+        interval = 1 / typing_rate
+        await self.send('# ')
+        n = 0
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * interval)
+            if n >= line_length:
+                await self.send('\r')
+                self.drop_keys()
+                n = 0
+                await asyncio.sleep(interval)
+                await self.send('# ')
+                continue
+            c = random.choice(string.ascii_lowercase)
+            self.keys.append((c, time.perf_counter()))
+            self.sent_keys += 1
+            n += 1
+            await self.send(c)
+
+    async def run(self, delay, deadline):
+        await asyncio.sleep(delay)
+        try:
+            await self.connect()
+            self.connected = True
+            if not await self.started():
+                self.error = 'no prompt'
+            if self.role == 'output':
+                await self.send(output_command + '\r')
+                await asyncio.sleep(max(0, deadline - time.perf_counter()))
+                await self.send('\x03')
+            else:
+                await self.type_keys(deadline)
+                await self.send('\x15')
+            await self.send('exit\r')
+            await asyncio.sleep(0.5)
+        except (asyncio.CancelledError, GeneratorExit):
+            raise
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+        finally:
+            try:
+                await self.close()
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception:
+                pass
+            self.drop_keys()
+
+
+class HttpClient(Client):
+
+    def __init__(self, n, role):
+        super().__init__(n, role)
+        self.hint = '%016x' % random.getrandbits(64)
+        self.http = None
+        self.poller = None
+        self.refresh = asyncio.Event()
+        self.pending = ''
+        self.sender = None
+
+    def url(self, query):
+        return http_url + '/?' + query + '&session=' + self.hint
+
+    async def connect(self):
+        self.http = aiohttp.ClientSession()
+        async with self.http.get(self.url('size=' + screen_size)) as r:
+            await r.read()
+        self.poller = asyncio.create_task(self.poll())
+
+    async def poll(self):
+        query = 'console&repaint'
+        while True:
+            if long_poll:
+                query += '&wait=' + str(long_poll)
+            try:
+                async with self.http.get(self.url(query)) as r:
+                    body = await r.read()
+                    ok = r.status < 400
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception:
+                ok = False
+            query = 'console'
+            if not ok:
+                await asyncio.sleep(SLOW_REFRESH / 1000)
+                continue
+            try:
+                text = json.loads(body).get('text', '')
+            except ValueError:
+                text = ''
+            self.on_output(text, len(body))
+            if long_poll:
+                continue
+            try:
+                await asyncio.wait_for(self.refresh.wait(), FAST_REFRESH / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self.refresh.clear()
+
+    async def send(self, text):
+        self.pending += text
+        if self.sender is None:
+            self.sender = asyncio.create_task(self.transmit())
+
+    async def transmit(self):
+        # One POST at a time; what is typed in the meantime is sent with
+        # the next one. After a POST, the driver asks for the output soon.
+        loop = asyncio.get_running_loop()
+        try:
+            while self.pending:
+                data = self.pending
+                self.pending = ''
+                async with self.http.post(http_url + '/?session=' + self.hint, data = data.encode('utf-8'),
+                                          headers = { 'Content-Type': 'text/plain' }) as r:
+                    await r.read()
+                self.bytes_out += len(data)
+                self.messages_out += 1
+                loop.call_later(IMMEDIATE_REFRESH / 1000, self.refresh.set)
+                await asyncio.sleep(IMMEDIATE_REFRESH / 1000)
+        finally:
+            self.sender = None
+
+    async def close(self):
+        if self.sender:
+            try:
+                await asyncio.wait_for(self.sender, 2)
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception:
+                pass
+        if self.poller:
+            self.poller.cancel()
+        if self.http:
+            await self.http.close()
+
+
+class WebSocketClient(Client):
+
+    def __init__(self, n, role, binary = False):
+        super().__init__(n, role)
+        self.binary = binary
+        self.ws = None
+        self.receiver = None
+
+    async def connect(self):
+        uri = ws_url + ('/?binary' if self.binary else '/')
+        self.ws = await websockets.connect(uri, max_size = None)
+        if self.binary:
+            await self.ws.send(WS_TAG_SIZE + screen_size.encode('ascii'))
+        else:
+            await self.ws.send(json.dumps({ 'size': screen_size }))
+        self.receiver = asyncio.create_task(self.receive())
+
+    async def receive(self):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+        async for m in self.ws:
+            if isinstance(m, bytes):
+                self.on_output(decoder.decode(m[1:]) if m[:1] == WS_TAG_DATA else '', len(m))
+            else:
+                try:
+                    text = json.loads(m).get('text', '')
+                except ValueError:
+                    text = ''
+                self.on_output(text, len(m))
+
+    async def send(self, text):
+        if self.binary:
+            m = WS_TAG_DATA + text.encode('utf-8')
+        else:
+            m = json.dumps({ 'text': text })
+        await self.ws.send(m)
+        self.bytes_out += len(m)
+        self.messages_out += 1
+
+    async def close(self):
+        if self.receiver:
+            self.receiver.cancel()
+        if self.ws:
+            await self.ws.close()
+
+
+class ServerMonitor:
+
+    # Samples the metrics of the server, for CPU time, memory and
+    # event loop lag.
+
+    NAMES = [ 'process_cpu_seconds_total', 'process_resident_memory_bytes', 'xwterm_event_loop_lag_seconds', 'xwterm_sessions',
+              'xwterm_tasks' ]
+
+    def __init__(self, url):
+        self.url = url
+        self.samples = []
+
+    async def sample(self, http):
+        async with http.get(self.url) as r:
+            text = await r.text()
+        values = {}
+        for line in text.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[0] in ServerMonitor.NAMES:
+                values[parts[0]] = float(parts[1])
+        values['time'] = time.perf_counter()
+        self.samples.append(values)
+
+    async def run(self):
+        async with aiohttp.ClientSession() as http:
+            while True:
+                try:
+                    await self.sample(http)
+                except (asyncio.CancelledError, GeneratorExit):
+                    raise
+                except Exception:
+                    pass
+                await asyncio.sleep(METRICS_PERIOD)
+
+    async def final(self):
+        try:
+            async with aiohttp.ClientSession() as http:
+                await self.sample(http)
+        except (asyncio.CancelledError, GeneratorExit):
+            raise
+        except Exception:
+            pass
+
+    def report(self):
+        s = [ v for v in self.samples if 'process_cpu_seconds_total' in v ]
+        if len(s) < 2:
+            return None
+        first, last = s[0], s[-1]
+        cpu = last['process_cpu_seconds_total'] - first['process_cpu_seconds_total']
+        elapsed = last['time'] - first['time']
+        rss = [ v['process_resident_memory_bytes'] for v in s if 'process_resident_memory_bytes' in v ]
+        lag = [ v['xwterm_event_loop_lag_seconds'] for v in s if 'xwterm_event_loop_lag_seconds' in v ]
+        sessions = [ v['xwterm_sessions'] for v in s if 'xwterm_sessions' in v ]
+        return { "cpu_seconds": round(cpu, 3),
+                 "cpu_percent": round(100 * cpu / elapsed, 1) if elapsed > 0 else None,
+                 "rss_bytes_start": int(rss[0]) if rss else None,
+                 "rss_bytes_max": int(max(rss)) if rss else None,
+                 "rss_bytes_end": int(rss[-1]) if rss else None,
+                 "loop_lag_max_ms": round(max(lag) * 1000, 3) if lag else None,
+                 "sessions_max": int(max(sessions)) if sessions else None }
+
+
+def new_client(n, role):
+    if transport == 'http':
+        return HttpClient(n, role)
+    return WebSocketClient(n, role, transport == 'ws-binary')
+
+async def main():
+    clients = [ new_client(i, 'typing') for i in range(nclients) ]
+    clients += [ new_client(nclients + i, 'output') for i in range(noutput_clients) ]
+    monitor = ServerMonitor(metrics_url)
+    mt = asyncio.create_task(monitor.run())
+    started = datetime.datetime.now()
+    t0 = time.perf_counter()
+    deadline = t0 + ramp + duration
+    n = len(clients)
+    tasks = [ asyncio.create_task(c.run(ramp * i / n if n > 1 else 0, deadline)) for i, c in enumerate(clients) ]
+    if not quiet:
+        print('Running', nclients, 'typing and', noutput_clients, 'output clients (' + transport + ') for', ramp + duration, 's...', file = report)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - t0
+    mt.cancel()
+    await monitor.final()
+
+    latencies = sorted(l for c in clients for l in c.latencies)
+    def ms(v):
+        return round(v * 1000, 3) if v is not None else None
+    bytes_in = sum(c.bytes_in for c in clients)
+    messages_in = sum(c.messages_in for c in clients)
+    result = {
+        "version": VERSION,
+        "date": started.strftime("%Y/%m/%d %H:%M:%S"),
+        "config": { "transport": transport, "clients": nclients, "output_clients": noutput_clients,
+                    "duration_s": duration, "ramp_s": ramp, "typing_rate": typing_rate,
+                    "line_length": line_length, "output_command": output_command,
+                    "size": screen_size, "long_poll_ms": long_poll,
+                    "http_url": http_url, "ws_url": ws_url },
+        "elapsed_s": round(elapsed, 3),
+        "clients": { "connected": sum(1 for c in clients if c.connected),
+                     "errors": sum(1 for c in clients if c.error),
+                     "error_messages": sorted(set(c.error for c in clients if c.error)) },
+        "keys": { "sent": sum(c.sent_keys for c in clients),
+                  "echoed": len(latencies),
+                  "lost": sum(c.lost_keys for c in clients) },
+        "latency_ms": { "samples": len(latencies),
+                        "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+                        "p50": ms(percentile(latencies, 50)),
+                        "p90": ms(percentile(latencies, 90)),
+                        "p99": ms(percentile(latencies, 99)),
+                        "max": ms(latencies[-1] if latencies else None) },
+        "throughput": { "bytes_in": bytes_in,
+                        "bytes_out": sum(c.bytes_out for c in clients),
+                        "messages_in": messages_in,
+                        "messages_out": sum(c.messages_out for c in clients),
+                        "bytes_in_per_s": round(bytes_in / elapsed),
+                        "messages_in_per_s": round(messages_in / elapsed, 1) },
+        "server": monitor.report(),
+    }
+    return result
+
+async def idle_test():
+    # Starts "idle_sessions" sessions (a size request starts the shell),
+    # waits for the shells to settle, and compares the metrics of the
+    # server with those taken before. The sessions are killed at the end.
+    monitor = ServerMonitor(metrics_url)
+    started = datetime.datetime.now()
+    hints = [ '%016x' % random.getrandbits(64) for i in range(idle_sessions) ]
+    errors = collections.Counter()
+    limit = asyncio.Semaphore(IDLE_CONCURRENCY)
+    async def request(http, query):
+        async with limit:
+            try:
+                async with http.get(http_url + '/?' + query) as r:
+                    await r.read()
+                    if r.status >= 400:
+                        errors['HTTP ' + str(r.status)] += 1
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception as e:
+                errors[str(e) or type(e).__name__] += 1
+    async with aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = IDLE_CONCURRENCY)) as http:
+        await monitor.sample(http)
+        if not quiet:
+            print('Starting', idle_sessions, 'idle sessions...', file = report)
+        t0 = time.perf_counter()
+        await asyncio.gather(*[ request(http, 'size=' + screen_size + '&idle=' + str(IDLE_TIMEOUT) + '&session=' + h) for h in hints ])
+        startup = time.perf_counter() - t0
+        await asyncio.sleep(idle_settle)
+        await monitor.sample(http)
+        await asyncio.gather(*[ request(http, 'kill=' + h) for h in hints ])
+    before, after = monitor.samples[0], monitor.samples[-1]
+    sessions = after.get('xwterm_sessions', 0) - before.get('xwterm_sessions', 0)
+    def per_session(name):
+        if name not in before or name not in after or sessions <= 0:
+            return None
+        return round((after[name] - before[name]) / sessions, 2)
+    return {
+        "version": VERSION,
+        "date": started.strftime("%Y/%m/%d %H:%M:%S"),
+        "config": { "idle_sessions": idle_sessions, "settle_s": idle_settle, "size": screen_size, "http_url": http_url },
+        "startup_s": round(startup, 3),
+        "sessions": int(sessions),
+        "errors": dict(errors),
+        "rss_bytes_before": int(before['process_resident_memory_bytes']) if 'process_resident_memory_bytes' in before else None,
+        "rss_bytes_after": int(after['process_resident_memory_bytes']) if 'process_resident_memory_bytes' in after else None,
+        "bytes_per_session": per_session('process_resident_memory_bytes'),
+        "tasks_per_session": per_session('xwterm_tasks'),
+    }
+
+def print_idle_result(r):
+    print('Sessions: ' + str(r["sessions"]) + ' started in ' + str(r["startup_s"]) + ' s', r["errors"] or '', file = report)
+    print('Server: RSS ' + str(r["rss_bytes_before"]) + ' -> ' + str(r["rss_bytes_after"]) + ', '
+          + str(r["bytes_per_session"]) + ' bytes and ' + str(r["tasks_per_session"]) + ' tasks per session', file = report)
+
+def print_result(r):
+    l = r["latency_ms"]
+    t = r["throughput"]
+    print('Clients: ' + str(r["clients"]["connected"]) + ' connected, ' + str(r["clients"]["errors"]) + ' errors', r["clients"]["error_messages"] or '', file = report)
+    print('Keys: ' + str(r["keys"]["sent"]) + ' sent, ' + str(r["keys"]["echoed"]) + ' echoed, ' + str(r["keys"]["lost"]) + ' lost', file = report)
+    print('Echo latency (ms): p50=' + str(l["p50"]) + ' p90=' + str(l["p90"]) + ' p99=' + str(l["p99"]) + ' max=' + str(l["max"]), file = report)
+    print('Received: ' + str(t["bytes_in"]) + ' bytes (' + str(t["bytes_in_per_s"]) + '/s), ' + str(t["messages_in"]) + ' messages (' + str(t["messages_in_per_s"]) + '/s)', file = report)
+    s = r["server"]
+    if s:
+        print('Server: CPU ' + str(s["cpu_percent"]) + '%, RSS ' + str(s["rss_bytes_start"]) + ' -> ' + str(s["rss_bytes_end"]) + ' (max ' + str(s["rss_bytes_max"]) + '), max loop lag ' + str(s["loop_lag_max_ms"]) + ' ms', file = report)
+    else:
+        print('Server: metrics not available', file = report)
+
+
+if __name__ == '__main__':
+
+    def usage():
+        normal = '\x1B[0m'
+        bold  = normal + '\x1B[1m\x1B[96m'
+        italic  = normal + '\x1B[3m\x1B[93m'
+        comment = normal + ' : '
+        print('\nUsage:')
+        print(' '+bold+'-transport '+italic+'|'.join(TRANSPORTS)+comment+'Protocol of the clients. Default='+DEFAULT_TRANSPORT)
+        print(' '+bold+'-http '+italic+'URL'+comment+'HTTP service. Default='+DEFAULT_HTTP_URL)
+        print(' '+bold+'-ws '+italic+'URL'+comment+'WebSocket service. Default='+DEFAULT_WS_URL)
+        print(' '+bold+'-metrics '+italic+'URL'+comment+'Metrics of the server. Default='+italic+'HTTP service'+normal+'/metrics')
+        print(' '+bold+'-clients '+italic+'n'+comment+'Clients that type. Default='+str(DEFAULT_CLIENTS))
+        print(' '+bold+'-output-clients '+italic+'n'+comment+'Clients that run the output command. Default='+str(DEFAULT_OUTPUT_CLIENTS))
+        print(' '+bold+'-output-command '+italic+'command'+comment+'Command run by the output clients. Default="'+DEFAULT_OUTPUT_COMMAND+'"')
+        print(' '+bold+'-duration '+italic+'seconds'+comment+'Duration of the test, after the ramp. Default='+str(DEFAULT_DURATION))
+        print(' '+bold+'-ramp '+italic+'seconds'+comment+'Time to start all the clients. Default='+str(DEFAULT_RAMP))
+        print(' '+bold+'-rate '+italic+'keys/s'+comment+'Typing rate of each client. Default='+str(DEFAULT_TYPING_RATE))
+        print(' '+bold+'-line-length '+italic+'n'+comment+'Keys typed before Enter. Default='+str(DEFAULT_LINE_LENGTH))
+        print(' '+bold+'-size '+italic+'lines'+'x'+'columns'+comment+'Screen size. Default='+DEFAULT_SIZE)
+        print(' '+bold+'-long-poll '+italic+'ms'+comment+'HTTP clients use long poll requests, 0=periodic polling. Default='+str(DEFAULT_LONG_POLL))
+        print(' '+bold+'-idle-sessions '+italic+'n'+comment+'Measure memory and tasks of n idle sessions instead (HTTP)')
+        print(' '+bold+'-idle-settle '+italic+'seconds'+comment+'Time left to the idle sessions before the measure. Default='+str(DEFAULT_IDLE_SETTLE))
+        print(' '+bold+'-json '+italic+'file'+comment+'Write the results as JSON ("-" = standard output, the report goes to standard error)')
+        print(' '+bold+'-q'+normal+' | '+bold+'-quiet'+comment+'No messages')
+        print(' '+bold+'-h'+normal+' | '+bold+'-help'+comment+'This help')
+        print('')
+        sys.exit(0)
+
+    args = sys.argv[1:]
+
+    while len(args) > 0:
+
+        opt = args[0].lower().replace('--', '-')
+        args = args[1:]
+        if opt in [ "-transport", "-http", "-ws", "-metrics", "-clients", "-output-clients", "-output-command",
+                    "-duration", "-ramp", "-rate", "-line-length", "-size", "-long-poll", "-json",
+                    "-idle-sessions", "-idle-settle" ]:
+            if len(args) == 0:
+                usage()
+            arg = args[0]
+            args = args[1:]
+            try:
+                if opt == "-transport":
+                    if arg not in TRANSPORTS:
+                        usage()
+                    transport = arg
+                elif opt == "-http":
+                    http_url = arg.rstrip('/')
+                elif opt == "-ws":
+                    ws_url = arg.rstrip('/')
+                elif opt == "-metrics":
+                    metrics_url = arg
+                elif opt == "-clients":
+                    nclients = max(0, int(arg))
+                elif opt == "-output-clients":
+                    noutput_clients = max(0, int(arg))
+                elif opt == "-output-command":
+                    output_command = arg
+                elif opt == "-duration":
+                    duration = max(1, float(arg))
+                elif opt == "-ramp":
+                    ramp = max(0, float(arg))
+                elif opt == "-rate":
+                    typing_rate = max(0.1, float(arg))
+                elif opt == "-line-length":
+                    line_length = max(1, int(arg))
+                elif opt == "-size":
+                    li, co = arg.split('x')
+                    screen_size = str(int(li)) + 'x' + str(int(co))
+                elif opt == "-long-poll":
+                    long_poll = max(0, int(arg))
+                elif opt == "-json":
+                    json_file = arg
+                elif opt == "-idle-sessions":
+                    idle_sessions = max(0, int(arg))
+                elif opt == "-idle-settle":
+                    idle_settle = max(0, float(arg))
+            except ValueError:
+                usage()
+        elif opt in [ "-q", "-quiet" ]:
+            quiet = True
+        else:
+            usage()
+
+    if metrics_url is None:
+        metrics_url = http_url + '/metrics'
+    if json_file == '-':
+        report = sys.stderr
+
+    if idle_sessions > 0:
+        result = asyncio.run(idle_test())
+        if not quiet:
+            print_idle_result(result)
+    else:
+        result = asyncio.run(main())
+        if not quiet:
+            print_result(result)
+    if json_file == '-':
+        print(json.dumps(result, indent = 1))
+    elif json_file:
+        with open(json_file, 'w') as f:
+            json.dump(result, f, indent = 1)
@@ -50,9 +50,25 @@ import mimetypes
 import time
 import json
 import threading
+import codecs
+import re
+import collections
 import logging
 import subprocess
 import datetime
+import urllib.parse
+import zlib
+import hashlib
+import email.utils
+import concurrent.futures
+import bisect
+import traceback
+import heapq
+import itertools
+import socket
+import array
+import shlex
+import select
 try:
     import aiohttp
     import aiohttp.web
@@ -76,6 +92,10 @@ except:
         import websockets
     except:
         has_websockets = False
+try:
+    from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+except:
+    PerMessageDeflate = None
 try:
     import io
     import msvcrt
@@ -97,6 +117,8 @@ if not hasattr(asyncio, 'create_task'):
     asyncio.create_task = asyncio.ensure_future
 if not hasattr(asyncio, 'get_running_loop'):
     asyncio.get_running_loop = asyncio.get_event_loop
+if not hasattr(asyncio, 'all_tasks'):
+    asyncio.all_tasks = asyncio.Task.all_tasks
 if not hasattr(asyncio, 'run'):
     def loop(x):
         return asyncio.get_event_loop().run_until_complete(x)
@@ -329,23 +351,188 @@ SESSION_HINT_PARAM="session"
 SET_SIZE_PARAM="size" # e.g. size=25x80
 LIST_SESSIONS_PARAM="sessions"
 KILL_SESSIONS_PARAM="kill"
+LONG_POLL_PARAM="wait" # e.g. console&wait=20000 (milliseconds)
+OVERFLOW_PARAM="overflow" # e.g. overflow=skip
+REPAINT_PARAM="repaint" # e.g. console&repaint
+IDLE_TIMEOUT_PARAM="idle" # e.g. idle=600 (seconds)
+SHELL_PARAM="shell" # e.g. shell=python (a profile of --shell-profiles)
+DOWNLOAD_PARAM="download" # e.g. download=<file name> (from the upload directory)
+DEBUG_PARAM="debug" # e.g. debug=+timing,-stall (or just "debug" to read the state)
+PROFILE_PARAM="profile" # profile=start, profile=stop, profile=dump
+HISTORY_PARAM="history" # e.g. history=<session ID>&lines=100, or history=<session ID>&from=0&to=65536
+HISTORY_LINES_PARAM="lines" # also in data requests, e.g. console&lines=100
+HISTORY_BYTES_PARAM="bytes" # also in data requests, e.g. console&bytes=4096
+HISTORY_FROM_PARAM="from"
+HISTORY_TO_PARAM="to"
 DEFAULT_FILE="index.html"
+METRICS_PATH="/metrics" # Prometheus text format
+# Period of the measure of the event loop lag (seconds)
+LOOP_LAG_PERIOD = 0.5
 
 DEFAULT_WEBSOCKET_PORT = 8001
+WS_MUX_PARAM="mux" # e.g. ws://127.0.0.1:8001/?mux
+WS_READONLY_PARAM="readonly" # e.g. ws://127.0.0.1:8001/?session=<session ID>&readonly
+# Binary protocol, selected by subprotocol or parameter (e.g. ws://127.0.0.1:8001/?binary).
+# Every binary message starts with a tag byte: data messages carry UTF-8
+# encoded characters (both directions), size messages "<lines>x<columns>".
+WS_BINARY_PARAM="binary"
+WS_BINARY_SUBPROTOCOL="xwterm.binary"
+WS_TAG_DATA=b'\x00'
+WS_TAG_SIZE=b'\x01'
 
 RESIZE_MITIGATION_TIME_S = 1 # 4 # 0 # 1
 
-#DEBUG_FLAGS = {"async", "process", "session", "http", "websocket"}
-DEBUG_FLAGS = {"async", "process", "session", "websocket"}
-
-SESSION_IDLE_CHECK_PERIOD = 10
-SESSION_IDLE_TIMEOUT = 120 #10
+#DEBUG_FLAGS = {"async", "process", "session", "http", "websocket", "stall", "profile", "timing"}
+DEBUG_FLAGS = {"async", "process", "session", "websocket", "stall"}
+
+# Event loop stall detector ("stall" debug flag): callbacks or steps of
+# tasks that take longer than this are recorded with their stack.
+DEFAULT_STALL_THRESHOLD_MS = 100
+# Sampling profiler ("profile" debug flag): period of the samples (seconds).
+PROFILE_INTERVAL = 0.005
+
+# Sessions that nobody uses for this long are closed (seconds). A client
+# can choose another timeout for its session ("idle" parameter), up to
+# SESSION_IDLE_TIMEOUT_MAX.
+DEFAULT_SESSION_IDLE_TIMEOUT = 120
+SESSION_IDLE_TIMEOUT_MAX = 86400
+
+# Long poll: upper limit of the time a data request can be held
+# waiting for output, and the time spent collecting the output that
+# follows the first chunk before answering.
+DEFAULT_LONG_POLL_MAX_MS = 25000
+DEFAULT_LONG_POLL_COALESCE_MS = 10
+
+# Output batching: chunks of output are merged until the batch reaches
+# the given size, or the given time has elapsed since its first chunk.
+# Zero time disables batching.
+DEFAULT_OUTPUT_FLUSH_MS = 8
+DEFAULT_OUTPUT_FLUSH_BYTES = 65536
+
+# Size of the reads from the virtual terminal. If the maximum is greater
+# than the initial size, the size is adaptive: it doubles while reads
+# come back full (bulk output), and halves when they come back mostly
+# empty (interactive use).
+DEFAULT_READ_SIZE = 1024
+DEFAULT_READ_SIZE_MAX = 65536
+
+# Capacity of the session queues, in characters (0 = unbounded).
+# When the output queue is full, the virtual terminal is not read anymore,
+# so the kernel suspends the shell until the client catches up.
+DEFAULT_TXQ_LIMIT = 262144
+DEFAULT_RXQ_LIMIT = 65536
+
+# What to do when a client falls behind: "block" suspends the shell
+# (see above), "skip" discards the output queued for the client when
+# it exceeds the threshold, and replaces it with a copy of the current
+# screen. "skip" requires a model of the screen for each session.
+OVERFLOW_POLICIES = [ 'block', 'skip' ]
+DEFAULT_OVERFLOW_POLICY = 'block'
+DEFAULT_OVERFLOW_THRESHOLD = 65536
+
+# Scrollback kept by every session, in bytes of UTF-8 encoded output
+# (0 = none), and optional limit on the number of lines (0 = no limit).
+# The memory used by a session for its history is exactly the given size,
+# allocated when the shell produces its first output.
+DEFAULT_HISTORY_SIZE = 65536
+DEFAULT_HISTORY_LINES = 0
+
+# Compression of the output: messages (WebSocket) and responses (HTTP)
+# smaller than the threshold are sent as they are. WebSocket compression
+# is "permessage-deflate"; the window size is the base 2 logarithm
+# of the size of the history buffer of the compressors (9...15, the larger
+# the better, but each connection needs 2**(window + 2) bytes for it).
+# Without context takeover the history is reset at every message: it uses
+# less memory, but the compression ratio of terminal output is much worse.
+DEFAULT_COMPRESSION_LEVEL = 6
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+DEFAULT_WS_WINDOW_BITS = 12
+
+# Memory for the cache of the files served by HTTP (0 = no cache).
+# Files larger than the stream threshold are not cached, they are sent
+# directly from the disk (by "sendfile", if available).
+DEFAULT_STATIC_CACHE_SIZE = 16777216
+DEFAULT_STREAM_THRESHOLD = 1048576
+
+# Uploads are written by a pool of threads, in blocks of this size.
+# An upload that receives nothing for the timeout (seconds) is
+# abandoned, and its partial file is removed.
+DEFAULT_UPLOAD_BLOCK_SIZE = 1048576
+DEFAULT_UPLOAD_THREADS = 4
+DEFAULT_UPLOAD_TIMEOUT = 600
+
+# Command run by the sessions. Other commands can be given as named
+# profiles in a JSON file, e.g.
+#  { "python": { "command": "python3 -q", "env": { "PYTHONSTARTUP": null }, "cwd": "/tmp" } }
+# ("argv" can be given instead of "command"), and a session selects
+# one with SHELL_PARAM. "env" is applied on top of the environment of
+# the server, null removes a variable.
+DEFAULT_SHELL_COMMAND = "/bin/bash"
+DEFAULT_SHELL_PROFILE = "default"
+
+# Shells started in advance, so that a new session doesn't wait for
+# the start of its shell. When the pool falls below the low watermark,
+# it is filled up to the high one, one shell at a time (0 = no pool).
+DEFAULT_SHELL_POOL_HIGH = 2
+DEFAULT_SHELL_POOL_LOW = 1
+
+# Ended shells: how long to wait for the exit status of a shell after
+# it has been killed (seconds), and how many closed sessions are kept,
+# with their exit status and resource usage, for the session list.
+REAP_TIMEOUT_S = 5
+DEFAULT_CLOSED_SESSIONS = 100
 
 initial_nlines = DEFAULT_NLINES
 initial_ncolumns = DEFAULT_NCOLUMNS
+# Replay of a recorded session instead of a shell (see ReplayReader).
+# Speed 0 means "as fast as possible", repeat 0 means "forever".
+DEFAULT_REPLAY_SPEED = 1.0
+DEFAULT_REPLAY_REPEAT = 1
+replay_file = None
+replay_timing_file = None
+replay_speed = DEFAULT_REPLAY_SPEED
+replay_repeat = DEFAULT_REPLAY_REPEAT
+replay = None
 bind_address = DEFAULT_BIND_ADDRESS
 http_port = DEFAULT_HTTP_PORT
 websocket_port = DEFAULT_WEBSOCKET_PORT
+long_poll_max_ms = DEFAULT_LONG_POLL_MAX_MS
+long_poll_coalesce_ms = DEFAULT_LONG_POLL_COALESCE_MS
+output_flush_ms = DEFAULT_OUTPUT_FLUSH_MS
+output_flush_bytes = DEFAULT_OUTPUT_FLUSH_BYTES
+read_size = DEFAULT_READ_SIZE
+read_size_max = DEFAULT_READ_SIZE_MAX
+txq_limit = DEFAULT_TXQ_LIMIT
+rxq_limit = DEFAULT_RXQ_LIMIT
+overflow_policy = DEFAULT_OVERFLOW_POLICY
+overflow_threshold = DEFAULT_OVERFLOW_THRESHOLD
+history_size = DEFAULT_HISTORY_SIZE
+history_lines = DEFAULT_HISTORY_LINES
+enable_compression = True
+compression_level = DEFAULT_COMPRESSION_LEVEL
+compression_threshold = DEFAULT_COMPRESSION_THRESHOLD
+ws_window_bits = DEFAULT_WS_WINDOW_BITS
+ws_context_takeover = True
+static_cache_size = DEFAULT_STATIC_CACHE_SIZE
+stream_threshold = DEFAULT_STREAM_THRESHOLD
+stall_threshold_ms = DEFAULT_STALL_THRESHOLD_MS
+session_idle_timeout = DEFAULT_SESSION_IDLE_TIMEOUT
+static_cache = None
+upload_block_size = DEFAULT_UPLOAD_BLOCK_SIZE
+upload_threads = DEFAULT_UPLOAD_THREADS
+upload_timeout = DEFAULT_UPLOAD_TIMEOUT
+upload_executor = None
+shell_command = DEFAULT_SHELL_COMMAND
+shell_profiles_file = None
+shell_profiles = { DEFAULT_SHELL_PROFILE: { "argv": [ DEFAULT_SHELL_COMMAND ], "env": None, "cwd": None } }
+# Shells are started by a helper process (see SpawnHelper), if possible.
+enable_spawn_helper = True
+shell_pool_high = DEFAULT_SHELL_POOL_HIGH
+shell_pool_low = DEFAULT_SHELL_POOL_LOW
+closed_sessions = DEFAULT_CLOSED_SESSIONS
+# If True, every session keeps a model of its screen, so that
+# a client can request a copy of the current screen when it reconnects.
+enable_screen_model = False
 debug = False
 enable_http = True
 conhost_helper_pipe = None
@@ -363,17 +550,414 @@ else:
     #default_encoding = 'cp1252'
     default_encoding = 'utf-8'
 
-def find_valid_encoded(text):
-    for i in range(len(text), 0, -1):
+# Error policy of the decoder applied to the output of the shell.
+# "replace" substitutes invalid sequences with U+FFFD, "surrogateescape"
+# maps them to lone surrogates (so the original bytes can be recovered),
+# "strict" discards the chunk that contains them.
+DECODE_ERROR_POLICIES = [ 'replace', 'strict', 'surrogateescape' ]
+DEFAULT_DECODE_ERRORS = 'replace'
+decode_errors = DEFAULT_DECODE_ERRORS
+
+def new_decoder():
+    # Incremental decoders keep an incomplete multibyte sequence
+    # at the end of a chunk and complete it with the next one, so every
+    # byte is decoded exactly once.
+    return codecs.getincrementaldecoder(default_encoding)(errors=decode_errors)
+
+class Histogram:
+
+    # Cumulative histogram, in the Prometheus format. "buckets" are
+    # the upper bounds, in increasing order.
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [ 0 ] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def render(self, name, labels, out):
+        sep = "," if labels else ""
+        n = 0
+        for b, c in zip(self.buckets, self.counts):
+            n += c
+            out.append(name + '_bucket{' + labels + sep + 'le="' + str(b) + '"} ' + str(n))
+        out.append(name + '_bucket{' + labels + sep + 'le="+Inf"} ' + str(self.count))
+        labels = "{" + labels + "}" if labels else ""
+        out.append(name + '_sum' + labels + ' ' + str(self.sum))
+        out.append(name + '_count' + labels + ' ' + str(self.count))
+
+
+class Metrics:
+
+    # Counters of the whole server, exported in the Prometheus text format
+    # at METRICS_PATH. Counting is a dictionary update, so they are always
+    # on. The values that can be read from the sessions (queues and so on)
+    # are collected only when the metrics are requested.
+    # With "-fix-aiohttp" the WebSocket sessions live in another process,
+    # whose counters are not exported.
+    # The keys of "counters" are (name, labels).
+
+    DESCRIPTIONS = {
+        "xwterm_sessions_created_total": ("counter", "Sessions created."),
+        "xwterm_sessions_closed_total": ("counter", "Sessions removed (shell exited, killed or expired)."),
+        "xwterm_shells_started_total": ("counter", "Shell processes started."),
+        "xwterm_shells_exited_total": ("counter", "Shell processes terminated."),
+        "xwterm_shell_pool_hits_total": ("counter", "Sessions that took their shell from the pool."),
+        "xwterm_shell_pool_misses_total": ("counter", "Sessions that started their shell because the pool was empty."),
+        "xwterm_shell_pool_shells": ("gauge", "Shells ready in the pool."),
+        "xwterm_session_ends_total": ("counter", "Sessions whose shell has ended, by reason (exit, kill, idle, disconnect)."),
+        "xwterm_shell_cpu_seconds_total": ("counter", "CPU time used by the shells that have ended."),
+        "xwterm_transport_bytes_total": ("counter", "Data exchanged, by transport and direction (characters for text messages)."),
+        "xwterm_transport_messages_total": ("counter", "Messages exchanged, by transport and direction."),
+        "xwterm_output_stalls_total": ("counter", "Times the output of a shell was suspended because of a slow client."),
+        "xwterm_output_resyncs_total": ("counter", "Times the output queued for a slow client was replaced by a copy of the screen."),
+        "xwterm_http_requests_total": ("counter", "HTTP requests, by method and status."),
+        "xwterm_static_cache_hits_total": ("counter", "Files served from the cache."),
+        "xwterm_static_cache_misses_total": ("counter", "Files read from the disk."),
+        "xwterm_sessions": ("gauge", "Current sessions."),
+        "xwterm_shells": ("gauge", "Current shell processes."),
+        "xwterm_attachments": ("gauge", "Clients attached to sessions of other clients."),
+        "xwterm_queue_bytes": ("gauge", "Data in the queues of all the sessions."),
+        "xwterm_queue_max_bytes": ("gauge", "Data in the longest queue."),
+        "xwterm_tasks": ("gauge", "Tasks of the event loop."),
+        "xwterm_event_loop_lag_seconds": ("gauge", "Last measured delay of the event loop."),
+        "xwterm_event_loop_stalls_total": ("counter", "Times the event loop was blocked longer than the stall threshold."),
+        "xwterm_pty_read_bytes": ("histogram", "Size of the reads from the shells."),
+        "xwterm_ws_send_seconds": ("histogram", "Time to send a WebSocket message."),
+        "xwterm_http_request_duration_seconds": ("histogram", "Time to handle an HTTP request, by method."),
+        "xwterm_event_loop_lag": ("histogram", "Delay of the event loop (seconds)."),
+        "process_cpu_seconds_total": ("counter", "CPU time of the server."),
+        "process_resident_memory_bytes": ("gauge", "Resident memory of the server."),
+        "process_start_time_seconds": ("gauge", "Start time of the server."),
+    }
+
+    counters = collections.Counter()
+    read_size = Histogram([ 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576 ])
+    ws_send_time = Histogram([ 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5 ])
+    http_duration = {}
+    loop_lag = Histogram([ 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5 ])
+    loop_lag_last = 0
+    start_time = time.time()
+
+    def count(name, labels = "", n = 1):
+        Metrics.counters[(name, labels)] += n
+
+    def transfer(transport, direction, n):
+        labels = 'transport="' + transport + '",direction="' + direction + '"'
+        Metrics.counters[("xwterm_transport_bytes_total", labels)] += n
+        Metrics.counters[("xwterm_transport_messages_total", labels)] += 1
+
+    def http_request(method, status, duration):
+        Metrics.counters[("xwterm_http_requests_total", 'method="' + method + '",status="' + str(status) + '"')] += 1
+        h = Metrics.http_duration.get(method)
+        if h is None:
+            h = Histogram([ 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30 ])
+            Metrics.http_duration[method] = h
+        h.observe(duration)
+
+    async def ws_send(ws, message):
+        t = time.perf_counter()
+        await ws.send(message)
+        Metrics.ws_send_time.observe(time.perf_counter() - t)
+        Metrics.transfer("ws", "out", len(message))
+
+    async def monitor():
+        # Measures how late the event loop wakes up a task.
+        loop = asyncio.get_running_loop()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(LOOP_LAG_PERIOD)
+            lag = max(0, loop.time() - t - LOOP_LAG_PERIOD)
+            Metrics.loop_lag_last = lag
+            Metrics.loop_lag.observe(lag)
+
+    def gauges():
+        g = {}
+        sessions = list(Session.sessions.values())
+        g["xwterm_sessions"] = [ ("", len(sessions)) ]
+        g["xwterm_shells"] = [ ("", sum(1 for s in sessions if s.shell)) ]
+        g["xwterm_shell_pool_shells"] = [ ("", len(ShellPool.shells)) ]
+        g["xwterm_attachments"] = [ ("", sum(len(s.attachments) for s in sessions)) ]
+        active = [ s for s in sessions if s.txq ]
+        g["xwterm_queue_bytes"] = [ ('queue="txq"', sum(s.txq.size for s in active)),
+                                    ('queue="rxq"', sum(s.rxq.size for s in active)) ]
+        g["xwterm_queue_max_bytes"] = [ ('queue="txq"', max([ s.txq.size for s in active ], default = 0)),
+                                        ('queue="rxq"', max([ s.rxq.size for s in active ], default = 0)) ]
+        g["xwterm_tasks"] = [ ("", len(asyncio.all_tasks())) ]
+        g["xwterm_event_loop_lag_seconds"] = [ ("", Metrics.loop_lag_last) ]
+        if static_cache:
+            g["xwterm_static_cache_hits_total"] = [ ("", static_cache.hits) ]
+            g["xwterm_static_cache_misses_total"] = [ ("", static_cache.misses) ]
+        t = os.times()
+        g["process_cpu_seconds_total"] = [ ("", round(t.user + t.system, 3)) ]
+        try:
+            with open('/proc/self/statm') as f:
+                g["process_resident_memory_bytes"] = [ ("", int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')) ]
+        except (OSError, ValueError, IndexError, AttributeError):
+            pass
+        g["process_start_time_seconds"] = [ ("", round(Metrics.start_time, 3)) ]
+        return g
+
+    def render():
+        series = collections.defaultdict(list)
+        for (name, labels), v in Metrics.counters.items():
+            series[name].append((labels, v))
+        series.update(Metrics.gauges())
+        histograms = { "xwterm_pty_read_bytes": [ ("", Metrics.read_size) ],
+                       "xwterm_ws_send_seconds": [ ("", Metrics.ws_send_time) ],
+                       "xwterm_http_request_duration_seconds": [ ('method="' + m + '"', h) for m, h in Metrics.http_duration.items() ],
+                       "xwterm_event_loop_lag": [ ("", Metrics.loop_lag) ] }
+        out = []
+        for name, (kind, text) in Metrics.DESCRIPTIONS.items():
+            if name in histograms:
+                if not histograms[name]:
+                    continue
+                out.append("# HELP " + name + " " + text)
+                out.append("# TYPE " + name + " " + kind)
+                for labels, h in histograms[name]:
+                    h.render(name, labels, out)
+            elif name in series:
+                out.append("# HELP " + name + " " + text)
+                out.append("# TYPE " + name + " " + kind)
+                for labels, v in sorted(series[name]):
+                    out.append(name + ("{" + labels + "}" if labels else "") + " " + str(v))
+        out.append("")
+        return "\n".join(out)
+
+if has_aiohttp:
+
+    # Without aiohttp the server runs in WebSocket-only mode.
+
+    @aiohttp.web.middleware
+    async def metrics_middleware(request, handler):
+        t = time.perf_counter()
+        status = 500
         try:
-            t = text[:i].decode(default_encoding)
-            return t, text[i:]
-        except UnicodeDecodeError:
-            continue
-    return "", text
+            response = await handler(request)
+            status = response.status
+            return response
+        except aiohttp.web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            Metrics.http_request(request.method, status, time.perf_counter() - t)
+
+async def do_GET_metrics(request):
+    return aiohttp.web.Response(body = Metrics.render().encode('utf-8'),
+                                headers = { 'Content-Type': 'text/plain; version=0.0.4; charset=utf-8' })
+
+
+class Timed:
+
+    # Awaitable that runs a coroutine and, if the "timing" debug flag is
+    # set, measures each of its steps (the time between two awaits,
+    # during which the event loop can't do anything else).
+
+    __slots__ = ("name", "coro")
+
+    def __init__(self, name, coro):
+        self.name = name
+        self.coro = coro
+
+    def __await__(self):
+        coro = self.coro
+        value = None
+        exc = None
+        while True:
+            timing = "timing" in DEBUG_FLAGS
+            if timing:
+                t = time.perf_counter()
+            try:
+                if exc is None:
+                    f = coro.send(value)
+                else:
+                    f = coro.throw(exc)
+            except StopIteration as e:
+                if timing:
+                    Debug.record(self.name, time.perf_counter() - t)
+                return e.value
+            except BaseException:
+                if timing:
+                    Debug.record(self.name, time.perf_counter() - t)
+                raise
+            if timing:
+                Debug.record(self.name, time.perf_counter() - t)
+            try:
+                value = yield f
+                exc = None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                value = None
+                exc = e
+
+
+class Debug:
+
+    # Diagnostic tools for the event loop, switched on and off
+    # by DEBUG_FLAGS, also while the server runs (see DEBUG_PARAM):
+    #  "stall": a thread (the watchdog) checks that the event loop
+    #   runs a periodic callback in time. When it doesn't, a callback
+    #   or a step of a task is blocking the loop, and its stack is
+    #   recorded.
+    #  "profile": a thread samples the stack of the event loop, and
+    #   counts the samples of each stack, in the "collapsed" format
+    #   of flame graph tools.
+    #  "timing": the tasks of the sessions and of the transports
+    #   measure their steps (see Timed).
+    # Threads stop by themselves when their flag is removed.
+
+    stalls = collections.deque(maxlen = 32)
+    samples = collections.Counter()
+    timings = {}
+    loop = None
+    thread_id = None
+    heartbeat = 0
+    beat_handle = None
+    watchdog = None
+    sampler = None
+
+    def start():
+        Debug.loop = asyncio.get_running_loop()
+        Debug.thread_id = threading.get_ident()
+        Debug.update()
+
+    def set_flags(spec):
+        # "+flag" or "flag" sets a flag, "-flag" clears it.
+        for f in spec.split(','):
+            f = f.strip()
+            if f.startswith('-'):
+                DEBUG_FLAGS.discard(f[1:])
+            elif f.startswith('+'):
+                DEBUG_FLAGS.add(f[1:])
+            elif f:
+                DEBUG_FLAGS.add(f)
+        if Debug.loop:
+            Debug.update()
+
+    def update():
+        if "stall" in DEBUG_FLAGS:
+            if Debug.beat_handle is None:
+                Debug.beat()
+            if Debug.watchdog is None:
+                Debug.watchdog = threading.Thread(target = Debug.watch, name = "watchdog", daemon = True)
+                Debug.watchdog.start()
+        if "profile" in DEBUG_FLAGS and Debug.sampler is None:
+            Debug.sampler = threading.Thread(target = Debug.sample, name = "profiler", daemon = True)
+            Debug.sampler.start()
+
+    def beat():
+        Debug.heartbeat = time.monotonic()
+        if "stall" in DEBUG_FLAGS:
+            Debug.beat_handle = Debug.loop.call_later(stall_threshold_ms / 4000, Debug.beat)
+        else:
+            Debug.beat_handle = None
+
+    def stack(frame):
+        # Names of the functions, from the outermost.
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(os.path.basename(code.co_filename) + ":" + getattr(code, 'co_qualname', code.co_name))
+            frame = frame.f_back
+        names.reverse()
+        return names
+
+    def watch():
+        period = stall_threshold_ms / 4000
+        last = None
+        stall = None
+        while "stall" in DEBUG_FLAGS:
+            time.sleep(period)
+            hb = Debug.heartbeat
+            late = time.monotonic() - hb - period
+            if late * 1000 < stall_threshold_ms:
+                continue
+            if hb == last:
+                # Still the same stall
+                stall["ms"] = round(late * 1000)
+                continue
+            frame = sys._current_frames().get(Debug.thread_id)
+            if frame is None:
+                # Nothing recorded: try again at the next tick.
+                continue
+            last = hb
+            stack = traceback.format_stack(frame)
+            stall = { "time": datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"),
+                      "ms": round(late * 1000),
+                      "stack": [ s.rstrip() for s in stack ] }
+            Debug.stalls.append(stall)
+            Metrics.count("xwterm_event_loop_stalls_total")
+            print("Event loop blocked for more than", stall["ms"], "ms, in:", stack[-1].strip().split('\n')[0])
+        Debug.watchdog = None
+
+    def sample():
+        while "profile" in DEBUG_FLAGS:
+            frame = sys._current_frames().get(Debug.thread_id)
+            if frame is not None:
+                Debug.samples[";".join(Debug.stack(frame))] += 1
+            del frame
+            time.sleep(PROFILE_INTERVAL)
+        Debug.sampler = None
+
+    def profile(op):
+        if op == 'start':
+            Debug.samples.clear()
+            Debug.set_flags("+profile")
+        elif op == 'stop':
+            Debug.set_flags("-profile")
+        return "".join(s + " " + str(n) + "\n" for s, n in Debug.samples.most_common())
+
+    async def timed(name, coro):
+        # Coroutine that runs "coro" measuring its steps.
+        return await Timed(name, coro)
+
+    def record(name, t):
+        s = Debug.timings.get(name)
+        if s is None:
+            s = [ 0, 0, 0 ]
+            Debug.timings[name] = s
+        s[0] += 1
+        s[1] += t
+        if t > s[2]:
+            s[2] = t
+
+    def state():
+        return { "flags": sorted(DEBUG_FLAGS),
+                 "stall_threshold_ms": stall_threshold_ms,
+                 "stalls": list(Debug.stalls),
+                 "profile_samples": sum(Debug.samples.values()),
+                 "timing": { name: { "steps": s[0],
+                                     "total_ms": round(s[1] * 1000, 3),
+                                     "avg_us": round(s[1] * 1000000 / s[0], 1) if s[0] else 0,
+                                     "max_ms": round(s[2] * 1000, 3) }
+                             for name, s in Debug.timings.items() } }
+
 
 class AsyncJob:
 
+    # A group of tasks supervised together. Every task is watched by a
+    # done callback, so adding a task or losing one costs the same however
+    # many tasks the job has (the session manager holds the jobs of all
+    # the sessions). The job ends when it's cancelled or, with
+    # "terminate_on_first_competed", when one of its tasks ends: then the
+    # other tasks are cancelled and awaited, and "on_task_termination" is
+    # called with the task that ended the job (None if it was cancelled).
+    # The job has no task of its own while it runs: the shutdown runs in
+    # a task created when the job ends, and "main" is a future that
+    # completes when all of this is done.
+
+    __slots__ = ('name', 'on_task_termination', 'terminate_on_first_competed',
+                 'tasks', 'ending', 'finished', 'closer', 'main')
+
     def dump(self):
         return self.name
 
@@ -381,86 +965,1413 @@ class AsyncJob:
         self.on_task_termination = on_task_termination
         self.terminate_on_first_competed = terminate_on_first_competed
         self.name = name
-        self.signal_q = asyncio.Queue()
         self.tasks = set()
+        self.ending = False
+        self.finished = None
+        self.closer = None
+        self.main = asyncio.get_running_loop().create_future()
         for t in tasklist:
-            self.tasks.add(t)
-        self.listener = asyncio.create_task(self.listen())
-        self.tasks.add(self.listener)
-        self.main = asyncio.create_task(self.job())
-
-    async def listen(self):
-        #print("Job ", self.name, ": waiting for signal")
-        ok = await self.signal_q.get()
-        #print("Job ", self.name, ": got signal ", ok)
-        return ok
-    
+            self.watch(t)
+
+    def watch(self, task):
+        if self.ending:
+            task.cancel()
+        self.tasks.add(task)
+        task.add_done_callback(self.on_done)
+
+    def on_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled():
+            e = task.exception()
+            if e is not None:
+                print("Job ", self.name, ": task failed: ", repr(e))
+        if self.terminate_on_first_competed:
+            self.end(task)
+
+    def end(self, task = None):
+        if not self.ending:
+            self.ending = True
+            self.finished = task
+            self.closer = asyncio.create_task(self.shutdown())
+
+    async def shutdown(self):
+        #print("Job ", self.name, ": terminating...")
+        try:
+            pending = list(self.tasks)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+            if self.on_task_termination:
+                await self.on_task_termination(self.finished)
+        finally:
+            if not self.main.done():
+                self.main.set_result(None)
+        #print("Job ", self.name, ": terminated")
+
     async def job(self):
+        # Waits for the end of the job.
+        await asyncio.shield(self.main)
+
+    async def add(self, task):
+        self.watch(task)
+
+    async def cancel(self):
+        self.end()
+        if asyncio.current_task() is not self.closer:
+            await asyncio.shield(self.main)
+
+
+class ByteQueue:
+
+    # A FIFO of strings similar to asyncio.Queue, but bounded by the total
+    # length of the items instead of their number. "put_nowait" always
+    # accepts the item, so producers that can't wait may exceed the limit.
+    # Producers that can wait call "wait_space" (or "put"), which blocks
+    # when the queue is full ("blocked") until it has been drained to half
+    # its limit. Waiters are futures created when somebody waits, so an
+    # idle queue costs little more than its deque.
+
+    __slots__ = ('limit', 'items', 'size', 'blocked', 'getters', 'putters')
+
+    def __init__(self, limit = 0):
+        self.limit = limit
+        self.items = collections.deque()
+        self.size = 0
+        self.blocked = False
+        self.getters = []
+        self.putters = []
+
+    def wake(waiters):
+        for w in waiters:
+            if not w.done():
+                w.set_result(None)
+        waiters.clear()
+
+    async def wait(waiters):
+        w = asyncio.get_running_loop().create_future()
+        waiters.append(w)
+        try:
+            await w
+        finally:
+            if w in waiters:
+                waiters.remove(w)
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return len(self.items) == 0
+
+    def full(self):
+        return self.limit > 0 and self.size >= self.limit
+
+    def put_nowait(self, item):
+        self.items.append(item)
+        self.size += len(item)
+        if self.getters:
+            ByteQueue.wake(self.getters)
+        if self.full():
+            self.blocked = True
+
+    def unblock(self):
+        self.blocked = False
+        if self.putters:
+            ByteQueue.wake(self.putters)
+
+    async def wait_space(self):
+        while self.blocked:
+            await ByteQueue.wait(self.putters)
+
+    async def put(self, item):
+        await self.wait_space()
+        self.put_nowait(item)
+
+    def get_nowait(self):
+        if len(self.items) == 0:
+            raise asyncio.QueueEmpty
+        item = self.items.popleft()
+        self.size -= len(item)
+        if self.blocked and self.size <= self.limit // 2:
+            self.unblock()
+        return item
+
+    async def get(self):
+        while len(self.items) == 0:
+            await ByteQueue.wait(self.getters)
+        return self.get_nowait()
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+        self.unblock()
+
+
+class OutputBatcher:
+
+    # This is the stage between the shell and the clients. It merges
+    # the chunks of output, so that a burst of output reaches the
+    # clients as a few large messages instead of many small ones.
+    # Batches are flushed by size or by time, whichever comes first.
+
+    __slots__ = ('deliver', 'stats', 'chunks', 'size', 'timer')
+
+    def __init__(self, deliver, stats):
+        self.deliver = deliver
+        self.stats = stats
+        self.chunks = []
+        self.size = 0
+        self.timer = None
+        for k in [ "out_chunks", "out_bytes", "out_batches", "flush_size", "flush_time" ]:
+            self.stats[k] = 0
+
+    def push(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        self.stats["out_chunks"] += 1
+        self.stats["out_bytes"] += len(text)
+        if self.size >= output_flush_bytes or output_flush_ms <= 0:
+            self.stats["flush_size"] += 1
+            self.flush()
+        elif self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(output_flush_ms / 1000, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.stats["flush_time"] += 1
+        self.flush()
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if len(self.chunks) == 0:
+            return
+        if len(self.chunks) == 1:
+            text = self.chunks[0]
+        else:
+            text = "".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        self.stats["out_batches"] += 1
+        self.deliver(text)
+
+    def discard(self):
+        self.close()
+        self.chunks = []
+        self.size = 0
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+
+def binary_frame(text):
+    # "surrogateescape" gives back the original bytes of invalid
+    # sequences, if the decoder preserved them.
+    return WS_TAG_DATA + text.encode('utf-8', 'surrogateescape')
 
-        while True:
-            #print("Job ", self.name, ": waiting for tasks")
-            
-            tasks = list(self.tasks)
-            tasks.append(self.listener)
 
-            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+class OutputChunk:
 
-            #print("Job ", self.name, ": ", len(done), " completed, ", len(pending), " pending")
+    # A batch of output shared by all the clients attached to a session.
+    # Its WebSocket frame is built once, the first time a client needs it.
 
-            end = False
+    __slots__ = ('text', 'frame', 'data')
 
-            #for task in pending:
-            #   print("Task pending: ", task)
+    def __init__(self, text):
+        self.text = text
+        self.frame = None
+        self.data = None
 
-            for task in done:
-                #print("Task done: ", task)
-                result = await task
-                if task == self.listener:
-                    #print("Job ", self.name, ": signaled ", result)
-                    if not result:
-                        end = True
-                    self.listener = None
+    def __len__(self):
+        return len(self.text)
+
+    def json(self):
+        if self.frame is None:
+            self.frame = json.dumps({ 'text': self.text })
+        return self.frame
+
+    def binary(self):
+        if self.data is None:
+            self.data = binary_frame(self.text)
+        return self.data
+
+
+class Attachment:
+
+    # A client attached to a session that already has its own client
+    # (see "Session.attach"). It gets the same output, through a queue
+    # of its own. Read-only attachments can't send input nor resize
+    # the screen.
+
+    def __init__(self, session, readonly = False):
+        self.session = session
+        self.readonly = readonly
+        self.queue = ByteQueue(txq_limit)
+
+    def push(self, chunk):
+        if self.queue.size + len(chunk) > overflow_threshold and self.session.screen:
+            # This client is too slow: skip to the current screen.
+            self.queue.clear()
+            self.queue.put_nowait(OutputChunk(self.session.screen.snapshot()))
+            self.session.stats["resyncs"] += 1
+            Metrics.count("xwterm_output_resyncs_total")
+        else:
+            self.queue.put_nowait(chunk)
+
+    async def next_output(self):
+        return await self.queue.get()
+
+
+class History:
+
+    # The scrollback of a session: the last output of the shell, kept in
+    # a ring buffer of fixed size as UTF-8 encoded text. Positions are
+    # absolute offsets in the output of the session since its start, so
+    # a client can ask for a range and then continue from where it stopped.
+    # The buffer is allocated at the first write, so sessions that produce
+    # no output cost nothing.
+    # The line limit is applied when the history is read, by looking for
+    # line ends backwards from the end of the buffer: writing costs
+    # the same whether there is a line limit or not.
+
+    def __init__(self, size, max_lines = 0):
+        self.size = size
+        self.max_lines = max_lines
+        self.buf = None
+        self.start = 0
+        self.end = 0
+
+    def write(self, text):
+        if self.size <= 0:
+            return
+        data = text.encode('utf-8', 'surrogateescape')
+        n = len(data)
+        if n == 0:
+            return
+        if self.buf is None:
+            self.buf = bytearray(self.size)
+        end = self.end + n
+        if n > self.size:
+            data = data[n - self.size:]
+        # Copy in two pieces when the data wrap around the end of the buffer
+        pos = (end - len(data)) % self.size
+        k = min(len(data), self.size - pos)
+        self.buf[pos:pos+k] = data[:k]
+        if k < len(data):
+            self.buf[:len(data)-k] = data[k:]
+        self.end = end
+        self.start = max(self.start, end - self.size)
+
+    def first(self):
+        # Offset of the oldest available byte
+        if self.max_lines > 0:
+            return self.line_start(self.max_lines)
+        return self.start
+
+    def rfind_newline(self, limit):
+        # Offset of the last newline before "limit", or -1
+        size = self.size
+        lo = self.start
+        while limit > lo:
+            # Search the contiguous piece of buffer that ends at "limit"
+            b = (limit - 1) % size + 1
+            a = max(b - (limit - lo), 0)
+            i = self.buf.rfind(b'\n', a, b)
+            if i >= 0:
+                return limit - (b - i)
+            limit -= b - a
+        return -1
+
+    def line_start(self, n):
+        # Offset of the first of the last "n" lines. The current line,
+        # if it isn't terminated yet, counts as one.
+        if self.end == self.start:
+            return self.start
+        limit = self.end
+        if self.buf[(limit - 1) % self.size] == 0x0a:
+            limit -= 1
+        pos = limit
+        for i in range(n):
+            k = self.rfind_newline(limit)
+            if k < 0:
+                return self.start
+            pos = k + 1
+            limit = k
+        return pos
+
+    def tail_start(self, nlines = 0, nbytes = 0):
+        # Offset of the last "nlines" lines or "nbytes" bytes, whichever
+        # is shorter. No limits = the whole history.
+        first = self.start
+        if nbytes > 0:
+            first = max(first, self.end - nbytes)
+        if self.max_lines > 0 and (nlines <= 0 or nlines > self.max_lines):
+            nlines = self.max_lines
+        if nlines > 0:
+            first = max(first, self.line_start(nlines))
+        return first
+
+    def read(self, first, last):
+        # Returns the text between the given offsets, limited to what
+        # is still available, and the actual offsets. Incomplete characters
+        # at the edges are excluded.
+        first = min(max(first, self.first()), self.end)
+        last = min(last, self.end)
+        if first >= last:
+            return "", first, first
+        a = first % self.size
+        n = last - first
+        if a + n <= self.size:
+            data = bytes(self.buf[a:a+n])
+        else:
+            data = bytes(self.buf[a:]) + bytes(self.buf[:a+n-self.size])
+        i = 0
+        while i < min(3, len(data)) and (data[i] & 0xc0) == 0x80:
+            i += 1
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        text = decoder.decode(data[i:])
+        last -= len(decoder.getstate()[0])
+        return text, first + i, last
+
+    def tail(self, nlines = 0, nbytes = 0):
+        return self.read(self.tail_start(nlines, nbytes), self.end)[0]
+
+
+class Screen:
+
+    # A model of the terminal screen, fed with the output of the shell.
+    # It keeps track of characters, attributes, cursor, scroll region
+    # and alternate screen, so that the current content of the screen can be
+    # reproduced at any moment ("snapshot"). It is not a complete emulator:
+    # character width is not taken into account (every code point takes
+    # one cell), and sequences it doesn't know are ignored.
+    #
+    # Each row is a pair of lists: characters and attributes. An attribute
+    # is the parameter string of the SGR sequence that selects it ("" is
+    # the default), so a snapshot can emit it as it is.
+    #
+    # The output is split into tokens by a single regular expression, and
+    # each token is dispatched through tables indexed by its final character.
+    # Blocks of plain lines (the typical bulk output) are recognized as a
+    # whole, so that lines that would scroll off the screen before the end
+    # of the block are not drawn at all.
+
+    SEQUENCES = re.compile(
+        r'((?:[^\x00-\x1f\x7f]*\r+\n){2,})'       # 1: block of plain lines
+        r'|([^\x00-\x1f\x7f]+)'                  # 2: text
+        r'|\x1b\[([0-?]*)[ -/]*([@-~])'           # 3, 4: CSI
+        r'|\x1b\]([^\x07\x1b]*)(?:\x07|\x1b\\)'   # 5: OSC
+        r'|\x1b[P^_X][^\x1b]*\x1b\\'              # DCS, PM, APC, SOS
+        r'|\x1b[ #%()*+][ -~]'                    # Three-character sequences
+        r'|\x1b[^\[\]P^_X #%()*+]'                # Two-character sequences
+        r'|[\x00-\x1a\x1c-\x1f\x7f]')             # Control characters
+
+    MAX_PENDING = 4096
+
+    SGR_FLAGS = { 1: "1", 2: "2", 3: "3", 4: "4", 5: "5", 7: "7", 8: "8", 9: "9" }
+    SGR_RESETS = { 22: ("1", "2"), 23: ("3",), 24: ("4",), 25: ("5",), 27: ("7",), 28: ("8",), 29: ("9",) }
+
+    # DEC special graphics (line drawing) charset
+    LINE_DRAWING = str.maketrans(
+        "`abcdefghijklmnopqrstuvwxyz{|}~",
+        "◆▒␉␌␍␊°±␤␋┘┐┌└┼"
+        "⎺⎻─⎼⎽├┤┴┬│≤≥π≠£·")
+
+    # DEC private modes that change the screen buffer. The others are
+    # just recorded and reproduced by the snapshot.
+    ALT_SCREEN_MODES = ( 47, 1047, 1049 )
+
+    def __init__(self, li, co):
+        self.li = li
+        self.co = co
+        self.csi = {
+            'A': self.csi_cuu, 'B': self.csi_cud, 'C': self.csi_cuf, 'D': self.csi_cub,
+            'E': self.csi_cnl, 'F': self.csi_cpl, 'G': self.csi_cha, '`': self.csi_cha,
+            'H': self.csi_cup, 'f': self.csi_cup, 'd': self.csi_vpa, 'e': self.csi_cud,
+            'a': self.csi_cuf, 'I': self.csi_cht, 'Z': self.csi_cbt,
+            'J': self.csi_ed, 'K': self.csi_el, 'X': self.csi_ech,
+            '@': self.csi_ich, 'P': self.csi_dch, 'L': self.csi_il, 'M': self.csi_dl,
+            'S': self.csi_su, 'T': self.csi_sd, 'b': self.csi_rep,
+            'r': self.csi_decstbm, 's': self.csi_save, 'u': self.csi_restore,
+            'm': self.csi_sgr,
+        }
+        self.csi_private = {
+            'h': self.csi_decset, 'l': self.csi_decrst,
+            'J': self.csi_ed, 'K': self.csi_el,
+        }
+        self.controls = {
+            '\r': self.carriage_return, '\n': self.linefeed, '\x0b': self.linefeed,
+            '\x0c': self.linefeed, '\b': self.backspace, '\t': self.tab,
+            '\x0e': self.shift_out, '\x0f': self.shift_in,
+        }
+        self.escapes = {
+            '\x1b7': self.save_cursor, '\x1b8': self.restore_cursor,
+            '\x1bD': self.linefeed, '\x1bE': self.next_line, '\x1bM': self.reverse_index,
+            '\x1bc': self.reset, '\x1b=': self.keypad_application, '\x1b>': self.keypad_numeric,
+        }
+        self.pending = ""
+        self.reset()
+
+    def reset(self):
+        self.main_rows = self.blank_rows(self.li)
+        self.alt_rows = None
+        self.rows = self.main_rows
+        self.x = 0
+        self.y = 0
+        self.top = 0
+        self.bottom = self.li - 1
+        self.origin = False
+        self.autowrap = True
+        self.flags = []
+        self.fg = ""
+        self.bg = ""
+        self.attr = ""
+        self.charsets = [ 'B', 'B' ]
+        self.shift = 0
+        self.keypad = False
+        self.modes = {}
+        self.saved = None
+        self.saved_main = None
+        self.title = None
+        self.last_char = " "
+
+    def blank_row(self):
+        return ([ " " ] * self.co, [ "" ] * self.co)
+
+    def blank_rows(self, n):
+        return [ self.blank_row() for i in range(n) ]
+
+    # Output processing
+
+    def feed(self, text):
+        if self.pending:
+            text = self.pending + text
+            self.pending = ""
+        end = len(text)
+        i = text.rfind('\x1b', max(0, end - Screen.MAX_PENDING))
+        if i >= 0 and not Screen.SEQUENCES.match(text, i):
+            # Incomplete sequence, it will be completed by the next chunk.
+            # An unterminated string may contain it.
+            k = max(text.rfind('\x1b]', 0, i), text.rfind('\x1bP', 0, i))
+            if k >= max(0, end - Screen.MAX_PENDING) and not Screen.SEQUENCES.match(text, k):
+                i = k
+            self.pending = text[i:]
+            end = i
+        for m in Screen.SEQUENCES.finditer(text, 0, end):
+            g = m.lastindex
+            if g == 2:
+                self.put_text(m.group(2))
+            elif g == 1:
+                self.put_lines(m.group(1))
+            elif g == 4:
+                p = m.group(3)
+                if p == "" or p[0] <= '9' or p[0] == ';':
+                    f = self.csi.get(m.group(4))
+                    if f:
+                        f(p)
+                elif p[0] == '?':
+                    f = self.csi_private.get(m.group(4))
+                    if f:
+                        f(p[1:])
+            elif g == 5:
+                self.osc(m.group(5))
+            else:
+                s = m.group()
+                if s[0] != '\x1b':
+                    f = self.controls.get(s)
+                    if f:
+                        f()
                 else:
-                    self.tasks.remove(task)
-                    if self.terminate_on_first_competed:
-                        end = True
-                
-            if end:
-                #print("Job ", self.name, ": terminating...")
-                for task in pending:
-                    task.cancel()
-                    try:
-                    #
-                    # Hell, cancellation exception is propagated up to the current task...
-                    #
-                        await task            
-                    except (asyncio.CancelledError):
-                        pass
-                    except (GeneratorExit):
-                        raise
-                    except:
-                        pass
-                #print("Job ", self.name, ": invoking termination callback ", self.on_task_termination)
-                if self.on_task_termination:
-                    await self.on_task_termination(task)
-                #print("Job ", self.name, ": terminated")
-                break
-            if not self.listener:
-                self.listener = asyncio.create_task(self.listen())
+                    f = self.escapes.get(s)
+                    if f:
+                        f()
+                    elif len(s) == 3 and s[1] in '()':
+                        self.charsets[0 if s[1] == '(' else 1] = s[2]
+
+    def put_text(self, text):
+        if self.charsets[self.shift] == '0':
+            text = text.translate(Screen.LINE_DRAWING)
+        co = self.co
+        n = len(text)
+        i = 0
+        while i < n:
+            if self.x >= co:
+                if self.autowrap:
+                    self.x = 0
+                    self.linefeed()
+                else:
+                    self.x = co - 1
+            chars, attrs = self.rows[self.y]
+            x = self.x
+            k = min(n - i, co - x)
+            chars[x:x+k] = text[i:i+k]
+            attrs[x:x+k] = [ self.attr ] * k
+            self.x = x + k
+            i += k
+        self.last_char = text[-1]
+
+    def put_lines(self, block):
+        lines = block.split('\n')
+        lines.pop()
+        self.put_line(lines[0])
+        li = self.li
+        if len(lines) > 2 * li and self.top == 0 and self.bottom == li - 1 and self.autowrap:
+            # Find the lines that are still visible at the end of the block.
+            # The cursor is at the beginning of a line, so if there are at
+            # least as many lines before them as the screen has rows,
+            # the current content of the screen is scrolled away entirely.
+            co = self.co
+            k = len(lines)
+            r = 0
+            while r < li:
+                k -= 1
+                n = len(lines[k].rstrip('\r'))
+                r += max(1, (n + co - 1) // co)
+            if k > li:
+                self.rows[:] = self.blank_rows(li)
+                self.y = li - 1
+                lines = lines[k-1:]
+        for i in range(1, len(lines)):
+            self.put_line(lines[i])
+
+    def put_line(self, line):
+        line = line.rstrip('\r')
+        if line:
+            self.put_text(line)
+        self.x = 0
+        self.linefeed()
+
+    def scroll_up(self, n, top = None):
+        if top is None:
+            top = self.top
+        bottom = self.bottom + 1
+        n = min(n, bottom - top)
+        del self.rows[top:top+n]
+        self.rows[bottom-n:bottom-n] = self.blank_rows(n)
+
+    def scroll_down(self, n, top = None):
+        if top is None:
+            top = self.top
+        bottom = self.bottom + 1
+        n = min(n, bottom - top)
+        del self.rows[bottom-n:bottom]
+        self.rows[top:top] = self.blank_rows(n)
+
+    def linefeed(self):
+        if self.y == self.bottom:
+            self.scroll_up(1)
+        elif self.y < self.li - 1:
+            self.y += 1
+
+    def reverse_index(self):
+        if self.y == self.top:
+            self.scroll_down(1)
+        elif self.y > 0:
+            self.y -= 1
+
+    def next_line(self):
+        self.x = 0
+        self.linefeed()
+
+    def carriage_return(self):
+        self.x = 0
+
+    def backspace(self):
+        self.x = max(0, min(self.x, self.co - 1) - 1)
+
+    def tab(self):
+        self.x = min(self.co - 1, (self.x // 8 + 1) * 8)
+
+    def shift_out(self):
+        self.shift = 1
+
+    def shift_in(self):
+        self.shift = 0
+
+    def keypad_application(self):
+        self.keypad = True
+
+    def keypad_numeric(self):
+        self.keypad = False
+
+    def save_cursor(self):
+        self.saved = (self.x, self.y, self.flags, self.fg, self.bg, self.attr,
+                      self.origin, list(self.charsets), self.shift)
+
+    def restore_cursor(self):
+        if self.saved:
+            (self.x, self.y, self.flags, self.fg, self.bg, self.attr,
+                 self.origin, charsets, self.shift) = self.saved
+            self.charsets = list(charsets)
+            self.x = min(self.x, self.co - 1)
+            self.y = min(self.y, self.li - 1)
+        else:
+            self.move_to(0, 0)
 
+    def osc(self, s):
+        if s[:2] in ("0;", "2;"):
+            self.title = s[2:]
 
+    # CSI sequences
 
-    async def add(self, task):
-        self.tasks.add(task)
-        await self.signal_q.put(True)
+    def params(self, p, default = 1):
+        try:
+            return [ int(v) if v else default for v in p.split(';') ]
+        except ValueError:
+            return [ default ]
+
+    def param(self, p, default = 1):
+        v = self.params(p, default)[0]
+        return v if v > 0 else default
+
+    def move_to(self, y, x):
+        self.y = max(0, min(self.li - 1, y))
+        self.x = max(0, min(self.co - 1, x))
+
+    def csi_cuu(self, p):
+        top = self.top if self.y >= self.top else 0
+        self.move_to(max(top, self.y - self.param(p)), self.x)
+
+    def csi_cud(self, p):
+        bottom = self.bottom if self.y <= self.bottom else self.li - 1
+        self.move_to(min(bottom, self.y + self.param(p)), self.x)
+
+    def csi_cuf(self, p):
+        self.move_to(self.y, self.x + self.param(p))
+
+    def csi_cub(self, p):
+        self.move_to(self.y, min(self.x, self.co - 1) - self.param(p))
+
+    def csi_cnl(self, p):
+        self.csi_cud(p)
+        self.x = 0
+
+    def csi_cpl(self, p):
+        self.csi_cuu(p)
+        self.x = 0
+
+    def csi_cha(self, p):
+        self.move_to(self.y, self.param(p) - 1)
+
+    def csi_cht(self, p):
+        for i in range(self.param(p)):
+            self.tab()
+
+    def csi_cbt(self, p):
+        x = min(self.x, self.co - 1)
+        for i in range(self.param(p)):
+            x = max(0, (x - 1) // 8 * 8)
+        self.x = x
+
+    def csi_vpa(self, p):
+        y = self.param(p) - 1
+        if self.origin:
+            y = min(y + self.top, self.bottom)
+        self.move_to(y, self.x)
+
+    def csi_cup(self, p):
+        v = self.params(p)
+        y = v[0] if v[0] > 0 else 1
+        x = v[1] if len(v) > 1 and v[1] > 0 else 1
+        if self.origin:
+            y = min(y + self.top, self.bottom + 1)
+        self.move_to(y - 1, x - 1)
+
+    def erase(self, y, x0, x1):
+        chars, attrs = self.rows[y]
+        chars[x0:x1] = [ " " ] * (x1 - x0)
+        attrs[x0:x1] = [ self.bg ] * (x1 - x0)
+
+    def csi_ed(self, p):
+        mode = self.params(p, 0)[0]
+        x = min(self.x, self.co)
+        if mode == 0:
+            self.erase(self.y, x, self.co)
+            for y in range(self.y + 1, self.li):
+                self.erase(y, 0, self.co)
+        elif mode == 1:
+            for y in range(0, self.y):
+                self.erase(y, 0, self.co)
+            self.erase(self.y, 0, min(x + 1, self.co))
+        elif mode == 2 or mode == 3:
+            for y in range(0, self.li):
+                self.erase(y, 0, self.co)
+
+    def csi_el(self, p):
+        mode = self.params(p, 0)[0]
+        x = min(self.x, self.co)
+        if mode == 0:
+            self.erase(self.y, x, self.co)
+        elif mode == 1:
+            self.erase(self.y, 0, min(x + 1, self.co))
+        elif mode == 2:
+            self.erase(self.y, 0, self.co)
+
+    def csi_ech(self, p):
+        x = min(self.x, self.co - 1)
+        self.erase(self.y, x, min(self.co, x + self.param(p)))
+
+    def csi_ich(self, p):
+        x = min(self.x, self.co - 1)
+        n = min(self.param(p), self.co - x)
+        chars, attrs = self.rows[self.y]
+        chars[x:x] = [ " " ] * n
+        attrs[x:x] = [ self.bg ] * n
+        del chars[self.co:]
+        del attrs[self.co:]
+
+    def csi_dch(self, p):
+        x = min(self.x, self.co - 1)
+        n = min(self.param(p), self.co - x)
+        chars, attrs = self.rows[self.y]
+        del chars[x:x+n]
+        del attrs[x:x+n]
+        chars.extend([ " " ] * n)
+        attrs.extend([ self.bg ] * n)
+
+    def csi_il(self, p):
+        if self.top <= self.y <= self.bottom:
+            self.scroll_down(self.param(p), self.y)
+            self.x = 0
+
+    def csi_dl(self, p):
+        if self.top <= self.y <= self.bottom:
+            self.scroll_up(self.param(p), self.y)
+            self.x = 0
+
+    def csi_su(self, p):
+        self.scroll_up(self.param(p))
+
+    def csi_sd(self, p):
+        self.scroll_down(self.param(p))
+
+    def csi_rep(self, p):
+        self.put_text(self.last_char * min(self.param(p), self.li * self.co))
+
+    def csi_decstbm(self, p):
+        v = self.params(p, 0)
+        top = v[0] if v[0] > 0 else 1
+        bottom = v[1] if len(v) > 1 and v[1] > 0 else self.li
+        bottom = min(bottom, self.li)
+        if top < bottom:
+            self.top = top - 1
+            self.bottom = bottom - 1
+            self.move_to(self.top if self.origin else 0, 0)
+
+    def csi_save(self, p):
+        if p == "":
+            self.save_cursor()
+
+    def csi_restore(self, p):
+        if p == "":
+            self.restore_cursor()
+
+    def csi_decset(self, p):
+        for mode in self.params(p, 0):
+            self.set_mode(mode, True)
+
+    def csi_decrst(self, p):
+        for mode in self.params(p, 0):
+            self.set_mode(mode, False)
+
+    def set_mode(self, mode, value):
+        if mode in Screen.ALT_SCREEN_MODES:
+            self.set_alt_screen(mode, value)
+        elif mode == 1048:
+            if value:
+                self.save_cursor()
+            else:
+                self.restore_cursor()
+        else:
+            if mode == 6:
+                self.origin = value
+                self.move_to(self.top if value else 0, 0)
+            elif mode == 7:
+                self.autowrap = value
+            self.modes[mode] = value
+
+    def set_alt_screen(self, mode, value):
+        if value == (self.alt_rows is not None):
+            return
+        if value:
+            if mode == 1049:
+                self.save_cursor()
+            self.saved_main = self.saved
+            self.alt_rows = self.blank_rows(self.li)
+            self.rows = self.alt_rows
+        else:
+            self.alt_rows = None
+            self.rows = self.main_rows
+            self.saved = self.saved_main
+            if mode == 1049:
+                self.restore_cursor()
+
+    def csi_sgr(self, p):
+        v = self.params(p, 0)
+        i = 0
+        while i < len(v):
+            n = v[i]
+            i += 1
+            if n == 0:
+                self.flags = []
+                self.fg = ""
+                self.bg = ""
+            elif n in Screen.SGR_FLAGS:
+                f = Screen.SGR_FLAGS[n]
+                if f not in self.flags:
+                    self.flags = sorted(self.flags + [ f ])
+            elif n in Screen.SGR_RESETS:
+                r = Screen.SGR_RESETS[n]
+                self.flags = [ f for f in self.flags if f not in r ]
+            elif 30 <= n <= 37 or 90 <= n <= 97:
+                self.fg = str(n)
+            elif n == 39:
+                self.fg = ""
+            elif 40 <= n <= 47 or 100 <= n <= 107:
+                self.bg = str(n)
+            elif n == 49:
+                self.bg = ""
+            elif n == 38 or n == 48:
+                # Extended colors: 38;5;n or 38;2;r;g;b
+                if i < len(v) and v[i] == 5:
+                    c = ";".join(str(k) for k in v[i-1:i+2])
+                    i += 2
+                elif i < len(v) and v[i] == 2:
+                    c = ";".join(str(k) for k in v[i-1:i+4])
+                    i += 4
+                else:
+                    break
+                if n == 38:
+                    self.fg = c
+                else:
+                    self.bg = c
+        self.attr = ";".join(self.flags + [ c for c in (self.fg, self.bg) if c ])
 
-    async def cancel(self):
-        await self.signal_q.put(False)
+    # Geometry
+
+    def resize_rows(self, rows, li, co, y):
+        if co != self.co:
+            for chars, attrs in rows:
+                if co < self.co:
+                    del chars[co:]
+                    del attrs[co:]
+                else:
+                    chars.extend([ " " ] * (co - self.co))
+                    attrs.extend([ "" ] * (co - self.co))
+        drop = 0
+        if li < self.li:
+            # Keep the cursor line visible
+            drop = max(0, y - (li - 1))
+            del rows[:drop]
+            del rows[li:]
+        else:
+            rows.extend([ ([ " " ] * co, [ "" ] * co) for i in range(li - self.li) ])
+        return drop
+
+    def resize(self, li, co):
+        if li == self.li and co == self.co:
+            return
+        if self.alt_rows is not None:
+            self.resize_rows(self.main_rows, li, co, self.li - 1)
+            self.y -= self.resize_rows(self.alt_rows, li, co, self.y)
+        else:
+            self.y -= self.resize_rows(self.main_rows, li, co, self.y)
+        self.li = li
+        self.co = co
+        self.top = 0
+        self.bottom = li - 1
+        self.move_to(self.y, self.x)
+
+    # Reproduction of the current content of the screen
+
+    def sgr(self, attr):
+        if attr:
+            return "\x1b[0;" + attr + "m"
+        return "\x1b[0m"
+
+    def paint(self, out, rows):
+        out.append("\x1b[0m\x1b(B\x0f\x1b[r\x1b[H\x1b[2J")
+        cur = ""
+        for y, (chars, attrs) in enumerate(rows):
+            # Skip the trailing blanks
+            n = len(chars)
+            while n > 0 and chars[n - 1] == " " and attrs[n - 1] == "":
+                n -= 1
+            if n == 0:
+                continue
+            out.append("\x1b[" + str(y + 1) + "H")
+            start = 0
+            while start < n:
+                a = attrs[start]
+                end = start + 1
+                while end < n and attrs[end] == a:
+                    end += 1
+                if a != cur:
+                    out.append(self.sgr(a))
+                    cur = a
+                out.append("".join(chars[start:end]))
+                start = end
+
+    def snapshot(self):
+        # A sequence that brings a terminal in the state of the model.
+        # The cursor saved by DECSC is not reproduced.
+        out = []
+        if self.title is not None:
+            out.append("\x1b]0;" + self.title + "\x07")
+        out.append("\x1b[?1049l")
+        self.paint(out, self.main_rows)
+        if self.alt_rows is not None:
+            out.append("\x1b[?1049h")
+            self.paint(out, self.alt_rows)
+        for mode, value in self.modes.items():
+            out.append("\x1b[?" + str(mode) + ("h" if value else "l"))
+        if self.top != 0 or self.bottom != self.li - 1:
+            out.append("\x1b[" + str(self.top + 1) + ";" + str(self.bottom + 1) + "r")
+        y = self.y
+        if self.origin:
+            out.append("\x1b[?6h")
+            y -= self.top
+        if self.x >= self.co:
+            # Pending wrap: rewrite the last character to reproduce it.
+            chars, attrs = self.rows[self.y]
+            out.append("\x1b[" + str(y + 1) + ";" + str(self.co) + "H")
+            out.append(self.sgr(attrs[-1]) + chars[-1])
+        else:
+            out.append("\x1b[" + str(y + 1) + ";" + str(self.x + 1) + "H")
+        out.append(self.sgr(self.attr))
+        out.append("\x1b(" + self.charsets[0] + "\x1b)" + self.charsets[1])
+        out.append("\x0e" if self.shift else "\x0f")
+        out.append("\x1b=" if self.keypad else "\x1b>")
+        return "".join(out)
 
     
+def load_replay(typescript, timing = None):
+    # Loads a session recorded by "script -t" (or "script -T"): the
+    # typescript and, optionally, the timing file. Classic timing files
+    # have "<delay> <bytes>" lines; advanced ones ("script -T") have
+    # "<type> <delay> ..." lines, of which only "O" (output) carry data.
+    with open(typescript, 'rb') as f:
+        data = f.read()
+    start = 0
+    li, co = initial_nlines, initial_ncolumns
+    if data.startswith(b'Script started on'):
+        start = data.find(b'\n') + 1
+        m = re.search(rb'COLUMNS="(\d+)" LINES="(\d+)"', data[:start])
+        if m:
+            co, li = int(m.group(1)), int(m.group(2))
+    steps = []
+    if timing:
+        delay = 0
+        with open(timing, 'r') as f:
+            for line in f:
+                w = line.split()
+                if len(w) < 2:
+                    continue
+                if w[0][0].isalpha():
+                    delay += float(w[1])
+                    if w[0] == 'O' and len(w) >= 3:
+                        steps.append((delay, int(w[2])))
+                        delay = 0
+                else:
+                    steps.append((delay + float(w[0]), int(w[1])))
+                    delay = 0
+        end = min(len(data), start + sum(n for d, n in steps))
+    else:
+        end = data.rfind(b'\nScript done on')
+        if end < start:
+            end = len(data)
+    return { "data": data, "start": start, "end": end, "steps": steps, "li": li, "co": co }
+
+
+def load_shell_profiles(command, path = None):
+    # The default profile runs "command", the file (if any) adds
+    # other profiles, or replaces the default one.
+    profiles = { DEFAULT_SHELL_PROFILE: { "command": command } }
+    if path:
+        with open(path, 'r') as f:
+            profiles.update(json.load(f))
+    result = {}
+    for name, p in profiles.items():
+        argv = p.get("argv") or shlex.split(p.get("command", ""))
+        if not argv:
+            raise ValueError("profile " + name + ": no command")
+        result[name] = { "argv": [ str(a) for a in argv ], "env": p.get("env"), "cwd": p.get("cwd") }
+    return result
+
+
+class ReplayReader:
+
+    # The output of a recorded session, in place of that of a shell.
+    # Data are delivered in the chunks given by the timing file, at
+    # the recorded times divided by the speed factor. Times are
+    # computed from the beginning of the replay, so delays don't add up.
+    # With speed 0 (or without timing) data are delivered as fast as the
+    # session reads them. After the last repetition the reader waits
+    # like an idle shell, so the session stays open (and its output
+    # reaches the clients) until it's killed or expires.
+
+    def __init__(self, rec, speed, repeat):
+        self.rec = rec
+        self.speed = speed if rec["steps"] else 0
+        self.repeat = repeat
+        self.closed = False
+        self.idle = None
+        self.rewind()
+
+    def rewind(self):
+        self.pos = self.rec["start"]
+        self.step = 0
+        self.left = 0
+        self.due = asyncio.get_running_loop().time()
+
+    async def read(self, n):
+        rec = self.rec
+        while not self.closed:
+            if self.speed <= 0:
+                if self.pos < rec["end"]:
+                    data = rec["data"][self.pos:min(self.pos + n, rec["end"])]
+                    self.pos += len(data)
+                    return data
+            else:
+                if self.left == 0 and self.step < len(rec["steps"]):
+                    delay, self.left = rec["steps"][self.step]
+                    self.step += 1
+                    self.due += delay / self.speed
+                    wait = self.due - asyncio.get_running_loop().time()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                if self.left > 0:
+                    k = min(n, self.left, rec["end"] - self.pos)
+                    if k > 0:
+                        data = rec["data"][self.pos:self.pos + k]
+                        self.pos += k
+                        self.left -= k
+                        return data
+                    self.left = 0
+                    self.step = len(rec["steps"])
+                if self.step < len(rec["steps"]):
+                    continue
+            # End of the recording
+            if self.repeat == 1:
+                self.idle = asyncio.get_running_loop().create_future()
+                await self.idle
+                break
+            if self.repeat > 1:
+                self.repeat -= 1
+            self.rewind()
+        return b''
+
+    async def close(self):
+        self.closed = True
+        if self.idle is not None and not self.idle.done():
+            self.idle.set_result(None)
+
+
+class DiscardWriter:
+
+    # Input of a replayed session: nobody reads it.
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+
+class Reaper:
+
+    # Collects the shells that end, so that they don't stay around as
+    # zombies, with their exit status and the resources they have used
+    # (wait4). The shells started by the spawn helper are children of the
+    # helper, which reaps them and sends the results to the server. The
+    # shells started by the server itself are watched in the event loop
+    # by a pidfd or, where there are no pidfds, by SIGCHLD.
+    # "children" maps a PID to a future whose result is (status, usage),
+    # both None if the status of the process can't be known.
+
+    children = {}
+    local = set()
+    sigchld = False
+
+    def track(pid, local = False):
+        f = Reaper.children.get(pid)
+        if f is not None:
+            return f
+        loop = asyncio.get_running_loop()
+        f = loop.create_future()
+        Reaper.children[pid] = f
+        if local:
+            Reaper.local.add(pid)
+            try:
+                pidfd = os.pidfd_open(pid)
+            except (AttributeError, OSError):
+                pidfd = None
+            if pidfd is not None:
+                loop.add_reader(pidfd, Reaper.on_pidfd, pid, pidfd)
+            else:
+                if not Reaper.sigchld:
+                    loop.add_signal_handler(signal.SIGCHLD, Reaper.on_sigchld)
+                    Reaper.sigchld = True
+                # It may have ended already.
+                Reaper.collect(pid)
+        return f
+
+    def on_pidfd(pid, pidfd):
+        asyncio.get_running_loop().remove_reader(pidfd)
+        os.close(pidfd)
+        Reaper.collect(pid)
+
+    def on_sigchld():
+        for pid in list(Reaper.local):
+            Reaper.collect(pid)
+
+    def collect(pid):
+        try:
+            p, status, ru = os.wait4(pid, os.WNOHANG)
+        except ChildProcessError:
+            Reaper.exited(pid, None, None)
+            return
+        if p == pid:
+            Reaper.exited(pid, status, Reaper.usage(ru))
+
+    def exited(pid, status, usage):
+        Reaper.local.discard(pid)
+        f = Reaper.children.pop(pid, None)
+        if f is not None and not f.done():
+            f.set_result((status, usage))
+
+    def forget():
+        # The helper is gone, the exit of its children won't be known.
+        for pid in [ p for p in Reaper.children if p not in Reaper.local ]:
+            Reaper.exited(pid, None, None)
+
+    def usage(ru):
+        # CPU time in seconds (the process and the children it has
+        # waited for), maximum resident set size in KB.
+        return { "cpu": round(ru.ru_utime + ru.ru_stime, 3),
+                 "user": round(ru.ru_utime, 3),
+                 "sys": round(ru.ru_stime, 3),
+                 "maxrss": ru.ru_maxrss }
+
+    def live_usage(pid):
+        # The same for a running process, from /proc (Linux only).
+        # "maxrss" is the peak of the process itself here.
+        try:
+            with open('/proc/' + str(pid) + '/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            maxrss = 0
+            with open('/proc/' + str(pid) + '/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        maxrss = int(line.split()[1])
+            tick = os.sysconf('SC_CLK_TCK')
+            user = (int(fields[11]) + int(fields[13])) / tick
+            system = (int(fields[12]) + int(fields[14])) / tick
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None
+        return { "cpu": round(user + system, 3), "user": round(user, 3), "sys": round(system, 3), "maxrss": maxrss }
+
+    def exit_code(status):
+        # Like the return code of "subprocess": negative if the process
+        # was terminated by a signal.
+        if status is None:
+            return None
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+
+class SpawnHelper:
+
+    # A small process, forked at boot before the server grows, that starts
+    # the shells for it. Forking a big process copies its page tables and
+    # stalls the event loop for a while, so the server asks the helper
+    # instead: a request (a JSON object with "argv", "env", "cwd" and the
+    # size of the screen) goes through a Unix socket, and the helper
+    # answers with the PID of the shell and, as ancillary data
+    # (SCM_RIGHTS), the master side of its virtual terminal. Replies are
+    # matched to requests by "id". The helper reaps the shells, and sends
+    # { "exit": PID, "status": ..., "usage": ... } when one ends (see Reaper).
+    # If the helper isn't there (or dies), the server forks the shells by
+    # itself.
+
+    sock = None
+    pid = None
+    listening = False
+    pending = {}
+    seq = itertools.count()
+
+    def start():
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            a.close()
+            try:
+                SpawnHelper.serve(b)
+            finally:
+                os._exit(0)
+        b.close()
+        SpawnHelper.sock = a
+        SpawnHelper.pid = pid
+
+    def spawn(spec):
+        # Starts the shell described by "spec" in a new virtual terminal.
+        pid, fd = pty.fork()
+        if pid == 0:
+            try:
+                # Python ignores SIGPIPE and SIGXFSZ, the helper SIGINT.
+                for sig in [ signal.SIGINT, signal.SIGCHLD, signal.SIGPIPE, signal.SIGXFSZ ]:
+                    signal.signal(sig, signal.SIG_DFL)
+                fcntl.ioctl(0, termios.TIOCSWINSZ, struct.pack('HHHH', spec["li"], spec["co"], 0, 0))
+                if spec.get("cwd"):
+                    os.chdir(spec["cwd"])
+                env = os.environ.copy()
+                for k, v in (spec.get("env") or {}).items():
+                    if v is None:
+                        env.pop(k, None)
+                    else:
+                        env[k] = str(v)
+                os.execvpe(spec["argv"][0], spec["argv"], env)
+            except Exception as e:
+                print("exec(", spec["argv"][0], ") failed: ", e)
+            os._exit(1)
+        return pid, fd
+
+    def serve(sock):
+        # Main loop of the helper. It ends when the server closes the socket.
+        # SIGCHLD wakes it up through a pipe.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        r, w = os.pipe()
+        os.set_blocking(w, False)
+        signal.set_wakeup_fd(w)
+        signal.signal(signal.SIGCHLD, lambda n, f: None)
+        while True:
+            ready, _, _ = select.select([ sock, r ], [], [])
+            if r in ready:
+                os.read(r, 512)
+                SpawnHelper.reap(sock)
+            if sock not in ready:
+                continue
+            msg = sock.recv(65536)
+            if not msg:
+                break
+            req = json.loads(msg)
+            try:
+                pid, fd = SpawnHelper.spawn(req)
+            except OSError as e:
+                sock.send(json.dumps({ "id": req["id"], "error": str(e) }).encode('utf-8'))
+                continue
+            sock.sendmsg([ json.dumps({ "id": req["id"], "pid": pid }).encode('utf-8') ],
+                         [ (socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [ fd ])) ])
+            os.close(fd)
+
+    def reap(sock):
+        while True:
+            try:
+                pid, status, ru = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            sock.send(json.dumps({ "exit": pid, "status": status, "usage": Reaper.usage(ru) }).encode('utf-8'))
+
+    async def request(spec):
+        # Asks the helper for a shell, returns PID, terminal and
+        # the future of its exit status (see Reaper).
+        loop = asyncio.get_running_loop()
+        n = next(SpawnHelper.seq)
+        req = dict(spec)
+        req["id"] = n
+        try:
+            SpawnHelper.sock.send(json.dumps(req).encode('utf-8'))
+        except OSError:
+            SpawnHelper.lost()
+            raise
+        if not SpawnHelper.listening:
+            # From now on, the helper may send exit statuses at any time.
+            loop.add_reader(SpawnHelper.sock.fileno(), SpawnHelper.on_reply)
+            SpawnHelper.listening = True
+        f = loop.create_future()
+        SpawnHelper.pending[n] = f
+        try:
+            return await f
+        finally:
+            SpawnHelper.pending.pop(n, None)
+
+    def on_reply():
+        try:
+            msg, anc, flags, addr = SpawnHelper.sock.recvmsg(4096, socket.CMSG_SPACE(array.array('i').itemsize), socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return
+        except OSError:
+            msg = b''
+        if not msg:
+            SpawnHelper.lost()
+            return
+        fds = array.array('i')
+        for level, kind, data in anc:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        reply = json.loads(msg)
+        if "exit" in reply:
+            Reaper.exited(reply["exit"], reply["status"], reply["usage"])
+            return
+        f = SpawnHelper.pending.pop(reply["id"], None)
+        if f is None or f.done():
+            # Nobody waits for this shell anymore.
+            for fd in fds:
+                os.close(fd)
+            if "pid" in reply:
+                os.kill(reply["pid"], signal.SIGKILL)
+        elif "error" in reply or len(fds) == 0:
+            f.set_exception(OSError(reply.get("error", "no terminal")))
+        else:
+            f.set_result((reply["pid"], fds[0], Reaper.track(reply["pid"])))
+
+    def lost():
+        # The helper is gone: from now on the server forks by itself.
+        print("Spawn helper: terminated, shells are started by the server")
+        if SpawnHelper.listening:
+            asyncio.get_running_loop().remove_reader(SpawnHelper.sock.fileno())
+            SpawnHelper.listening = False
+        SpawnHelper.sock.close()
+        SpawnHelper.sock = None
+        Reaper.forget()
+        for f in SpawnHelper.pending.values():
+            if not f.done():
+                f.set_exception(OSError("spawn helper terminated"))
+        SpawnHelper.pending.clear()
+
+    async def start_shell(spec):
+        if SpawnHelper.sock is not None:
+            try:
+                return await SpawnHelper.request(spec)
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except OSError:
+                if SpawnHelper.sock is not None:
+                    raise
+        pid, fd = SpawnHelper.spawn(spec)
+        return pid, fd, Reaper.track(pid, True)
+
+
 class Shell:
 
-    def  __init__(self, name):
+    # A shell running in a virtual terminal (or a replayed recording).
+    # Resizes are debounced: a resize that comes less than
+    # RESIZE_MITIGATION_TIME_S after the previous one is applied by
+    # a timer of the event loop when that time has elapsed, so an idle
+    # shell has no task of its own. "reaped" is the future of the exit
+    # status of the process (see Reaper).
+
+    __slots__ = ('pid', 'proc', 'fd', 'rd', 'wr', 'err', 'kill', 'name', 'profile', 'pty', 'li', 'co',
+                 'last_resize_time', 'resize_timer', 'run', 'set_size_core', 'reaped')
+
+    def  __init__(self, name, profile = DEFAULT_SHELL_PROFILE):
         self.pid = None
         self.proc = None
         self.fd = None
@@ -469,21 +2380,19 @@ class Shell:
         self.err = None
         self.kill = None
         self.name = name or ""
+        self.profile = profile
         self.pty = None
         self.li = DEFAULT_NLINES
         self.co = DEFAULT_NCOLUMNS
         self.last_resize_time = time.time() - RESIZE_MITIGATION_TIME_S
-        self.resize_pending = False
-        self.resize_pending_event = asyncio.Event()
-        if RESIZE_MITIGATION_TIME_S > 0:
-            self.resize_polling_task = asyncio.create_task(self.resize_poll())
-            self.resize_pending_event = asyncio.Event()
-        else:
-            self.resize_polling_task = None
-            self.resize_pending_event = None
+        self.resize_timer = None
+        self.reaped = None
 
         #print("New shell: name=", self.name)
-        if platform.system() == "Linux":
+        if replay is not None:
+            self.run = self.run_replay
+            self.set_size_core = self.set_size_replay
+        elif platform.system() == "Linux":
             self.run = self.run_linux
             self.set_size_core = self.set_size_linux
         else:
@@ -496,6 +2405,9 @@ class Shell:
         s = struct.pack('HHHH', li, co, 0, 0)
         fcntl.ioctl(self.fd, termios.TIOCSWINSZ, s)
  
+    def set_size_replay(self, li, co):
+        pass
+
     def set_size_windows(self, li, co):
         if use_conhost:
             msg = PTY_SIGNAL_RESIZE_MESSAGE()
@@ -512,10 +2424,10 @@ class Shell:
                 raise ctypes.WinError(ctypes.get_last_error())
 
     def set_size_internal(self):
+        self.resize_timer = None
         try:
             self.last_resize_time = time.time()
             self.set_size_core(self.li, self.co)
-            self.resize_pending = False
             print("Process ", self.name, ": Size=", self.li, ",", self.co, " applied")
         except Exception as e:
             print("Process ", self.name, ": resize failed: ", e)
@@ -524,34 +2436,31 @@ class Shell:
         print("Process ", self.name, ": Resize request, Size=", li, ",", co)
         self.li = li
         self.co = co
-        if RESIZE_MITIGATION_TIME_S == 0:
-                self.set_size_internal()
-        elif not self.resize_pending:
-            if self.last_resize_time - time.time() >= RESIZE_MITIGATION_TIME_S:
-                self.set_size_internal()
-            else:
-                self.resize_pending = True
-                self.resize_pending_event.set()
-
-    async def resize_poll(self):
-        try:
-            while True:
-                await self.resize_pending_event.wait()
-                await asyncio.sleep(RESIZE_MITIGATION_TIME_S)
-                self.resize_pending_event.clear()
-                self.set_size_internal()
-        except asyncio.CancelledError:
-            raise
+        if self.resize_timer is not None:
+            # Already scheduled, it will apply the latest size.
+            return
+        wait = self.last_resize_time + RESIZE_MITIGATION_TIME_S - time.time()
+        if wait <= 0:
+            self.set_size_internal()
+        else:
+            self.resize_timer = asyncio.get_running_loop().call_later(wait, self.set_size_internal)
 
     # Platoform-specific shell process management
 
-    async def run_linux(self):
-        [pid, fd] = pty.fork()
+    async def run_replay(self):
+        # No process: the output comes from a recording, and the size
+        # of the screen is the recorded one.
+        self.li = replay["li"]
+        self.co = replay["co"]
+        self.rd = ReplayReader(replay, replay_speed, replay_repeat)
+        self.wr = DiscardWriter()
+        self.err = None
+        self.kill = self.rd.close
 
-        if pid == 0:
-            os.execv("/bin/bash", ["bash"])
-            print("Process ", self.name, ": exec(bash) failed")
-            sys.exit(1)
+    async def run_linux(self):
+        p = shell_profiles[self.profile]
+        spec = { "argv": p["argv"], "env": p["env"], "cwd": p["cwd"], "li": initial_nlines, "co": initial_ncolumns }
+        pid, fd, reaped = await SpawnHelper.start_shell(spec)
 
         self.fd = fd
 
@@ -563,30 +2472,33 @@ class Shell:
         #os.write(fd, bytes("\n", "UTF-8"))
         loop = asyncio.get_running_loop()
 
-        wr = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(fd, 'wb'))
+        # Each transport closes its own descriptor.
+        wr = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(os.dup(fd), 'wb'))
         writer_transport, writer_protocol = wr
         writer = asyncio.StreamWriter(writer_transport, writer_protocol, None, loop)
 
         reader = asyncio.StreamReader()
         protocol = asyncio.StreamReaderProtocol(reader)
-        await loop.connect_read_pipe(lambda: protocol, os.fdopen(fd, 'rb'))
+        reader_transport, _ = await loop.connect_read_pipe(lambda: protocol, os.fdopen(fd, 'rb'))
 
         async def end_shell():
+            # Not if it has been reaped already: the PID may belong
+            # to another process now.
+            if not reaped.done():
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
             try:
                 writer.close()
-                await writer.wait_close()
-                os.kill(pid, signal.SIGKILL)
-            except (asyncio.CancelledError, GeneratorExit):
-                raise
-            except:
-                pass
-            try:
-                os.close(fd)
+                await writer.wait_closed()
             except (asyncio.CancelledError, GeneratorExit):
                 raise
             except:
                 pass
+            reader_transport.close()
 
+        self.reaped = reaped
         self.pid = pid
         self.proc = None
         self.fd = fd
@@ -974,12 +2886,42 @@ class Shell:
         self.err = reader_err
         self.kill = end_shell
         
-    async def create(name):
-        shell = Shell(name)
-        await shell.run()
+    async def create(name, profile = DEFAULT_SHELL_PROFILE):
+        shell = ShellPool.take(name) if profile == DEFAULT_SHELL_PROFILE else None
+        if shell is None:
+            shell = Shell(name, profile)
+            await shell.run()
+            Metrics.count("xwterm_shells_started_total")
         return shell
 
+    def exited(self):
+        # True if the shell has ended. The end of the output isn't enough:
+        # it comes after the data still buffered (the prompt, for a shell of
+        # the pool), so the process itself is checked first: reaped, zombie
+        # or gone.
+        if self.reaped is not None and self.reaped.done():
+            return True
+        if self.pid is not None:
+            try:
+                with open('/proc/' + str(self.pid) + '/stat') as f:
+                    if f.read().rsplit(')', 1)[1].split()[0] in [ 'Z', 'X' ]:
+                        return True
+            except FileNotFoundError:
+                try:
+                    os.kill(self.pid, 0)
+                except ProcessLookupError:
+                    return True
+                except OSError:
+                    pass
+            except (OSError, IndexError):
+                pass
+        rd = self.rd
+        return isinstance(rd, asyncio.StreamReader) and (rd.at_eof() or rd.exception() is not None)
+
     async def terminate(self):
+        if self.resize_timer is not None:
+            self.resize_timer.cancel()
+            self.resize_timer = None
         try:
             await self.kill()
         except (asyncio.CancelledError, GeneratorExit):
@@ -987,23 +2929,120 @@ class Shell:
         except:
             pass
 
+    async def wait(self):
+        # Exit status and resource usage of the process, None if unknown.
+        if self.reaped is None:
+            return None, None
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.reaped), REAP_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            return None, None
+
+
+class ShellPool:
+
+    # Shells started in advance, at the initial size. A session takes one,
+    # if there is one, instead of waiting for the start of a new shell
+    # (fork, exec, and the startup files of bash). What the shell writes
+    # in the meantime (the prompt) waits in its stream, and is read by the
+    # session. The pool is refilled in the background, one shell at a
+    # time, when it falls below the low watermark. Replayed sessions don't
+    # use it, their replay would start before the session.
+
+    shells = collections.deque()
+    filler = None
+
+    def refill():
+        if ShellPool.filler is None and replay is None and len(ShellPool.shells) < shell_pool_low:
+            ShellPool.filler = asyncio.create_task(ShellPool.fill())
+
+    async def fill():
+        try:
+            while len(ShellPool.shells) < shell_pool_high:
+                shell = Shell("[pool]")
+                await shell.run()
+                ShellPool.shells.append(shell)
+                Metrics.count("xwterm_shells_started_total")
+        except (asyncio.CancelledError, GeneratorExit):
+            raise
+        except Exception as e:
+            print("Shell pool: cannot start a shell: ", e)
+        finally:
+            ShellPool.filler = None
+
+    def take(name):
+        shell = None
+        while ShellPool.shells:
+            s = ShellPool.shells.popleft()
+            if not s.exited():
+                shell = s
+                break
+            # Ended while waiting: discard it.
+            asyncio.create_task(s.terminate())
+            Metrics.count("xwterm_shells_exited_total")
+        if shell:
+            shell.name = name
+            Metrics.count("xwterm_shell_pool_hits_total")
+        elif shell_pool_high > 0 and replay is None:
+            Metrics.count("xwterm_shell_pool_misses_total")
+        ShellPool.refill()
+        return shell
+
 
 class Session:
 
+    # Sessions are cheap until they start their shell: the queues are
+    # created by "activate". An active session has just the tasks that
+    # move data to and from its shell; its job has no supervisor task
+    # (see AsyncJob), and resizes, output flushes and idle expiry are
+    # timers of the event loop.
+    # When the shell ends, the session records why ("reason": "exit",
+    # "kill", "idle" or "disconnect"), the exit status and the resources
+    # used by the shell, and a summary goes to "closed", the list of the
+    # last closed sessions.
+
+    __slots__ = ('sid', 'start_time', 'shell', 'rxq', 'txq', 'stats', 'output', 'history',
+                 'overflow', 'screen', 'visited', 'persistent', 'idle_timeout', 'expiry',
+                 'job', 'attachments', 'on_exit', 'shell_started', 'profile',
+                 'clients', 'dropped', 'reason', 'status', 'usage')
 
     def  __init__(self, sid, persistent=False):
         self.sid = sid
         self.start_time = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
         self.shell = None
-        self.rxq = asyncio.Queue()
-        self.txq = asyncio.Queue()
+        self.rxq = None
+        self.txq = None
+        self.stats = { "ws_frames": 0, "tx_stalls": 0, "resyncs": 0, "reads": 0, "read_size": read_size, "read_size_peak": read_size,
+                       "z_in": 0, "z_out": 0 }
+        self.output = OutputBatcher(self.deliver, self.stats)
+        self.history = History(history_size, history_lines)
+        self.overflow = None
+        self.screen = None
+        if enable_screen_model:
+            self.enable_screen()
+        self.set_overflow_policy(overflow_policy)
         self.visited = time.time()
         self.persistent = persistent
-        self.task = None
+        self.idle_timeout = session_idle_timeout
+        # Deadline of the entry of the session in the expiry heap
+        self.expiry = None
         self.job = None
-        self.pending_data = b""
+        # Additional clients, which receive a copy of the output
+        self.attachments = []
+        # Functions called with the session as argument when it ends
+        self.on_exit = []
         self.shell_started = False
+        self.profile = DEFAULT_SHELL_PROFILE
+        # WebSocket clients connected to the session (see "connect")
+        self.clients = 0
+        # True if the session has lost its WebSocket clients
+        self.dropped = False
+        self.reason = None
+        self.status = None
+        self.usage = None
         Session.sessions[self.sid] = self
+        Metrics.count("xwterm_sessions_created_total")
+        Session.schedule_expiry(self, self.visited + self.idle_timeout)
 
     async def activate(self):
 
@@ -1011,25 +3050,31 @@ class Session:
             return
         
         self.shell_started = True
+        self.rxq = ByteQueue(rxq_limit)
+        self.txq = ByteQueue(txq_limit)
 
-        self.shell = await Shell.create(self.sid)
+        self.shell = await Shell.create(self.sid, self.profile)
 
         print("Session ", self.sid, ": starting shell")
 
         tasks = list()
 
-        if self.shell.resize_polling_task:
-            tasks.append(self.shell.resize_polling_task)
-        tasks.append(asyncio.create_task(self.read_from_process(self.shell.rd)))
-        tasks.append(asyncio.create_task(self.write_to_process(self.shell.wr)))
+        tasks.append(asyncio.create_task(Debug.timed("read_from_process", self.read_from_process(self.shell.rd))))
+        tasks.append(asyncio.create_task(Debug.timed("write_to_process", self.write_to_process(self.shell.wr))))
         if self.shell.err:
-            tasks.append(asyncio.create_task(self.read_from_process(self.shell.err)))
+            tasks.append(asyncio.create_task(Debug.timed("read_from_process", self.read_from_process(self.shell.err))))
 
         async def on_close(task):
+            self.output.close()
+            for f in list(self.on_exit):
+                f(self)
             await self.shell.terminate()
+            Metrics.count("xwterm_shells_exited_total")
             if self.sid in Session.sessions:
                 del Session.sessions[self.sid]
-            print("Session ", self.sid, ": exiting")
+                Metrics.count("xwterm_sessions_closed_total")
+            self.ended(*await self.shell.wait())
+            print("Session ", self.sid, ": exiting (", self.reason, ", status ", Reaper.exit_code(self.status), ")")
 
 
         self.job = AsyncJob(*tasks, name = self.sid,
@@ -1047,42 +3092,217 @@ class Session:
         except:
             pass
 
-    def get_pending_data(self, clear):
-        t = self.pending_data
-        if clear:
-            self.pending_data = b""
-        return t
+    def connect(self):
+        # While WebSocket clients are connected, the session doesn't
+        # expire. When the last one goes, it becomes an ordinary session,
+        # subject to the idle timeout, so a client can connect again.
+        self.clients += 1
+        self.persistent = True
+        self.dropped = False
 
-    def add_pending_data(self, data):
-        self.pending_data = self.pending_data + data
+    def disconnect(self):
+        self.clients = max(0, self.clients - 1)
+        self.visited = time.time()
+        if self.clients == 0:
+            self.persistent = False
+            self.dropped = True
+            Session.schedule_expiry(self, self.visited + self.idle_timeout)
+
+    def ended(self, status, usage):
+        if self.reason is None:
+            self.reason = "exit"
+        self.status = status
+        self.usage = usage
+        Metrics.count("xwterm_session_ends_total", 'reason="' + self.reason + '"')
+        if usage:
+            Metrics.count("xwterm_shell_cpu_seconds_total", n = usage["cpu"])
+        so = self.describe()
+        so["et"] = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        so["rs"] = self.reason
+        so["ex"] = Reaper.exit_code(status)
+        so["ru"] = usage
+        Session.closed.append(so)
+
+    def describe(self):
+        # Entry of the session list
+        sz = "-"
+        pid = None
+        if self.shell:
+            sz = str(self.shell.co) + "x" + str(self.shell.li)
+            pid = self.shell.pid
+        return { "sid": self.sid,
+                 "ty": self.persistent,
+                 "sz": sz,
+                 "dt": self.start_time,
+                 "tm": int(time.time() - self.visited),
+                 "it": self.idle_timeout,
+                 "sh": self.profile,
+                 "pid": pid,
+                 "tq": self.txq.size if self.txq else 0,
+                 "rq": self.rxq.size if self.rxq else 0,
+                 "hs": self.history.end - self.history.start,
+                 "zr": round(self.stats["z_out"] / self.stats["z_in"], 3) if self.stats["z_in"] else None,
+                 "st": self.stats }
+
+    def set_overflow_policy(self, policy):
+        if policy not in OVERFLOW_POLICIES or policy == self.overflow:
+            return
+        self.overflow = policy
+        if policy == 'skip':
+            self.enable_screen()
+
+    def set_profile(self, name):
+        # The command of the shell, until the shell starts.
+        if not self.shell_started and name in shell_profiles:
+            self.profile = name
+
+    def set_idle_timeout(self, text):
+        try:
+            t = min(max(1, int(text)), SESSION_IDLE_TIMEOUT_MAX)
+        except (ValueError, TypeError):
+            return
+        self.idle_timeout = t
+        # A longer timeout is seen when the current entry comes due,
+        # a shorter one needs an earlier entry.
+        Session.schedule_expiry(self, self.visited + t)
+
+    def enable_screen(self):
+        if not self.screen:
+            if self.shell:
+                self.screen = Screen(self.shell.li, self.shell.co)
+            else:
+                self.screen = Screen(initial_nlines, initial_ncolumns)
+            # Rebuild what can be rebuilt of the screen from the history
+            text = self.history.tail()
+            if text:
+                self.screen.feed(text)
+
+    def resync(self):
+        # Replaces the queued output with a copy of the current screen.
+        self.txq.clear()
+        self.txq.put_nowait(self.screen.snapshot())
+        self.stats["resyncs"] += 1
+        Metrics.count("xwterm_output_resyncs_total")
+
+    def initial_output(self, nlines, nbytes, repaint):
+        # The last lines of the history and/or a copy of the current screen,
+        # for a client that (re)connects to the session.
+        out = []
+        if (nlines > 0 or nbytes > 0) and self.history.size > 0:
+            text = self.history.tail(nlines, nbytes)
+            if text:
+                out.append(text)
+        if repaint and self.screen:
+            out.append(self.screen.snapshot())
+            self.stats["resyncs"] += 1
+        return out
+
+    def reattach(self, nlines, nbytes, repaint):
+        # The client of the session (re)connects: the output it hasn't
+        # received yet is replaced by the initial output. The output
+        # not delivered yet is already in the history and in the screen.
+        if not ((nlines > 0 or nbytes > 0) and self.history.size > 0) and not (repaint and self.screen):
+            return
+        self.output.discard()
+        self.txq.clear()
+        for text in self.initial_output(nlines, nbytes, repaint):
+            self.txq.put_nowait(text)
+
+    def attach(self, readonly = False, nlines = 0, nbytes = 0):
+        # Adds a client to the session. Attached clients need the model
+        # of the screen, so the one that falls behind can skip to
+        # the current screen (see "deliver"). Their first output is
+        # the current screen, optionally preceded by the history.
+        self.enable_screen()
+        a = Attachment(self, readonly)
+        self.output.flush()
+        for text in self.initial_output(nlines, nbytes, True):
+            a.queue.put_nowait(OutputChunk(text))
+        self.attachments.append(a)
+        return a
+
+    def detach(self, a):
+        if a in self.attachments:
+            self.attachments.remove(a)
+
+    def deliver(self, text):
+        if self.attachments:
+            # One chunk (and one encoded frame) for all the attached
+            # clients. The shell isn't blocked by a slow client anymore,
+            # or all the others would be blocked too: every client that
+            # falls behind skips to the current screen.
+            chunk = OutputChunk(text)
+            for a in self.attachments:
+                a.push(chunk)
+        if (self.overflow == 'skip' or self.attachments) and self.txq.size + len(text) > overflow_threshold:
+            # The client is too slow: skip to the current screen.
+            self.resync()
+        else:
+            self.txq.put_nowait(text)
 
     async def read_from_process(self, reader):
         #print("self=", self, " reader=", reader)
+        decoder = new_decoder()
+        size = read_size
         try:
             while True:
-                data = await reader.read(1000)
+                if self.overflow == 'block' and not self.attachments and self.txq.blocked:
+                    # Backpressure: stop reading until the client drains the queue.
+                    self.stats["tx_stalls"] += 1
+                    Metrics.count("xwterm_output_stalls_total")
+                    await self.txq.wait_space()
+                data = await reader.read(size)
                 if not data:
                     break
+                self.stats["reads"] += 1
+                Metrics.read_size.observe(len(data))
+                Metrics.transfer("pty", "out", len(data))
+                if len(data) >= size:
+                    if size < read_size_max:
+                        size = min(size * 2, read_size_max)
+                        self.stats["read_size"] = size
+                        self.stats["read_size_peak"] = max(size, self.stats["read_size_peak"])
+                elif len(data) < size // 4 and size > read_size:
+                    size = max(size // 2, read_size)
+                    self.stats["read_size"] = size
                 try:
-                    data = self.get_pending_data(True) + data
-                    #d = data.decode('utf-8')
-                    d, remt = find_valid_encoded(data)
-                    self.add_pending_data(remt)
+                    d = decoder.decode(data)
                     if len(d) > 0:
-                        await self.txq.put(d)
+                        self.history.write(d)
+                        if self.screen:
+                            self.screen.feed(d)
+                        self.output.push(d)
                 except (asyncio.CancelledError, GeneratorExit):
                     raise
+                except UnicodeDecodeError as e:
+                    # "strict" policy: drop the chunk, and whatever
+                    # partial sequence the decoder was holding.
+                    print("Session ", self.sid, ": invalid output discarded: ", e)
+                    decoder.reset()
                 except Exception as e:
                     print(e)
         except (asyncio.CancelledError, GeneratorExit):
             raise
         except Exception as e:
             print(e)
+        self.output.flush()
         #print("Session ", self.sid, ": stdout/stderr closing...")
 
     async def write_to_process(self, writer):
         while True:
             message = await self.rxq.get()
+            if isinstance(message, bytes):
+                # Binary WebSocket protocol: already encoded
+                try:
+                    writer.write(message)
+                    Metrics.transfer("pty", "in", len(message))
+                    await writer.drain()
+                except (asyncio.CancelledError, GeneratorExit):
+                    raise
+                except Exception as e:
+                    print(e)
+                    break
+                continue
             try:
                 t = ''
                 try:
@@ -1096,7 +3316,9 @@ class Session:
                 except:
                     t = message
                 if t != '':
-                    writer.write(t.encode(default_encoding))
+                    b = t.encode(default_encoding)
+                    writer.write(b)
+                    Metrics.transfer("pty", "in", len(b))
                     await writer.drain()
             except (asyncio.CancelledError, GeneratorExit):
                 raise
@@ -1105,6 +3327,48 @@ class Session:
                 break
         #print("Session ", self.sid, ": stdin closing...")
 
+    async def get_output(self, timeout = 0):
+        # Returns all the pending output. If there is none and a timeout
+        # is given, waits for some, then lets the output that follows it
+        # accumulate for a short while, so a burst is sent as a whole.
+        chunks = []
+        if self.txq.empty() and timeout > 0:
+            getter = asyncio.ensure_future(self.txq.get())
+            try:
+                done, pending = await asyncio.wait([getter], timeout=timeout)
+            finally:
+                if not getter.done():
+                    getter.cancel()
+            if not done:
+                return ""
+            chunks.append(getter.result())
+            if long_poll_coalesce_ms > 0:
+                await asyncio.sleep(long_poll_coalesce_ms / 1000)
+        try:
+            while True:
+                chunks.append(self.txq.get_nowait())
+        except asyncio.QueueEmpty:
+            pass
+        return "".join(chunks)
+
+    async def next_output(self):
+        # Waits for the next batch of output. If more batches have
+        # accumulated in the meantime (slow client), merges them too,
+        # up to the flush size.
+        text = await self.txq.get()
+        if not self.txq.empty():
+            chunks = [ text ]
+            size = len(text)
+            try:
+                while size < output_flush_bytes:
+                    t = self.txq.get_nowait()
+                    chunks.append(t)
+                    size += len(t)
+            except asyncio.QueueEmpty:
+                pass
+            text = "".join(chunks)
+        return text
+
     def set_size_from_text(self,text):
         try:
             sz = text.split("x")
@@ -1112,6 +3376,8 @@ class Session:
                 li = int(sz[0])
                 co = int(sz[1])
                 self.shell.set_size(li, co)
+                if self.screen:
+                    self.screen.resize(li, co)
         except Exception as e:
             print(e)
 
@@ -1166,37 +3432,95 @@ class Session:
             session = await Session.new_session()
 
         session.visited = time.time()
+        session.dropped = False
+
+        if OVERFLOW_PARAM in params:
+            session.set_overflow_policy(params[OVERFLOW_PARAM])
+        if IDLE_TIMEOUT_PARAM in params:
+            session.set_idle_timeout(params[IDLE_TIMEOUT_PARAM])
+        if SHELL_PARAM in params:
+            session.set_profile(params[SHELL_PARAM])
 
         return session
 
     # Global session collection
     sessions = {}
     manager = None
+    closed = collections.deque()
 
-    async def kill_session(sid):
+    async def kill_session(sid, reason = "kill"):
         if sid in Session.sessions:
             session = Session.sessions[sid]
+            if session.reason is None:
+                session.reason = reason
             await session.terminate()
-            del Session.sessions[sid]
+            if sid in Session.sessions:
+                del Session.sessions[sid]
+                Metrics.count("xwterm_sessions_closed_total")
     
-    async def cleaner():
-        #print("Session cleaner started")
-        while True:
-            await asyncio.sleep(SESSION_IDLE_CHECK_PERIOD)
-            #print("Session cleaner loop")
-            s = Session.sessions.copy()
-            for sid in s:
-                session = s[sid]
-                if ((not session.persistent) and (time.time() - session.visited > SESSION_IDLE_TIMEOUT)):
-                    #print("Session ", sid, ": timeout -- closing...")
-                    await Session.kill_session(sid)
-                    print("Session ", sid, ": timeout -- closed")
+    # Idle expiry. Every session has an entry in a heap ordered by deadline,
+    # and a single timer is armed for the earliest one. "visited" is not
+    # tracked: when an entry comes due, the real deadline of the session is
+    # computed again, and the entry is pushed back if the session has been
+    # used in the meantime. Touching a session costs nothing, and every
+    # session costs O(log N) once per idle timeout at most.
+    # Entries of the sessions that are gone are dropped when they come due.
+    expiry_heap = []
+    expiry_seq = itertools.count()
+    expiry_timer = None
+    expiry_timer_at = 0
+
+    def push_expiry(session, t):
+        if session.expiry is not None and session.expiry <= t:
+            return False
+        session.expiry = t
+        heapq.heappush(Session.expiry_heap, (t, next(Session.expiry_seq), session))
+        return True
+
+    def schedule_expiry(session, t):
+        if Session.push_expiry(session, t):
+            if Session.expiry_timer is None or t < Session.expiry_timer_at:
+                Session.arm_expiry_timer()
+
+    def arm_expiry_timer():
+        if Session.expiry_timer is not None:
+            Session.expiry_timer.cancel()
+            Session.expiry_timer = None
+        if Session.expiry_heap:
+            t = Session.expiry_heap[0][0]
+            Session.expiry_timer_at = t
+            Session.expiry_timer = asyncio.get_running_loop().call_later(max(0, t - time.time()), Session.expire_sessions)
+
+    def expire_sessions():
+        Session.expiry_timer = None
+        now = time.time()
+        heap = Session.expiry_heap
+        while heap and heap[0][0] <= now:
+            t, seq, session = heapq.heappop(heap)
+            if session.expiry != t or Session.sessions.get(session.sid) is not session:
+                continue
+            session.expiry = None
+            if session.persistent:
+                # Check again later, it may become an ordinary session.
+                Session.push_expiry(session, now + session.idle_timeout)
+            elif session.visited + session.idle_timeout > now:
+                Session.push_expiry(session, session.visited + session.idle_timeout)
+            else:
+                asyncio.create_task(Session.expire(session.sid, "disconnect" if session.dropped else "idle"))
+        Session.arm_expiry_timer()
+
+    async def expire(sid, reason):
+        await Session.kill_session(sid, reason)
+        print("Session ", sid, ": timeout -- closed")
 
 
     def setup():
         Session.sessions = {}
-        cleaner = asyncio.create_task(Session.cleaner())
-        Session.manager = AsyncJob(cleaner, name = "[Manager]",
+        Session.closed = collections.deque(maxlen = closed_sessions)
+        Debug.start()
+        ShellPool.refill()
+        monitor = asyncio.create_task(Metrics.monitor())
+        Session.manager = AsyncJob(monitor, name = "[Manager]",
                                on_task_termination = None,
                                terminate_on_first_competed = False)
         return Session.manager.job
@@ -1225,24 +3549,171 @@ class Session:
         return wrapper
 
 
-async def get_files(request, session):
-    file_path = request.match_info.get('file_path', DEFAULT_FILE)
-    content = ""
-    fp = os.path.join(doc_dir, file_path)
-    if not os.path.exists(fp):
-        fp = os.path.join(os.path.dirname(doc_dir), "src", file_path)
-    if not os.path.exists(fp):
-        fp = os.path.join(os.path.dirname(doc_dir), "dist", file_path)
-    if not os.path.exists(fp):
-        fp = os.path.join(os.path.dirname(doc_dir), "wip", file_path)
-    try:
-#        print("session " + session.sid + ": opening " + file_path + " path=" + fp);
+class StaticCache:
+
+    # Cache of the files served by HTTP. The directories are probed only
+    # the first time a path is requested, then the result is remembered.
+    # Contents are kept up to a total size, and are validated by
+    # modification time and size at every request; least recently used
+    # files are discarded first. Files are read and compressed
+    # by a worker thread, so the event loop is never blocked by the disk.
+    # Large files are not loaded at all: they are streamed from the disk,
+    # like the requests for a range of a file.
+    # ETags are made of modification time and size, as those of
+    # aiohttp.web.FileResponse, so that a tag from a whole response is
+    # valid in If-Range for a partial one. The compressed copy has its
+    # own tag.
+
+    MAX_PATHS = 4096
+
+    COMPRESSIBLE = re.compile(r'^(text/.*|application/(javascript|json|xml|x-javascript)|image/svg\+xml)$')
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.paths = {}
+        self.entries = collections.OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, file_path):
+        fp = self.paths.get(file_path)
+        if fp is None:
+            for d in [ doc_dir,
+                       os.path.join(os.path.dirname(doc_dir), "src"),
+                       os.path.join(os.path.dirname(doc_dir), "dist"),
+                       os.path.join(os.path.dirname(doc_dir), "wip") ]:
+                fp = os.path.join(d, file_path)
+                if os.path.isfile(fp):
+                    break
+            else:
+                # Not found: not remembered, it may appear later.
+                return None
+            if len(self.paths) >= StaticCache.MAX_PATHS:
+                self.paths.clear()
+            self.paths[file_path] = fp
+        return fp
+
+    def etag(st):
+        return '"' + format(st.st_mtime_ns, 'x') + '-' + format(st.st_size, 'x') + '"'
+
+    def load(fp, st, compress):
+        # Runs in a worker thread
         with open(fp, 'rb') as file:
-            content = file.read()
+            body = file.read()
         mime_type, _ = mimetypes.guess_type(fp)
         if mime_type is None:
             mime_type = 'application/octet-stream'
-        response = aiohttp.web.Response(body=content, content_type=mime_type)
+        gz = None
+        if compress and len(body) >= compression_threshold and StaticCache.COMPRESSIBLE.match(mime_type):
+            c = zlib.compressobj(9, zlib.DEFLATED, 31)
+            gz = c.compress(body) + c.flush()
+            if len(gz) >= len(body):
+                gz = None
+        return { "path": fp,
+                 "mtime": st.st_mtime_ns,
+                 "size": st.st_size,
+                 "body": body,
+                 "gzip": gz,
+                 "mime": mime_type,
+                 "etag": StaticCache.etag(st),
+                 "modified": email.utils.formatdate(st.st_mtime, usegmt=True),
+                 "mtime_s": int(st.st_mtime) }
+
+    async def get(self, file_path):
+        fp = self.resolve(file_path)
+        if fp is None:
+            return None
+        try:
+            st = os.stat(fp)
+        except OSError:
+            self.paths.pop(file_path, None)
+            return None
+        if st.st_size > stream_threshold or st.st_size > self.limit:
+            self.discard(fp)
+            return { "path": fp, "body": None }
+        e = self.entries.get(fp)
+        if e is not None and e["mtime"] == st.st_mtime_ns and e["size"] == st.st_size:
+            self.entries.move_to_end(fp)
+            self.hits += 1
+            return e
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        e = await loop.run_in_executor(None, StaticCache.load, fp, st, enable_compression)
+        self.discard(fp)
+        n = len(e["body"]) + len(e["gzip"] or b'')
+        if n <= self.limit:
+            self.entries[fp] = e
+            self.used += n
+            while self.used > self.limit:
+                self.discard(next(iter(self.entries)))
+        return e
+
+    def discard(self, fp):
+        e = self.entries.pop(fp, None)
+        if e is not None:
+            self.used -= len(e["body"]) + len(e["gzip"] or b'')
+
+    def not_modified(request, e, etag):
+        inm = request.headers.get('If-None-Match')
+        if inm is not None:
+            # Weak comparison, as required for GET
+            tags = [ t.strip() for t in inm.split(',') ]
+            return '*' in tags or etag in [ t[2:] if t.startswith('W/') else t for t in tags ]
+        ims = request.headers.get('If-Modified-Since')
+        if ims is not None:
+            try:
+                return e["mtime_s"] <= email.utils.parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                pass
+        return False
+
+    def response(request, e):
+        if e["body"] is None or 'Range' in request.headers:
+            return stream_file(e["path"])
+        headers = { 'Last-Modified': e["modified"],
+                    # The browser can keep the file, but must ask whether it has changed.
+                    'Cache-Control': 'no-cache' }
+        body = e["body"]
+        etag = e["etag"]
+        gzip = False
+        if e["gzip"] is not None:
+            headers['Vary'] = 'Accept-Encoding'
+            accepted = [ x.split(';')[0].strip() for x in request.headers.get('Accept-Encoding', '').lower().split(',') ]
+            gzip = 'gzip' in accepted
+        if gzip:
+            body = e["gzip"]
+            etag = etag[:-1] + '-gz"'
+        headers['ETag'] = etag
+        if StaticCache.not_modified(request, e, etag):
+            return aiohttp.web.Response(status = 304, headers = headers)
+        if gzip:
+            headers['Content-Encoding'] = 'gzip'
+        return aiohttp.web.Response(body = body, content_type = e["mime"], headers = headers)
+
+
+def stream_file(fp, download = False):
+    # aiohttp takes care of Range and conditional requests, and
+    # uses "sendfile" where possible. The ETag is the same as that of
+    # StaticCache (recent versions of aiohttp set it by themselves).
+    headers = { 'Cache-Control': 'no-cache' }
+    try:
+        headers['ETag'] = StaticCache.etag(os.stat(fp))
+    except OSError:
+        pass
+    if download:
+        headers['Content-Disposition'] = 'attachment; filename="' + os.path.basename(fp).replace('"', '') + '"'
+    return aiohttp.web.FileResponse(fp, headers = headers)
+
+async def get_files(request, session):
+    file_path = request.match_info.get('file_path', DEFAULT_FILE)
+    try:
+#        print("session " + session.sid + ": opening " + file_path);
+        e = await static_cache.get(file_path)
+        if e is None:
+            response = aiohttp.web.Response(text='Not found', status = 404)
+        else:
+            response = StaticCache.response(request, e)
     except (asyncio.CancelledError, GeneratorExit):
         raise
     except Exception as e:
@@ -1250,6 +3721,33 @@ async def get_files(request, session):
         response = aiohttp.web.Response(text='Not found', status = 404)
     return response
 
+def int_param(params, name, default = 0):
+    try:
+        return int(params[name])
+    except (KeyError, ValueError):
+        return default
+
+def compressed_response(request, session, body):
+    # JSON response, compressed if it's large enough and the client accepts it.
+    # "deflate" in HTTP is the zlib format.
+    headers = {}
+    if enable_compression and len(body) >= compression_threshold:
+        accepted = [ e.split(';')[0].strip() for e in request.headers.get('Accept-Encoding', '').lower().split(',') ]
+        wbits = 0
+        if 'gzip' in accepted:
+            encoding, wbits = 'gzip', 31
+        elif 'deflate' in accepted:
+            encoding, wbits = 'deflate', 15
+        if wbits:
+            c = zlib.compressobj(compression_level, zlib.DEFLATED, wbits)
+            z = c.compress(body) + c.flush()
+            session.stats["z_in"] += len(body)
+            session.stats["z_out"] += len(z)
+            body = z
+            headers['Content-Encoding'] = encoding
+            headers['Vary'] = 'Accept-Encoding'
+    return aiohttp.web.Response(body=body, content_type='application/json', headers=headers)
+
 @Session.decorator
 async def do_GET(request, session):
     #print("GET: Session=", session.sid);
@@ -1262,35 +3760,86 @@ async def do_GET(request, session):
         if (SET_SIZE_PARAM in params): 
             session.set_size_from_text(params[SET_SIZE_PARAM])
 
-        text = ""
-        try:
-            while True:
-                t = session.txq.get_nowait()
-                text += t
-        except (asyncio.CancelledError, GeneratorExit):
-            raise
-        except:
-            pass
-        response = aiohttp.web.Response(body=json.dumps({ 'text': text }), content_type='application/json')
+        if (REPAINT_PARAM in params) or (HISTORY_LINES_PARAM in params) or (HISTORY_BYTES_PARAM in params):
+            session.reattach(int_param(params, HISTORY_LINES_PARAM),
+                             int_param(params, HISTORY_BYTES_PARAM),
+                             REPAINT_PARAM in params)
+
+        wait = 0
+        if LONG_POLL_PARAM in params:
+            try:
+                wait = min(int(params[LONG_POLL_PARAM]), long_poll_max_ms) / 1000
+            except ValueError:
+                wait = long_poll_max_ms / 1000
+
+        text = await session.get_output(wait)
+        if wait > 0:
+            session.visited = time.time()
+        response = compressed_response(request, session, json.dumps({ 'text': text }).encode('utf-8'))
+        Metrics.transfer("http", "out", len(response.body))
         #print("GET: Session=", session_id, " Data=", sessions[session_id]);
 
     elif LIST_SESSIONS_PARAM in params:
 
-        s = Session.sessions.copy()
-        sl = []
-        for sid in s:
-            session = s[sid]
-            sz = "-"
-            if session.shell:
-                sz = str(session.shell.co) + "x" + str(session.shell.li)
-            so = { "sid": sid,
-                   "ty": session.persistent,
-                   "sz": sz,
-                   "dt": session.start_time,
-                   "tm": int(time.time() - session.visited) }
-            sl.append(so)
+        if params[LIST_SESSIONS_PARAM] == "closed":
+            # The last closed sessions, with exit status and resource usage.
+            sl = list(Session.closed)
+        else:
+            sl = []
+            for session in list(Session.sessions.values()):
+                so = session.describe()
+                so["ru"] = Reaper.live_usage(so["pid"]) if so["pid"] else None
+                sl.append(so)
         response = aiohttp.web.Response(body=json.dumps(sl), content_type='application/json')
 
+    elif HISTORY_PARAM in params:
+
+        s = Session.sessions.get(params[HISTORY_PARAM])
+        if s is None:
+            response = aiohttp.web.Response(body=json.dumps({}), content_type='application/json', status = 404)
+        else:
+            h = s.history
+            if (HISTORY_FROM_PARAM in params) or (HISTORY_TO_PARAM in params):
+                first = int_param(params, HISTORY_FROM_PARAM, 0)
+                last = int_param(params, HISTORY_TO_PARAM, h.end)
+            else:
+                first = h.tail_start(int_param(params, HISTORY_LINES_PARAM), int_param(params, HISTORY_BYTES_PARAM))
+                last = h.end
+            text, first, last = h.read(first, last)
+            # "start" and "end" are the limits of the available history,
+            # "from" and "to" those of the returned text.
+            ho = { "sid": s.sid,
+                   "start": h.first(),
+                   "end": h.end,
+                   "from": first,
+                   "to": last,
+                   "text": text }
+            response = aiohttp.web.Response(body=json.dumps(ho), content_type='application/json')
+
+    elif DOWNLOAD_PARAM in params:
+
+        fp = None
+        if upload_dir is not None:
+            root = os.path.realpath(upload_dir)
+            fp = os.path.realpath(os.path.join(root, params[DOWNLOAD_PARAM]))
+            # Nothing outside the upload directory
+            if os.path.commonpath([ root, fp ]) != root or not os.path.isfile(fp):
+                fp = None
+        if fp is None:
+            response = aiohttp.web.Response(text='Not found', status = 404)
+        else:
+            response = stream_file(fp, download = True)
+
+    elif DEBUG_PARAM in params:
+
+        if params[DEBUG_PARAM]:
+            Debug.set_flags(params[DEBUG_PARAM])
+        response = aiohttp.web.Response(body=json.dumps(Debug.state()), content_type='application/json')
+
+    elif PROFILE_PARAM in params:
+
+        response = aiohttp.web.Response(text=Debug.profile(params[PROFILE_PARAM]))
+
     elif KILL_SESSIONS_PARAM in params:
         sid = params[KILL_SESSIONS_PARAM]
         await Session.kill_session(sid)
@@ -1314,6 +3863,7 @@ async def do_POST(request, session):
     try:
         await session.activate()
         data = await request.text()
+        Metrics.transfer("http", "in", len(data))
         await session.rxq.put(data)
         response = aiohttp.web.Response(text='', status = 200)
     except (asyncio.CancelledError, GeneratorExit):
@@ -1323,6 +3873,296 @@ async def do_POST(request, session):
         response = aiohttp.web.Response(text='Bad request', status = 400)
     return response
 
+class Upload:
+
+    # A file being uploaded. Data are written into "<name>.part" by a pool
+    # of threads, in large blocks, at the offsets given by "Content-Range",
+    # so a file can be sent in several requests, also in parallel, and an
+    # interrupted transfer can be resumed. The ranges already written are
+    # recorded, and the checksum (SHA-256) follows the part of the file
+    # that is complete from the beginning. When the whole file is there,
+    # it's renamed to its final name.
+    # The requests of a transfer carry the same "X-Upload-Id" (chosen by
+    # the client), and only they share its state: a request with another
+    # id starts a new upload, in its own partial file. Uploads that
+    # receive nothing for "upload_timeout" seconds are abandoned.
+
+    active = {}
+
+    CONTENT_RANGE = re.compile(r'bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)$')
+
+    def __init__(self, fp, total, uid = None):
+        self.fp = fp
+        self.uid = uid
+        self.key = (fp, uid)
+        if uid is None:
+            self.part = fp + ".part"
+        else:
+            self.part = fp + "." + hashlib.sha1(uid.encode('utf-8', 'replace')).hexdigest()[:16] + ".part"
+        self.total = total
+        self.ranges = []
+        self.digest = hashlib.sha256()
+        self.hashed = 0
+        self.hasher = None
+        self.expected = None
+        self.done = None
+        self.created = None
+        self.writing = 0
+        self.quiet = asyncio.Event()
+        self.quiet.set()
+        self.timer = None
+
+    @staticmethod
+    def new(fp, total, uid):
+        # Whatever an older upload with the same id has left is discarded.
+        u = Upload(fp, total, uid)
+        old = Upload.active.get(u.key)
+        if old is not None:
+            old.cancel_timer()
+        Upload.active[u.key] = u
+        u.touch()
+        return u
+
+    @staticmethod
+    def get(fp, total, uid):
+        u = Upload.active.get((fp, uid))
+        if u is None:
+            return Upload.new(fp, total, uid)
+        if u.total is None:
+            u.total = total
+        u.touch()
+        return u
+
+    # Abandoned uploads
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def touch(self):
+        self.cancel_timer()
+        self.timer = asyncio.get_running_loop().call_later(upload_timeout, self.expire)
+
+    def expire(self):
+        self.timer = None
+        if self.writing or self.done is not None:
+            self.touch()
+            return
+        if Upload.active.get(self.key) is self:
+            del Upload.active[self.key]
+            asyncio.get_running_loop().run_in_executor(upload_executor, Upload.discard, self.part)
+
+    def add_range(self, start, end):
+        r = []
+        for s, e in self.ranges:
+            if e < start or s > end:
+                r.append([s, e])
+            else:
+                start = min(start, s)
+                end = max(end, e)
+        r.append([start, end])
+        r.sort()
+        self.ranges = r
+
+    def received(self):
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    def complete(self):
+        return self.total is not None and self.received() >= self.total
+
+    def status(self):
+        return { "size": self.total, "received": self.ranges }
+
+    # Functions executed by the threads of the pool
+
+    @staticmethod
+    def pwrite(fd, data, offset):
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    @staticmethod
+    def create(path):
+        # A new upload starts from an empty file.
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
+
+    @staticmethod
+    def discard(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def hash_range(self, start, end):
+        with open(self.part, 'rb') as file:
+            file.seek(start)
+            while start < end:
+                data = file.read(min(upload_block_size, end - start))
+                if not data:
+                    break
+                self.digest.update(data)
+                start += len(data)
+        return start
+
+    def commit(self):
+        fd = os.open(self.part, os.O_WRONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(self.part, self.fp)
+
+    # Checksum
+
+    async def follow(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.hashed < self.received():
+                self.hashed = await loop.run_in_executor(upload_executor, self.hash_range, self.hashed, self.received())
+        finally:
+            self.hasher = None
+
+    def kick(self):
+        if self.hasher is None and self.hashed < self.received():
+            self.hasher = asyncio.ensure_future(self.follow())
+
+    # Request handling
+
+    async def write(self, request, start, end):
+        # Reads the body of the request, a block at a time. A block is
+        # written while the next one is received.
+        loop = asyncio.get_running_loop()
+        self.writing += 1
+        self.quiet.clear()
+        try:
+            if self.created is None:
+                self.created = loop.run_in_executor(upload_executor, Upload.create, self.part)
+            await self.created
+            return await self.write_body(request, start, end)
+        finally:
+            self.writing -= 1
+            if self.writing == 0:
+                self.quiet.set()
+            if self.done is None:
+                self.touch()
+
+    async def write_body(self, request, start, end):
+        loop = asyncio.get_running_loop()
+        fd = await loop.run_in_executor(upload_executor, os.open, self.part, os.O_WRONLY)
+        offset = start
+        pending = None
+        buf = bytearray()
+        try:
+            while True:
+                chunk = await request.content.readany()
+                if chunk:
+                    buf += chunk
+                    if end is not None and offset + len(buf) > end:
+                        raise ValueError("body longer than the range")
+                if buf and (not chunk or len(buf) >= upload_block_size):
+                    if pending is not None:
+                        await pending
+                        self.add_range(*pending.range)
+                        self.kick()
+                    pending = loop.run_in_executor(upload_executor, Upload.pwrite, fd, buf, offset)
+                    pending.range = (offset, offset + len(buf))
+                    offset += len(buf)
+                    buf = bytearray()
+                if not chunk:
+                    break
+        finally:
+            # What has been received is kept, also if the transfer is
+            # interrupted.
+            try:
+                if pending is not None:
+                    await pending
+                    self.add_range(*pending.range)
+                    self.kick()
+            finally:
+                await loop.run_in_executor(upload_executor, os.close, fd)
+        return offset
+
+    async def finish(self):
+        # More requests may complete the file at the same time, the
+        # first one does the job and the others wait for it.
+        if self.done is None:
+            self.done = asyncio.ensure_future(self.conclude())
+        return await asyncio.shield(self.done)
+
+    async def conclude(self):
+        loop = asyncio.get_running_loop()
+        try:
+            # Other requests may still be writing (e.g. a slice sent
+            # twice): the file is not renamed under them.
+            await self.quiet.wait()
+            while self.hashed < self.total:
+                self.kick()
+                await self.hasher
+            checksum = self.digest.hexdigest()
+            if self.expected is not None and self.expected != checksum:
+                await loop.run_in_executor(upload_executor, os.remove, self.part)
+                return None
+            await loop.run_in_executor(upload_executor, self.commit)
+            return checksum
+        finally:
+            self.cancel_timer()
+            if Upload.active.get(self.key) is self:
+                del Upload.active[self.key]
+
+    @staticmethod
+    async def put(request, fp):
+        crange = request.headers.get('Content-Range')
+        uid = request.headers.get('X-Upload-Id')
+        if crange is None:
+            # The whole file, from the beginning. If the client announced
+            # the size, a failed transfer can be resumed.
+            u = Upload.new(fp, request.content_length, uid)
+            start, end = 0, request.content_length
+        else:
+            m = Upload.CONTENT_RANGE.match(crange.strip())
+            if m is None:
+                return aiohttp.web.Response(text='Bad Content-Range', status = 400)
+            total = None if m.group(3) == '*' else int(m.group(3))
+            if m.group(1) is None:
+                # "bytes */<size>": what has been received so far?
+                u = Upload.active.get((fp, uid))
+                if u is None:
+                    return aiohttp.web.json_response({ "size": total, "received": [] }, status = 202)
+                u.touch()
+                return aiohttp.web.json_response(u.status(), status = 202)
+            start, end = int(m.group(1)), int(m.group(2)) + 1
+            if start >= end or (total is not None and end > total):
+                return aiohttp.web.Response(text='Bad Content-Range', status = 400)
+            u = Upload.get(fp, total, uid)
+            if u.total is not None and total is not None and u.total != total:
+                return aiohttp.web.Response(text='Size mismatch', status = 409)
+        expected = request.headers.get('X-Checksum-Sha256')
+        if expected:
+            u.expected = expected.strip().lower()
+
+        if u.done is not None:
+            # The file is complete already, this is a repeated slice.
+            return await Upload.result(u)
+        offset = await u.write(request, start, end)
+        if crange is None and u.total is None:
+            u.total = offset
+
+        if not u.complete():
+            return aiohttp.web.json_response(u.status(), status = 202)
+        return await Upload.result(u)
+
+    @staticmethod
+    async def result(u):
+        checksum = await u.finish()
+        if checksum is None:
+            return aiohttp.web.Response(text='Checksum mismatch', status = 400)
+        return aiohttp.web.json_response({ "size": u.total, "sha256": checksum })
+
 @Session.decorator
 async def do_PUT(request, session):
     #print("PUT: Session=", session.sid)
@@ -1330,40 +4170,314 @@ async def do_PUT(request, session):
         response = aiohttp.web.Response(text='Bad request', status = 500)
     else:
         file_path = request.match_info.get('file_path', 'default.bin')
-        fp = os.path.join(upload_dir, file_path)
+        root = os.path.realpath(upload_dir)
+        fp = os.path.realpath(os.path.join(root, file_path))
+        if os.path.commonpath([ root, fp ]) != root or fp == root:
+            return aiohttp.web.Response(text='Bad request', status = 400)
 
-        async def upload():
+        try:
+            response = await Upload.put(request, fp)
+        except (asyncio.CancelledError, GeneratorExit):
+            raise
+        except Exception as e:
+            print("Error uploading file:", e)
+            response = aiohttp.web.Response(text='Error uploading file', status = 500)
+        if response.status == 200:
+            print(f'File {file_path} uploaded successfully to {fp}')
+    return response
+
+if PerMessageDeflate is not None:
+
+    class ThresholdDeflate(PerMessageDeflate):
+
+        # permessage-deflate allows sending any message uncompressed, so
+        # small messages (typically echo of the keys) are left alone.
+        # Messages in more frames are large, and are always compressed.
+        # It also counts the bytes, for the statistics of the session
+        # that is sending ("stats", set by the sender).
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.skip_message = False
+            self.stats = None
+
+        def encode(self, frame):
+            if frame.opcode >= 8: # Control frames
+                return frame
+            if frame.opcode != 0: # Not a continuation
+                self.skip_message = frame.fin and len(frame.data) < compression_threshold
+            if self.skip_message:
+                return frame
+            f = super().encode(frame)
+            if self.stats is not None:
+                self.stats["z_in"] += len(frame.data)
+                self.stats["z_out"] += len(f.data)
+            return f
+
+    class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+
+        def process_request_params(self, params, accepted_extensions):
+            response_params, ext = super().process_request_params(params, accepted_extensions)
+            return response_params, ThresholdDeflate(ext.remote_no_context_takeover, ext.local_no_context_takeover,
+                                                     ext.remote_max_window_bits, ext.local_max_window_bits,
+                                                     ext.compress_settings)
+
+def websocket_extensions():
+    if not enable_compression or PerMessageDeflate is None:
+        return None
+    return [ ThresholdDeflateFactory(server_no_context_takeover = not ws_context_takeover,
+                                     client_no_context_takeover = not ws_context_takeover,
+                                     server_max_window_bits = ws_window_bits,
+                                     client_max_window_bits = ws_window_bits,
+                                     compress_settings = { "level": compression_level, "memLevel": 5 }) ]
+
+def set_compression_stats(ws, stats):
+    # The compressor of the connection counts the bytes of the given
+    # session from now on.
+    protocol = getattr(ws, 'protocol', ws)
+    for ext in getattr(protocol, 'extensions', None) or []:
+        if PerMessageDeflate is not None and isinstance(ext, ThresholdDeflate):
+            ext.stats = stats
+
+class MuxChannel:
+
+    # A session carried by a multiplexed WebSocket connection.
+    # "window" is the number of characters the server may send before
+    # the client acknowledges them (0 = no flow control). While a channel
+    # has no credit, its output stays in the output queue of the session,
+    # so the usual overflow policy of the session applies.
+
+    def __init__(self, ch, session, owner, window):
+        self.ch = ch
+        self.session = session
+        self.owner = owner
+        self.attachment = None
+        self.window = window
+        self.credit = window
+        self.has_credit = asyncio.Event()
+        self.has_credit.set()
+        self.task = None
+
+    def ack(self, n):
+        self.credit = min(self.credit + n, self.window)
+        if self.credit > 0:
+            self.has_credit.set()
+
+    async def wait_credit(self):
+        while self.window > 0 and self.credit <= 0:
+            self.has_credit.clear()
+            await self.has_credit.wait()
+
+
+class WebSocketMux:
+
+    # Many sessions over one WebSocket connection. Every frame is a JSON
+    # object, and "ch" is the channel it refers to (a number chosen by the
+    # client). Client to server:
+    #   { "ch": 1, "op": "open", "session": ..., "size": "25x80", "window": 65536, "shell": ... }
+    #   { "ch": 1, "op": "attach", "session": ..., "lines": 100, "readonly": true }
+    #   { "ch": 1, "text": "ls\r" }, { "ch": 1, "size": "25x80" }
+    #   { "ch": 1, "op": "ack", "n": 4096 }
+    #   { "ch": 1, "op": "close", "kill": true }
+    # Server to client:
+    #   { "ch": 1, "session": ... } (channel open), { "ch": 1, "text": ... },
+    #   { "ch": 1, "closed": true }, { "ch": 1, "error": ... }
+    # "open" creates a session (or attaches to it, if "session" names an
+    # existing one), "attach" requires an existing session. A channel
+    # attached to an existing session gets a copy of its output (see
+    # "Session.attach"), and can be read-only. Sessions
+    # survive the channel: when their last channel is closed without
+    # "kill", or the connection is lost, the idle timeout applies to them
+    # (see "Session.connect"), so the client can attach again in the
+    # meantime.
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.channels = {}
+
+    async def send(self, obj):
+        await Metrics.ws_send(self.ws, json.dumps(obj))
+
+    async def error(self, ch, text):
+        try:
+            await self.send({ 'ch': ch, 'error': text })
+        except (asyncio.CancelledError, GeneratorExit):
+            raise
+        except:
+            pass
+
+    async def run(self):
+        try:
+            async for message in self.ws:
+                Metrics.transfer("ws", "in", len(message))
+                try:
+                    d = json.loads(message)
+                    ch = d['ch']
+                except (asyncio.CancelledError, GeneratorExit):
+                    raise
+                except:
+                    continue
+                await self.dispatch(ch, d)
+        except (asyncio.CancelledError, GeneratorExit):
+            raise
+        except Exception as e:
+            #print("WS mux recv: ", e)
+            pass
+        finally:
+            for ch in list(self.channels):
+                await self.close_channel(ch, notify = False)
+
+    async def dispatch(self, ch, d):
+        op = d.get('op')
+        c = self.channels.get(ch)
+        if op in [ 'open', 'attach' ]:
+            if c:
+                await self.error(ch, 'channel in use')
+            else:
+                await self.open_channel(ch, d, op == 'attach')
+        elif c is None:
+            await self.error(ch, 'no such channel')
+        elif op == 'close':
+            await self.close_channel(ch, kill = bool(d.get('kill')))
+        elif op == 'ack':
             try:
-                file = open(fp, 'wb')
-                while True:
-                    chunk = await request.content.read(1024)
-                    if not chunk:
-                        file.close()
-                        break
-                    file.write(chunk)
+                c.ack(int(d.get('n', 0)))
+            except ValueError:
+                pass
+        elif c.attachment and c.attachment.readonly:
+            await self.error(ch, 'read only')
+        else:
+            session = c.session
+            if 'size' in d:
+                session.set_size_from_text(d['size'])
+            t = d.get('text')
+            if t:
+                # Input doesn't wait for room in the queue, or a session
+                # whose shell doesn't read would stall the other channels.
+                if session.rxq.full():
+                    await self.error(ch, 'input queue full')
+                else:
+                    session.rxq.put_nowait(t)
+                    session.visited = time.time()
+
+    async def open_channel(self, ch, d, attach):
+        sid = d.get('session')
+        session = Session.sessions.get(sid) if sid else None
+        owner = False
+        if session is None:
+            if attach:
+                await self.error(ch, 'no such session')
+                return
+            if sid:
+                session = await Session.new_session_by_sid(sid, persistent = True)
+            else:
+                session = await Session.new_session(persistent = True)
+            owner = True
+        try:
+            window = max(0, int(d.get('window', 0)))
+        except ValueError:
+            window = 0
+        if 'idle' in d:
+            session.set_idle_timeout(d['idle'])
+        if SHELL_PARAM in d:
+            session.set_profile(d[SHELL_PARAM])
+        c = MuxChannel(ch, session, owner, window)
+        session.connect()
+        self.channels[ch] = c
+        await session.activate()
+        try:
+            nlines = int(d.get('lines', 0))
+            nbytes = int(d.get('bytes', 0))
+        except ValueError:
+            nlines = nbytes = 0
+        if owner:
+            if 'size' in d:
+                session.set_size_from_text(d['size'])
+        else:
+            c.attachment = session.attach(bool(d.get('readonly')), nlines, nbytes)
+        session.on_exit.append(self.on_session_exit)
+        c.task = asyncio.create_task(Debug.timed("write_channel", self.write_channel(c)))
+        await self.send({ 'ch': ch, 'session': session.sid })
+
+    def on_session_exit(self, session):
+        for ch, c in list(self.channels.items()):
+            if c.session is session:
+                asyncio.create_task(self.close_channel(ch))
+
+    async def close_channel(self, ch, kill = False, notify = True):
+        c = self.channels.pop(ch, None)
+        if c is None:
+            return
+        c.task.cancel()
+        session = c.session
+        if self.on_session_exit in session.on_exit:
+            session.on_exit.remove(self.on_session_exit)
+        if c.attachment:
+            session.detach(c.attachment)
+        session.disconnect()
+        if kill:
+            await Session.kill_session(session.sid)
+        if notify:
+            try:
+                await self.send({ 'ch': ch, 'closed': True })
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except:
+                pass
+
+    async def write_channel(self, c):
+        session = c.session
+        while True:
+            try:
+                await c.wait_credit()
+                if c.attachment:
+                    # The frame of the chunk is shared by all the clients,
+                    # only the channel number is added.
+                    d = await c.attachment.next_output()
+                    set_compression_stats(self.ws, session.stats)
+                    await Metrics.ws_send(self.ws, '{"ch": ' + str(c.ch) + ', ' + d.json()[1:])
+                else:
+                    d = await session.next_output()
+                    set_compression_stats(self.ws, session.stats)
+                    await self.send({ 'ch': c.ch, 'text': d })
+                c.credit -= len(d)
+                session.stats["ws_frames"] += 1
+                session.visited = time.time()
             except (asyncio.CancelledError, GeneratorExit):
                 raise
             except Exception as e:
-                print("Error opening file for upload:", e)
-                return False
-            return True
-        
-        result = await upload()
-        if not result:
-            response = aiohttp.web.Response(text='Error uploading file', status = 500)
-        else:
-            print(f'File {file_path} uploaded successfully to {fp}')
-            response = aiohttp.web.Response(text='', status = 200)
-    return response
+                #print("WS mux send: ", e)
+                break
+
+
+def websocket_params(ws, path):
+    # Old versions of "websockets" pass the path to the handler,
+    # newer ones keep it in the request.
+    if path is None:
+        request = getattr(ws, 'request', None)
+        path = request.path if request is not None else getattr(ws, 'path', '')
+    return urllib.parse.parse_qs(urllib.parse.urlsplit(path or '').query, keep_blank_values = True)
 
 async def websocket_server():
 
     print('*** Websocket server ready - bind address=' + bind_address + ':' + str(websocket_port))
 
-    async def read_from_websocket(ws, session):
+    async def read_from_websocket(ws, session, readonly = False):
         async for data in ws:
+            Metrics.transfer("ws", "in", len(data))
+            if readonly:
+                continue
             try:
-                await session.rxq.put(data)
+                if isinstance(data, bytes):
+                    # Binary protocol: input goes to the shell as it is,
+                    # without being parsed.
+                    tag = data[:1]
+                    if tag == WS_TAG_DATA:
+                        await session.rxq.put(data[1:])
+                    elif tag == WS_TAG_SIZE:
+                        session.set_size_from_text(data[1:].decode('ascii', 'replace'))
+                else:
+                    await session.rxq.put(data)
                 session.visited = time.time()
             except (asyncio.CancelledError, GeneratorExit):
                 raise
@@ -1371,11 +4485,19 @@ async def websocket_server():
                 #print("WS recv: ", e)
                 break
 
-    async def write_to_websocket(ws, session):
+    async def write_to_websocket(ws, session, attachment = None, binary = False):
         while True:
             try:
-                d = await session.txq.get()
-                await ws.send(json.dumps({ 'text': d }))
+                if attachment:
+                    d = await attachment.next_output()
+                    await Metrics.ws_send(ws, d.binary() if binary else d.json())
+                elif binary:
+                    d = await session.next_output()
+                    await Metrics.ws_send(ws, binary_frame(d))
+                else:
+                    d = await session.next_output()
+                    await Metrics.ws_send(ws, json.dumps({ 'text': d }))
+                session.stats["ws_frames"] += 1
                 session.visited = time.time()
             except (asyncio.CancelledError, GeneratorExit):
                 raise
@@ -1386,17 +4508,55 @@ async def websocket_server():
     async def websocket_connection(ws, path = None):
 
         #print("WS connection, peer = ", json.dumps(ws.remote_address))
-        session = await Session.new_session(persistent = True)
-        await session.activate()
+        params = websocket_params(ws, path)
+        binary = WS_BINARY_PARAM in params or getattr(ws, 'subprotocol', None) == WS_BINARY_SUBPROTOCOL
+        if WS_MUX_PARAM in params:
+            await WebSocketMux(ws).run()
+            return
+
+        # Like HTTP requests, a connection can name the session it wants.
+        # If the session exists, the connection is attached to it, and gets
+        # a copy of its output.
+        sid = params.get(SESSION_HINT_PARAM, [ None ])[0]
+        session = Session.sessions.get(sid) if sid else None
+        attachment = None
+        if session:
+            readonly = WS_READONLY_PARAM in params
+            try:
+                nlines = int(params.get(HISTORY_LINES_PARAM, [ 0 ])[0])
+                nbytes = int(params.get(HISTORY_BYTES_PARAM, [ 0 ])[0])
+            except ValueError:
+                nlines = nbytes = 0
+            if SHELL_PARAM in params:
+                session.set_profile(params[SHELL_PARAM][0])
+            await session.activate()
+            attachment = session.attach(readonly, nlines, nbytes)
+            print("Session ", session.sid, ": WebSocket client attached", " (read only)" if readonly else "")
+        else:
+            if sid:
+                session = await Session.new_session_by_sid(sid, persistent = True)
+            else:
+                session = await Session.new_session(persistent = True)
+            readonly = False
+            if SHELL_PARAM in params:
+                session.set_profile(params[SHELL_PARAM][0])
+            await session.activate()
+        if IDLE_TIMEOUT_PARAM in params:
+            session.set_idle_timeout(params[IDLE_TIMEOUT_PARAM][0])
+        session.connect()
         tasks = list()
         
         #print("WS connection, shell running, peer = ", json.dumps(ws.remote_address))
 
-        tasks.append(asyncio.create_task(read_from_websocket(ws, session)))
-        tasks.append(asyncio.create_task(write_to_websocket(ws, session)))
+        set_compression_stats(ws, session.stats)
+        tasks.append(asyncio.create_task(read_from_websocket(ws, session, readonly)))
+        tasks.append(asyncio.create_task(Debug.timed("write_to_websocket", write_to_websocket(ws, session, attachment, binary))))
 
         async def on_close(task):
             #print("WS connection closed, peer = ", json.dumps(ws.remote_address))
+            if attachment:
+                session.detach(attachment)
+            session.disconnect()
             try:
                 await ws.close()
             except (asyncio.CancelledError, GeneratorExit):
@@ -1420,16 +4580,39 @@ async def websocket_server():
 # Source of this approach: https://github.com/hzlmn/sketch/issues/4#issuecomment-1311185375
 # Note that the post also recommends to "save somewhere" the task, or the GC will
 # destroy it at the first opportunity. See below.
-    wsserver = await websockets.serve(websocket_connection, bind_address, websocket_port)
+    def select_subprotocol(*args):
+        # Clients that don't ask for a subprotocol must be accepted too.
+        # The arguments depend on the version of "websockets": (connection,
+        # client subprotocols) or (client subprotocols, server subprotocols).
+        offered = args[0] if isinstance(args[0], (list, tuple)) else args[1]
+        return WS_BINARY_SUBPROTOCOL if WS_BINARY_SUBPROTOCOL in offered else None
+
+    compression = {}
+    if not enable_compression:
+        compression = { 'compression': None }
+    elif PerMessageDeflate is not None:
+        compression = { 'compression': None, 'extensions': websocket_extensions() }
+    try:
+        wsserver = await websockets.serve(websocket_connection, bind_address, websocket_port,
+                                          subprotocols = [ WS_BINARY_SUBPROTOCOL ], select_subprotocol = select_subprotocol,
+                                          **compression)
+    except TypeError:
+        # Old versions: the binary protocol can be selected by parameter only.
+        wsserver = await websockets.serve(websocket_connection, bind_address, websocket_port, **compression)
     if hasattr(wsserver, 'serve_forever'):
         await wsserver.serve_forever()
 
 async def init_http_server():
+    global static_cache, upload_executor
 
     print('*** HTTP server ready - bind address=' + bind_address + ':' + str(http_port) + ' root=' + doc_dir)
 
-    http_server = aiohttp.web.Application()
+    static_cache = StaticCache(static_cache_size)
+    upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers = upload_threads, thread_name_prefix = "upload")
+
+    http_server = aiohttp.web.Application(middlewares = [ metrics_middleware ])
     http_server.add_routes([aiohttp.web.get('/', do_GET),
+                            aiohttp.web.get(METRICS_PATH, do_GET_metrics),
                             aiohttp.web.get('/{file_path:.*}', do_GET_files),
                             aiohttp.web.post('/', do_POST),
                             aiohttp.web.put('/{file_path:.*}', do_PUT)])
@@ -1497,6 +4680,43 @@ if __name__ == '__main__':
             print(' '+bold+'-use-conhost'+comment+'(Windows only) Use conhost.exe instead of ConPTY (default, but not officially supported by M$)')
             print(' '+bold+'-use-conpty'+comment+'(Windows only) Use ConPTY API (recommended by M$, but slow)')
         print(' '+bold+'-initial-size'+orop+'-default-size '+italic+'columns'+normal+'x'+italic+'lines'+comment+'Initial screen size. Default='+str(DEFAULT_NCOLUMNS)+'x'+str(DEFAULT_NLINES))
+        print(' '+bold+'-decode-errors '+italic+'policy'+comment+'How to treat invalid shell output ('+', '.join(DECODE_ERROR_POLICIES)+'). Default='+DEFAULT_DECODE_ERRORS)
+        print(' '+bold+'-long-poll-max '+italic+'ms'+comment+'Maximum time a data request can wait for output (long poll). Default='+str(DEFAULT_LONG_POLL_MAX_MS))
+        print(' '+bold+'-long-poll-coalesce '+italic+'ms'+comment+'Time to collect more output before answering a long poll. Default='+str(DEFAULT_LONG_POLL_COALESCE_MS))
+        print(' '+bold+'-flush-time '+italic+'ms'+comment+'Maximum time output is held to be merged with the following one (0=no batching). Default='+str(DEFAULT_OUTPUT_FLUSH_MS))
+        print(' '+bold+'-flush-size '+italic+'bytes'+comment+'Size at which a batch of output is sent immediately. Default='+str(DEFAULT_OUTPUT_FLUSH_BYTES))
+        print(' '+bold+'-read-size '+italic+'bytes'+comment+'Size of the reads from the virtual terminal. Default='+str(DEFAULT_READ_SIZE))
+        print(' '+bold+'-read-size-max '+italic+'bytes'+comment+'Limit of the adaptive read size (not greater than read size = fixed size). Default='+str(DEFAULT_READ_SIZE_MAX))
+        print(' '+bold+'-txq-limit '+italic+'characters'+comment+'Capacity of the output queue of a session, 0=unbounded. Default='+str(DEFAULT_TXQ_LIMIT))
+        print(' '+bold+'-rxq-limit '+italic+'characters'+comment+'Capacity of the input queue of a session, 0=unbounded. Default='+str(DEFAULT_RXQ_LIMIT))
+        print(' '+bold+'-overflow '+italic+'policy'+comment+'What to do when a client falls behind ('+', '.join(OVERFLOW_POLICIES)+'). Default='+DEFAULT_OVERFLOW_POLICY)
+        print(' '+bold+'-overflow-threshold '+italic+'characters'+comment+'Backlog that triggers the "skip" policy. Default='+str(DEFAULT_OVERFLOW_THRESHOLD))
+        print(' '+bold+'-history-size '+italic+'bytes'+comment+'Scrollback kept by every session, 0=none. Default='+str(DEFAULT_HISTORY_SIZE))
+        print(' '+bold+'-history-lines '+italic+'lines'+comment+'Maximum number of lines of the scrollback, 0=no limit. Default='+str(DEFAULT_HISTORY_LINES))
+        print(' '+bold+'-no-compression'+comment+'Disable the compression of WebSocket messages and HTTP responses')
+        print(' '+bold+'-compression-level '+italic+'level'+comment+'Compression level, 1 (fast) to 9 (best). Default='+str(DEFAULT_COMPRESSION_LEVEL))
+        print(' '+bold+'-compression-threshold '+italic+'bytes'+comment+'Messages and responses smaller than this are not compressed. Default='+str(DEFAULT_COMPRESSION_THRESHOLD))
+        print(' '+bold+'-ws-window-bits '+italic+'bits'+comment+'Window size of WebSocket compression (9...15). Default='+str(DEFAULT_WS_WINDOW_BITS))
+        print(' '+bold+'-ws-no-context-takeover'+comment+'Reset WebSocket compression at every message (less memory, worse compression)')
+        print(' '+bold+'-static-cache-size '+italic+'bytes'+comment+'Memory for the cache of the files served by HTTP, 0=no cache. Default='+str(DEFAULT_STATIC_CACHE_SIZE))
+        print(' '+bold+'-stream-threshold '+italic+'bytes'+comment+'Files larger than this are streamed from the disk instead of being cached. Default='+str(DEFAULT_STREAM_THRESHOLD))
+        print(' '+bold+'-upload-block-size '+italic+'bytes'+comment+'Size of the blocks written to the disk during an upload. Default='+str(DEFAULT_UPLOAD_BLOCK_SIZE))
+        print(' '+bold+'-upload-threads '+italic+'n'+comment+'Number of threads that write the uploaded files. Default='+str(DEFAULT_UPLOAD_THREADS))
+        print(' '+bold+'-upload-timeout '+italic+'seconds'+comment+'Uploads that receive nothing for this time are abandoned. Default='+str(DEFAULT_UPLOAD_TIMEOUT))
+        print(' '+bold+'-shell '+italic+'command'+comment+'Command run by the sessions. Default='+DEFAULT_SHELL_COMMAND)
+        print(' '+bold+'-shell-profiles '+italic+'file'+comment+'JSON file of named commands, selected by the "'+SHELL_PARAM+'" parameter')
+        print(' '+bold+'-no-spawn-helper'+comment+'(Linux only) Start the shells from the server process instead of a helper process')
+        print(' '+bold+'-shell-pool '+italic+'n'+comment+'Shells started in advance (high watermark of the pool), 0=no pool. Default='+str(DEFAULT_SHELL_POOL_HIGH))
+        print(' '+bold+'-shell-pool-low '+italic+'n'+comment+'The pool is refilled when it has fewer shells than this. Default='+str(DEFAULT_SHELL_POOL_LOW))
+        print(' '+bold+'-closed-sessions '+italic+'n'+comment+'Closed sessions kept in the session list, with exit status and resource usage. Default='+str(DEFAULT_CLOSED_SESSIONS))
+        print(' '+bold+'-debug-flags '+italic+'flags'+comment+'Set ("+flag" or "flag") or clear ("-flag") debug flags, e.g. +timing,-stall. Default='+",".join(sorted(DEBUG_FLAGS)))
+        print(' '+bold+'-stall-threshold '+italic+'ms'+comment+'Event loop stalls longer than this are recorded ("stall" debug flag). Default='+str(DEFAULT_STALL_THRESHOLD_MS))
+        print(' '+bold+'-idle-timeout '+italic+'seconds'+comment+'Sessions unused for this time are closed. Default='+str(DEFAULT_SESSION_IDLE_TIMEOUT))
+        print(' '+bold+'-replay '+italic+'file'+comment+'Sessions replay this typescript (made by "script -t") instead of running a shell')
+        print(' '+bold+'-replay-timing '+italic+'file'+comment+'Timing file of the typescript. Without it, the typescript is sent as fast as possible')
+        print(' '+bold+'-replay-speed '+italic+'factor'+comment+'Replay speed, 0=as fast as possible. Default='+str(DEFAULT_REPLAY_SPEED))
+        print(' '+bold+'-replay-repeat '+italic+'n'+comment+'Times the typescript is replayed, then the session stays idle, 0=forever. Default='+str(DEFAULT_REPLAY_REPEAT))
+        print(' '+bold+'-screen-model'+comment+'Keep a model of the screen of every session, to repaint it when a client reconnects')
         print(' '+bold+'-no-welcome'+comment+'Disable welcome message')
         print(' '+bold+'-fix-aiohttp'+comment+'Launch WebSocket server in a separate process to prevent aiohttp bug')
         print(' '+bold+'-d'+orop+'-debug'+comment+'Enable debug mode')
@@ -1505,22 +4725,34 @@ if __name__ == '__main__':
         print('')
         sys.exit(0)
 
-    args = [ x.lower() for x in sys.argv[1:] ]
+    args = sys.argv[1:]
 
     while len(args) > 0:
 
-        opt = args[0]
+        opt = args[0].lower()
         opt = opt.replace('--', '-')
         args = args[1:]
         #print('"' + opt + '"')
         if opt in [ "-http", "-httpport", "-b", "-bind", "-bindaddr", "-ws", "-wsport", "-websocket", "-websocketport",
                     "-docdir", "-docroot", "-wwwroot", "-root", "-doc",
-                    "-initial-size", "-default-size" ]:
+                    "-initial-size", "-default-size", "-decode-errors",
+                    "-long-poll-max", "-long-poll-coalesce", "-flush-time", "-flush-size",
+                    "-read-size", "-read-size-max", "-txq-limit", "-rxq-limit",
+                    "-overflow", "-overflow-threshold", "-history-size", "-history-lines",
+                    "-compression-level", "-compression-threshold", "-ws-window-bits", "-static-cache-size",
+                    "-stream-threshold", "-upload-block-size", "-upload-threads", "-upload-timeout",
+                    "-shell-pool", "-shell-pool-low", "-shell", "-shell-profiles", "-closed-sessions",
+                    "-stall-threshold", "-debug-flags", "-idle-timeout",
+                    "-replay", "-replay-timing", "-replay-speed", "-replay-repeat" ]:
 
             if len(args) == 0:
                 usage()
             arg = args[0]
             args = args[1:]
+            # File names keep their case
+            if opt not in [ "-docdir", "-docroot", "-wwwroot", "-root", "-doc", "-replay", "-replay-timing",
+                            "-shell", "-shell-profiles" ]:
+                arg = arg.lower()
             if opt in [ "-http", "-httpport" ]:
                 http_port = arg
             elif opt in [ "-ws", "-wsport", "-websocket", "-websocketport" ]:
@@ -1538,9 +4770,105 @@ if __name__ == '__main__':
                     usage()
                 if initial_ncolumns < 1 or initial_nlines < 1:
                     usage()
+            elif opt in [ "-decode-errors" ]:
+                if arg not in DECODE_ERROR_POLICIES:
+                    usage()
+                decode_errors = arg
+            elif opt in [ "-long-poll-max", "-long-poll-coalesce", "-flush-time", "-flush-size",
+                          "-read-size", "-read-size-max", "-txq-limit", "-rxq-limit",
+                          "-overflow-threshold", "-history-size", "-history-lines",
+                          "-compression-level", "-compression-threshold", "-ws-window-bits", "-static-cache-size",
+                          "-stream-threshold", "-upload-block-size", "-upload-threads", "-upload-timeout",
+                          "-shell-pool", "-shell-pool-low", "-closed-sessions",
+                          "-stall-threshold", "-idle-timeout" ]:
+                try:
+                    v = int(arg)
+                except:
+                    usage()
+                if v < 0:
+                    usage()
+                if opt == "-long-poll-max":
+                    long_poll_max_ms = v
+                elif opt == "-long-poll-coalesce":
+                    long_poll_coalesce_ms = v
+                elif opt == "-flush-time":
+                    output_flush_ms = v
+                elif opt == "-flush-size":
+                    output_flush_bytes = v
+                elif opt == "-read-size":
+                    if v < 1:
+                        usage()
+                    read_size = v
+                elif opt == "-read-size-max":
+                    read_size_max = v
+                elif opt == "-txq-limit":
+                    txq_limit = v
+                elif opt == "-rxq-limit":
+                    rxq_limit = v
+                elif opt == "-overflow-threshold":
+                    overflow_threshold = v
+                elif opt == "-history-size":
+                    history_size = v
+                elif opt == "-history-lines":
+                    history_lines = v
+                elif opt == "-compression-level":
+                    if v < 1 or v > 9:
+                        usage()
+                    compression_level = v
+                elif opt == "-compression-threshold":
+                    compression_threshold = v
+                elif opt == "-static-cache-size":
+                    static_cache_size = v
+                elif opt == "-stream-threshold":
+                    stream_threshold = v
+                elif opt == "-upload-block-size":
+                    upload_block_size = max(4096, v)
+                elif opt == "-upload-threads":
+                    upload_threads = max(1, v)
+                elif opt == "-upload-timeout":
+                    upload_timeout = max(1, v)
+                elif opt == "-shell-pool":
+                    shell_pool_high = v
+                elif opt == "-shell-pool-low":
+                    shell_pool_low = v
+                elif opt == "-closed-sessions":
+                    closed_sessions = v
+                elif opt == "-stall-threshold":
+                    stall_threshold_ms = max(1, v)
+                elif opt == "-idle-timeout":
+                    session_idle_timeout = min(max(1, v), SESSION_IDLE_TIMEOUT_MAX)
+                else:
+                    if v < 9 or v > 15:
+                        usage()
+                    ws_window_bits = v
+            elif opt in [ "-overflow" ]:
+                if arg not in OVERFLOW_POLICIES:
+                    usage()
+                overflow_policy = arg
+            elif opt in [ "-debug-flags" ]:
+                Debug.set_flags(arg)
+            elif opt in [ "-shell" ]:
+                shell_command = arg
+            elif opt in [ "-shell-profiles" ]:
+                shell_profiles_file = arg
+            elif opt in [ "-replay" ]:
+                replay_file = arg
+            elif opt in [ "-replay-timing" ]:
+                replay_timing_file = arg
+            elif opt in [ "-replay-speed" ]:
+                try:
+                    replay_speed = max(0.0, float(arg))
+                except ValueError:
+                    usage()
+            elif opt in [ "-replay-repeat" ]:
+                try:
+                    replay_repeat = max(0, int(arg))
+                except ValueError:
+                    usage()
             
         elif opt in [ "-h", "-help", "-no-http", "-no-websocket", "-d", "-debug", "-q", "quiet",
-                      "-fix-aiohttp", "-aiohttp-workaround", "-no-welcome", '-use-conhost', '-use-conpty' ]:
+                      "-fix-aiohttp", "-aiohttp-workaround", "-no-welcome", '-use-conhost', '-use-conpty',
+                      "-screen-model", "-no-compression", "-ws-no-context-takeover", "-no-spawn-helper" ]:
 
             if opt in [ "-d", "-debug" ]:
                 debug = True
@@ -1556,6 +4884,14 @@ if __name__ == '__main__':
                 fix_aiohttp = True
             elif opt in [ "-no-welcome" ]:
                 enable_welcome = False
+            elif opt in [ "-screen-model" ]:
+                enable_screen_model = True
+            elif opt in [ "-no-compression" ]:
+                enable_compression = False
+            elif opt in [ "-ws-no-context-takeover" ]:
+                ws_context_takeover = False
+            elif opt in [ "-no-spawn-helper" ]:
+                enable_spawn_helper = False
             elif opt in [ "-use-conhost" ]:
                 use_conhost = True
             elif opt in [ "-use-conpty" ]:
@@ -1578,6 +4914,8 @@ if __name__ == '__main__':
     def no_print(*args):
         pass
 
+    shell_pool_low = min(max(1, shell_pool_low), shell_pool_high)
+
 
     if conhost_helper_pipe:
         #print("conhost_helper")
@@ -1612,14 +4950,36 @@ if __name__ == '__main__':
 # So we reserve a separate process to manage WebSocket, and the main one
 # manages HTTP.
 
+    if replay_file:
+        try:
+            replay = load_replay(replay_file, replay_timing_file)
+        except (OSError, ValueError) as e:
+            print("Cannot load the recorded session:", e)
+            sys.exit(1)
+
+    try:
+        shell_profiles = load_shell_profiles(shell_command, shell_profiles_file)
+    except (OSError, ValueError, AttributeError) as e:
+        print("Cannot load the shell profiles:", e)
+        sys.exit(1)
+
     if fix_aiohttp and enable_websocket and enable_http:
-        rv = os.spawnl(os.P_NOWAIT, sys.executable, sys.executable, __file__,
-                       '-no-welcome', '-no-http', '-ws', str(websocket_port), '-bind', bind_address) 
+        # The WebSocket server gets all the options (the last ones win),
+        # so that its sessions are configured like those of the HTTP server.
+        rv = os.spawnv(os.P_NOWAIT, sys.executable, [ sys.executable, __file__ ] + sys.argv[1:] +
+                       [ '-no-welcome', '-no-http', '-ws', str(websocket_port), '-bind', bind_address ])
         enable_websocket = False
 
     if debug:
         logging.basicConfig(level=logging.WARNING)
 
+    # Now, while the process is small.
+    if enable_spawn_helper and platform.system() == "Linux" and replay is None and (enable_http or enable_websocket):
+        try:
+            SpawnHelper.start()
+        except OSError as e:
+            print("Cannot start the spawn helper:", e)
+
     if enable_http:
 
         aiohttp.web.run_app(init_http_server(), host=bind_address, port=http_port, print=no_print)
@@ -0,0 +1,54 @@
+# Ended sessions: the reason of the end is recorded in the list of the
+# closed sessions.
+#
+#  python -m pytest example/tests
+
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+EXAMPLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, EXAMPLE_DIR)
+
+import miniserver
+
+from test_sessions import FakeWebSocket, sessions
+
+
+async def wait_end(session):
+    # The session leaves the list of the sessions before its end
+    # is recorded.
+    deadline = time.time() + 5
+    while not miniserver.Session.closed and time.time() < deadline:
+        await asyncio.sleep(0.1)
+    assert session.sid not in miniserver.Session.sessions
+    return miniserver.Session.closed[-1]
+
+def test_killed_session(sessions):
+    async def run():
+        miniserver.Session.setup()
+        mux = miniserver.WebSocketMux(FakeWebSocket())
+        await mux.open_channel(1, {}, False)
+        session = mux.channels[1].session
+        await asyncio.sleep(0.1)
+        await miniserver.Session.kill_session(session.sid)
+        closed = await wait_end(session)
+        assert closed["rs"] == "kill"
+
+    asyncio.run(run())
+
+def test_disconnected_session(sessions):
+    async def run():
+        miniserver.Session.setup()
+        mux = miniserver.WebSocketMux(FakeWebSocket())
+        await mux.open_channel(1, { "idle": 1 }, False)
+        session = mux.channels[1].session
+        await asyncio.sleep(0.1)
+        await mux.close_channel(1)
+        closed = await wait_end(session)
+        assert closed["rs"] == "disconnect"
+
+    asyncio.run(run())
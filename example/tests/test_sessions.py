@@ -0,0 +1,72 @@
+# Sessions with several WebSocket clients: a session stays alive while
+# some client is connected, and expires when the last one leaves.
+#
+#  python -m pytest example/tests
+
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+EXAMPLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, EXAMPLE_DIR)
+
+import miniserver
+
+
+class FakeWebSocket:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+@pytest.fixture
+def sessions(monkeypatch, tmp_path):
+    typescript = tmp_path / "typescript"
+    typescript.write_bytes(b'Script started on 2026-01-01 [COLUMNS="80" LINES="24"]\nhello\n')
+    monkeypatch.setattr(miniserver, "replay", miniserver.load_replay(str(typescript)))
+    monkeypatch.setattr(miniserver, "shell_pool_high", 0)
+    monkeypatch.setattr(miniserver, "print", lambda *args, **kwargs: None, raising = False)
+
+def test_client_count(sessions):
+    async def run():
+        miniserver.Session.setup()
+        s = await miniserver.Session.new_session(persistent = True)
+        s.connect()
+        s.connect()
+        s.disconnect()
+        assert s.persistent
+        s.disconnect()
+        assert not s.persistent and s.clients == 0 and s.dropped
+        assert s.expiry is not None
+        s.connect()
+        assert s.persistent and not s.dropped
+
+    asyncio.run(run())
+
+@pytest.mark.parametrize("owner_first", [ True, False ])
+def test_mux_channels_of_one_session(sessions, owner_first):
+    async def run():
+        miniserver.Session.setup()
+        a = miniserver.WebSocketMux(FakeWebSocket())
+        b = miniserver.WebSocketMux(FakeWebSocket())
+        await a.open_channel(1, { "idle": 1 }, False)
+        session = a.channels[1].session
+        await b.open_channel(1, { "session": session.sid }, True)
+        await asyncio.sleep(0.1)
+        first, second = (a, b) if owner_first else (b, a)
+        await first.close_channel(1)
+        assert session.persistent
+        await second.close_channel(1)
+        assert not session.persistent and session.clients == 0
+        # Nobody is connected: the session expires.
+        deadline = time.time() + 5
+        while session.sid in miniserver.Session.sessions and time.time() < deadline:
+            await asyncio.sleep(0.1)
+        assert session.sid not in miniserver.Session.sessions
+
+    asyncio.run(run())
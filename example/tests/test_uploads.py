@@ -0,0 +1,148 @@
+# Uploads (class Upload). They run without aiohttp: the requests and the
+# responses are replaced by small fakes.
+#
+#  python -m pytest example/tests
+
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import sys
+import types
+
+import pytest
+
+EXAMPLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, EXAMPLE_DIR)
+
+import miniserver
+
+
+class FakeContent:
+
+    def __init__(self, data, fail, gate):
+        self.chunks = [ data[i:i + 65536] for i in range(0, len(data), 65536) ]
+        self.fail = fail
+        self.gate = gate
+
+    async def readany(self):
+        if self.gate is not None and len(self.chunks) == 1:
+            await self.gate.wait()
+        if self.chunks:
+            return self.chunks.pop(0)
+        if self.fail:
+            raise ConnectionResetError("interrupted")
+        return b''
+
+class FakeRequest:
+
+    def __init__(self, data, headers = None, fail = False, gate = None):
+        self.headers = headers or {}
+        self.content = FakeContent(data, fail, gate)
+        self.content_length = None if 'Content-Range' in self.headers else len(data)
+
+def fake_json_response(body, status = 200):
+    return types.SimpleNamespace(body = body, status = status)
+
+@pytest.fixture
+def uploads(monkeypatch, tmp_path):
+    web = types.SimpleNamespace(json_response = fake_json_response,
+                                Response = lambda text = None, status = 200: types.SimpleNamespace(text = text, status = status))
+    monkeypatch.setattr(miniserver, "aiohttp", types.SimpleNamespace(web = web), raising = False)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers = 2)
+    monkeypatch.setattr(miniserver, "upload_executor", executor)
+    monkeypatch.setattr(miniserver.Upload, "active", {})
+    yield str(tmp_path / "file.bin")
+    executor.shutdown()
+
+def test_upload_replaces_longer_part(uploads):
+    fp = uploads
+    old = os.urandom(3000000)
+    new = os.urandom(1000)
+
+    async def run():
+        # An interrupted ranged transfer leaves a long ".part" behind.
+        with pytest.raises(ConnectionResetError):
+            await miniserver.Upload.put(FakeRequest(old[:2000000], { 'Content-Range': 'bytes 0-2999999/3000000' }, fail = True), fp)
+        assert os.path.getsize(fp + ".part") > len(new)
+        return await miniserver.Upload.put(FakeRequest(new), fp)
+
+    r = asyncio.run(run())
+    assert r.status == 200
+    with open(fp, 'rb') as f:
+        data = f.read()
+    assert data == new
+    assert r.body == { "size": len(new), "sha256": hashlib.sha256(new).hexdigest() }
+
+def test_upload_in_ranges(uploads):
+    fp = uploads
+    data = os.urandom(300000)
+
+    async def run():
+        await miniserver.Upload.put(FakeRequest(data[150000:], { 'Content-Range': 'bytes 150000-299999/300000' }), fp)
+        return await miniserver.Upload.put(FakeRequest(data[:150000], { 'Content-Range': 'bytes 0-149999/300000' }), fp)
+
+    r = asyncio.run(run())
+    assert r.status == 200
+    with open(fp, 'rb') as f:
+        assert f.read() == data
+    assert r.body["sha256"] == hashlib.sha256(data).hexdigest()
+
+
+def test_uploads_with_different_ids(uploads):
+    fp = uploads
+    a = os.urandom(300000)
+    b = os.urandom(300000)
+
+    async def run():
+        # Same name and size, but another upload: nothing of "a" is used.
+        await miniserver.Upload.put(FakeRequest(a[:150000], { 'Content-Range': 'bytes 0-149999/300000', 'X-Upload-Id': 'a' }), fp)
+        await miniserver.Upload.put(FakeRequest(b[150000:], { 'Content-Range': 'bytes 150000-299999/300000', 'X-Upload-Id': 'b' }), fp)
+        r = await miniserver.Upload.put(FakeRequest(b[:150000], { 'Content-Range': 'bytes 0-149999/300000', 'X-Upload-Id': 'b' }), fp)
+        assert (fp, 'a') in miniserver.Upload.active
+        return r
+
+    r = asyncio.run(run())
+    assert r.status == 200
+    with open(fp, 'rb') as f:
+        assert f.read() == b
+    assert r.body["sha256"] == hashlib.sha256(b).hexdigest()
+
+def test_upload_waits_for_writers(uploads):
+    fp = uploads
+    data = os.urandom(300000)
+    headers = { 'X-Upload-Id': 'x' }
+
+    async def run():
+        gate = asyncio.Event()
+        # A slice sent twice: the first copy is still being written
+        # when the file is complete.
+        slow = asyncio.ensure_future(miniserver.Upload.put(FakeRequest(data[:200000], dict(headers, **{ 'Content-Range': 'bytes 0-199999/300000' }), gate = gate), fp))
+        await asyncio.sleep(0.1)
+        await miniserver.Upload.put(FakeRequest(data[200000:], dict(headers, **{ 'Content-Range': 'bytes 200000-299999/300000' })), fp)
+        done = asyncio.ensure_future(miniserver.Upload.put(FakeRequest(data[:200000], dict(headers, **{ 'Content-Range': 'bytes 0-199999/300000' })), fp))
+        await asyncio.sleep(0.2)
+        assert not done.done() and not os.path.exists(fp)
+        gate.set()
+        return await slow, await done
+
+    r1, r2 = asyncio.run(run())
+    assert r1.status == 200 and r2.status == 200
+    with open(fp, 'rb') as f:
+        assert f.read() == data
+
+def test_abandoned_upload(uploads, monkeypatch):
+    fp = uploads
+    monkeypatch.setattr(miniserver, "upload_timeout", 0.2)
+
+    async def run():
+        r = await miniserver.Upload.put(FakeRequest(os.urandom(1000), { 'Content-Range': 'bytes 0-999/2000', 'X-Upload-Id': 'x' }), fp)
+        assert r.status == 202
+        part = miniserver.Upload.active[(fp, 'x')].part
+        assert os.path.exists(part)
+        await asyncio.sleep(0.5)
+        return part
+
+    part = asyncio.run(run())
+    assert miniserver.Upload.active == {}
+    assert not os.path.exists(part)
@@ -0,0 +1,26 @@
+# The server can be imported, and prints its help, also where aiohttp
+# is not installed.
+#
+#  python -m pytest example/tests
+
+import os
+import subprocess
+import sys
+
+EXAMPLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BLOCK_AIOHTTP = "import sys; sys.modules['aiohttp'] = None; sys.modules['aiohttp.web'] = None; "
+
+def run_without_aiohttp(code):
+    return subprocess.run([ sys.executable, "-c", BLOCK_AIOHTTP + code ],
+                          cwd = EXAMPLE_DIR, capture_output = True, text = True, timeout = 60)
+
+def test_import_without_aiohttp():
+    r = run_without_aiohttp("import miniserver; print(miniserver.has_aiohttp)")
+    assert r.returncode == 0, r.stderr
+    assert r.stdout.strip().endswith("False")
+
+def test_help_without_aiohttp():
+    r = run_without_aiohttp("import runpy; sys.argv = [ 'miniserver.py', '-h' ]; runpy.run_path('miniserver.py', run_name = '__main__')")
+    assert "NameError" not in r.stderr, r.stderr
+    assert "-fix-aiohttp" in r.stdout
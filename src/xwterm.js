@@ -529,12 +529,23 @@ const ANSITERM_DEFAULTS = {
 	immediateRefresh:  70, // Time in milliseconds to send an update request aftertheen nextding an event.
 	fastRefresh:  500, // Time in milliseconds to send the next update request after receiving a response.
 	slowRefresh:  2000, // Time in milliseconds to send the next update request after a protocol failure.
+	httpLongPoll:  0, // If not 0, maximum time in milliseconds the server may hold a data request while waiting for output ("long poll").
+	httpLongPollParam:  "wait", // Name of the parameter that carries the long poll time.
+	httpRepaintParam:  "repaint", // Name of the parameter that asks the server to send the whole screen at the first data request. Empty to disable.
+	httpReplayLines:  0, // If not 0, number of lines of the server-side history to replay at the first data request.
+	httpReplayLinesParam:  "lines", // Name of the parameter that carries the number of lines to replay.
 
 	// Parameters for "websocket" channel type
 	wsEndpoint: "127.0.0.1:8001", // Websocket endpoint
 	wsDataTag: "text", // name of the JSON field containing characters (both send and received),
 	wsSizeTag: "size", // name of the JSON tag containing the sreen size.
 	wsSizeData: "?lines?x?columns?", // format of the JSON tag containing the screen size.
+	wsSession: "", // If not empty, ID of an existing session to attach to (the server creates it if it doesn't exist).
+	wsReadOnly: false, // If true, the terminal attached to an existing session only shows its output.
+	wsBinary: false, // If true, use the binary protocol (subprotocol "xwterm.binary") instead of JSON messages. Not available in multiplexed mode.
+	wsMultiplex: false, // If true, all the terminals that use the same endpoint share a single connection.
+	wsMultiplexParam: "mux", // Parameter added to the endpoint URL to request the multiplexed protocol.
+	wsWindow: 262144, // Multiplexed mode only: characters the server may send before the terminal acknowledges them (0 = no flow control).
 
 	// Colors and appearance:
 
@@ -1408,10 +1419,21 @@ export class AnsiTermHistory
  * @param {number} [params.immediateRefresh=100] - Immediate refresh interval in milliseconds.
  * @param {number} [params.fastRefresh=500] - Fast refresh interval in milliseconds.
  * @param {number} [params.slowRefresh=2000] - Slow refresh interval in milliseconds.
+ * @param {number} [params.httpLongPoll=0] - If not 0, maximum time in milliseconds the server may hold a data request waiting for output.
+ * @param {string} [params.httpLongPollParam="wait"] - Name of the parameter that carries the long poll time.
+ * @param {string} [params.httpRepaintParam="repaint"] - Name of the parameter that asks the server to repaint the whole screen at the first data request. Empty to disable.
+ * @param {number} [params.httpReplayLines=0] - If not 0, number of lines of the server-side history to replay at the first data request.
+ * @param {string} [params.httpReplayLinesParam="lines"] - Name of the parameter that carries the number of lines to replay.
  * @param {string} [params.wsEndpoint=""] - WebSocket endpoint for the terminal.
  * @param {string} [params.wsDataTag=""] - WebSocket data tag for the terminal.
  * @param {string} [params.wsSizeTag=""] - WebSocket size tag for the terminal.
  * @param {string} [params.wsSizeData=""] - WebSocket size data for the terminal.
+ * @param {string} [params.wsSession=""] - If not empty, ID of an existing session to attach to (the server creates it if it doesn't exist).
+ * @param {boolean} [params.wsReadOnly=false] - If true, the terminal attached to an existing session only shows its output.
+ * @param {boolean} [params.wsBinary=false] - If true, use the binary protocol (subprotocol "xwterm.binary") instead of JSON messages. Not available in multiplexed mode.
+ * @param {boolean} [params.wsMultiplex=false] - If true, all the terminals that use the same endpoint share a single WebSocket connection.
+ * @param {string} [params.wsMultiplexParam="mux"] - Parameter added to the endpoint URL to request the multiplexed protocol.
+ * @param {number} [params.wsWindow=262144] - Multiplexed mode only: number of characters the server may send before the terminal acknowledges them (0 = no flow control).
  * @param {string} [params.palette=null] - Base pasette (colors 0...15). Possible values: "default",
  *                                       - null (sane as "default", but takes background and foregraound parameters)
  *                                       - "windows", "xterm", "vscode", or an array of 16 colors.
@@ -2638,6 +2660,11 @@ export class AnsiTerm {
 						immediateRefresh: this.params.immediateRefresh,
 						fastRefresh: this.params.fastRefresh,
 						slowRefresh: this.params.slowRefresh,
+						httpLongPoll: this.params.httpLongPoll,
+						httpLongPollParam: this.params.httpLongPollParam,
+						httpRepaintParam: this.params.httpRepaintParam,
+						httpReplayLines: this.params.httpReplayLines,
+						httpReplayLinesParam: this.params.httpReplayLinesParam,
 						httpSource: this.params.httpSource,
 						httpDest: this.params.httpDest,
 						httpSize: this.params.httpSize,
@@ -2654,6 +2681,12 @@ export class AnsiTerm {
 						wsDataTag: this.params.wsDataTag,
 						wsSizeTag: this.params.wsSizeTag,
 						wsSizeData: this.params.wsSizeData,
+						wsSession: this.params.wsSession,
+						wsReadOnly: this.params.wsReadOnly,
+						wsBinary: this.params.wsBinary,
+						wsMultiplex: this.params.wsMultiplex,
+						wsMultiplexParam: this.params.wsMultiplexParam,
+						wsWindow: this.params.wsWindow,
 					}
 				);
 				break;
@@ -5246,6 +5279,8 @@ export class AnsiTermHttpDriver extends AnsiTermDriver
 		this.immedate_refresh_request_count = 0;
 		this.timer = null;
 		this.refresh_timer = null;
+		this.poll_in_progress = false;
+		this.attach_pending = true;
 
 	// Fix some defaults that can't be set in the defaults table.
 	
@@ -5284,7 +5319,7 @@ export class AnsiTermHttpDriver extends AnsiTermDriver
 			this.timer = null;
 		}
 		this.timer = setTimeout( () => {
-			this._send_request(this.params.httpSource);
+			this._poll();
 		}, timeout);
 	}
 
@@ -5313,7 +5348,40 @@ export class AnsiTermHttpDriver extends AnsiTermDriver
 		return url;
 	}
 
-	_send_request(url)
+	_poll()
+	{
+		if (this.params.httpLongPoll && this.poll_in_progress) {
+			// In long poll mode the server answers as soon as new data are available,
+			// so there is no need to start another request while one is still pending.
+			return;
+		}
+		let url = this.params.httpSource;
+		if (this.attach_pending) {
+			// The session may already exist (e.g. page reload): the server can
+			// replay the last lines of its history and/or send the whole content
+			// of the screen first.
+			this.attach_pending = false;
+			if (this.params.httpReplayLines > 0) {
+				url += (url.indexOf('?') >= 0) ? '&' : '?';
+				url += this.params.httpReplayLinesParam + '=' + this.params.httpReplayLines;
+			}
+			if (this.params.httpRepaintParam != "") {
+				url += (url.indexOf('?') >= 0) ? '&' : '?';
+				url += this.params.httpRepaintParam;
+			}
+		}
+		if (! this.params.httpLongPoll) {
+			this._send_request(url);
+		}
+		else {
+			url += (url.indexOf('?') >= 0) ? '&' : '?';
+			url += this.params.httpLongPollParam + '=' + this.params.httpLongPoll;
+			this.poll_in_progress = true;
+			this._send_request(url, () => { this.poll_in_progress = false; });
+		}
+	}
+
+	_send_request(url, on_done)
 	{
 		url = this._add_session_hint(url);
 
@@ -5323,6 +5391,9 @@ export class AnsiTermHttpDriver extends AnsiTermDriver
 
 		xhr.onreadystatechange = () => {
 			if (xhr.readyState === XMLHttpRequest.DONE) {
+				if (on_done) {
+					on_done();
+				}
 				if (xhr.status >= 200 && xhr.status < 400) {
 					let t = xhr.responseText;
 					let data = t;
@@ -5342,7 +5413,12 @@ export class AnsiTermHttpDriver extends AnsiTermDriver
 						this._new_data(t);
 					}
 
-					this._schedule_update(this.params.fastRefresh);
+					if (this.params.httpLongPoll) {
+						this._start_cycle(0);
+					}
+					else {
+						this._schedule_update(this.params.fastRefresh);
+					}
 				}
 				else {
 					console.log(xhr.status);
@@ -5356,6 +5432,9 @@ export class AnsiTermHttpDriver extends AnsiTermDriver
 			xhr.open('GET', url, true);
 			xhr.send();
 		} catch {
+			if (on_done) {
+				on_done();
+			}
 			this._set_connection_state(false);
 		}
 	}
@@ -5447,6 +5526,111 @@ export class AnsiTermHttpDriver extends AnsiTermDriver
 }
 
 
+/**
+ * This class implements the shared connection used by WebSocket drivers
+ * in multiplexed mode ("wsMultiplex" parameter): all the terminals that
+ * refer to the same endpoint exchange their data through a single WebSocket,
+ * each one on its own channel.
+ *
+ * NOTE: not exported by the module.
+ */
+
+class AnsiTermWebSocketMux
+{
+	static connections = new Map();
+
+	static get(endpoint, param)
+	{
+		let mux = AnsiTermWebSocketMux.connections.get(endpoint);
+		if (! mux) {
+			mux = new AnsiTermWebSocketMux(endpoint, param);
+			AnsiTermWebSocketMux.connections.set(endpoint, mux);
+		}
+		return mux;
+	}
+
+	constructor(endpoint, param)
+	{
+		this.endpoint = endpoint;
+		this.channels = new Map();
+		this.next_channel = 1;
+		this.pending_objs = [];
+		this.connected = false;
+
+		let url = endpoint;
+		if (url.indexOf('/', url.indexOf('//') + 2) < 0) {
+			url += '/';
+		}
+		url += ((url.indexOf('?') >= 0) ? '&' : '?') + param;
+
+		this.socket = new WebSocket(url);
+
+		this.socket.addEventListener('open', (event) => {
+			this.connected = true;
+			while (this.pending_objs.length > 0) {
+				this.send(this.pending_objs.shift());
+			}
+		});
+
+		this.socket.addEventListener('message', (event) => {
+			let data;
+			try {
+				data = JSON.parse(event.data);
+			}
+			catch {
+				return;
+			}
+			let driver = this.channels.get(data.ch);
+			if (driver) {
+				driver._mux_message(data);
+			}
+		});
+
+		let on_close = (event) => {
+			this.connected = false;
+			if (AnsiTermWebSocketMux.connections.get(this.endpoint) === this) {
+				AnsiTermWebSocketMux.connections.delete(this.endpoint);
+			}
+			for (let driver of this.channels.values()) {
+				driver._set_connection_state(false);
+			}
+			this.channels.clear();
+		};
+		this.socket.addEventListener('close', on_close);
+		this.socket.addEventListener('error', on_close);
+	}
+
+	add(driver)
+	{
+		let ch = this.next_channel++;
+		this.channels.set(ch, driver);
+		return ch;
+	}
+
+	remove(ch)
+	{
+		if (this.channels.delete(ch)) {
+			this.send({ ch: ch, op: "close", kill: true });
+		}
+		if (this.channels.size == 0) {
+			AnsiTermWebSocketMux.connections.delete(this.endpoint);
+			try {
+				this.socket.close();
+			} catch {}
+		}
+	}
+
+	send(obj)
+	{
+		if (this.connected) {
+			this.socket.send(JSON.stringify(obj));
+		}
+		else {
+			this.pending_objs.push(obj);
+		}
+	}
+}
+
 /**
  * This class implements the WebSocket protocol driver for AnsiTerm.
  * It is activated by specifying "websocket" in "channelType" AnsiTerm's constructor
@@ -5472,7 +5656,37 @@ export class AnsiTermWebSocketDriver extends AnsiTermDriver
 			if (ep.substring(0,5) != "ws://" && ep.substring(0,6) != "wss://") {
 				ep = "ws://" + ep;
 			}
-			this.socket = new WebSocket(ep);
+			if (this.params.wsMultiplex) {
+				this.mux = AnsiTermWebSocketMux.get(ep, this.params.wsMultiplexParam);
+				this.channel = this.mux.add(this);
+				let obj = { ch: this.channel, op: "open", window: this.params.wsWindow };
+				if (this.params.wsSession) {
+					obj.session = this.params.wsSession;
+					obj.readonly = this.params.wsReadOnly;
+				}
+				this.mux.send(obj);
+				return;
+			}
+			if (this.params.wsSession) {
+				if (ep.indexOf('/', ep.indexOf('//') + 2) < 0) {
+					ep += '/';
+				}
+				ep += ((ep.indexOf('?') >= 0) ? '&' : '?') + "session=" + encodeURIComponent(this.params.wsSession);
+				if (this.params.wsReadOnly) {
+					ep += "&readonly";
+				}
+			}
+			if (this.params.wsBinary) {
+				// Binary messages start with a tag byte: 0 = characters (UTF-8), 1 = size.
+				this.binary = true;
+				this.encoder = new TextEncoder();
+				this.decoder = new TextDecoder("utf-8");
+				this.socket = new WebSocket(ep, [ "xwterm.binary" ]);
+				this.socket.binaryType = "arraybuffer";
+			}
+			else {
+				this.socket = new WebSocket(ep);
+			}
 		} catch {
 			this._stop();
 			return;
@@ -5489,6 +5703,15 @@ export class AnsiTermWebSocketDriver extends AnsiTermDriver
 		this.socket.addEventListener('message', (event) => {
 
 //			console.log('WS Messagge from server:', event.data);
+			if (event.data instanceof ArrayBuffer) {
+				let b = new Uint8Array(event.data);
+				if (b.length > 1 && b[0] == 0) {
+					// A multibyte character may be split between two messages.
+					this._new_data(this.decoder.decode(b.subarray(1), { stream: true }));
+				}
+				return;
+			}
+
 			let t = event.data;
 			let data = t;
 
@@ -5527,17 +5750,50 @@ export class AnsiTermWebSocketDriver extends AnsiTermDriver
 	_close()
 	{
 		console.log('WS Connection closed');
+		if (this.mux) {
+			this.mux.remove(this.channel);
+			this.mux = null;
+			return;
+		}
 		try {
 			this.socket.close();
 		} catch {}
 		this.socket = null;
 	}
 
+	_mux_message(data)
+	{
+		if ("session" in data) {
+			this._set_connection_state(true);
+		}
+		if ("closed" in data) {
+			this._set_connection_state(false);
+		}
+		if (this.params.wsDataTag in data) {
+			let t = data[this.params.wsDataTag];
+			if (t != "") {
+				this._new_data(t);
+				if (this.params.wsWindow > 0) {
+					this.mux.send({ ch: this.channel, op: "ack", n: t.length });
+				}
+			}
+		}
+	}
+
 	_send_obj(obj)
 	{
-		if (this.connection_state) {
-			let s = JSON.stringify(obj);
-	    	this.socket.send(s);
+		if (this.mux) {
+			obj.ch = this.channel;
+			this.mux.send(obj);
+		}
+		else if (this.connection_state) {
+			if (obj instanceof Uint8Array) {
+				this.socket.send(obj);
+			}
+			else {
+				let s = JSON.stringify(obj);
+		    	this.socket.send(s);
+			}
 		}
 		else {
 			this.pending_objs.push(obj);
@@ -5551,15 +5807,34 @@ export class AnsiTermWebSocketDriver extends AnsiTermDriver
 		this._send_obj(obj);
 	}
 
+	_send_binary(tag, text)
+	{
+		let t = this.encoder.encode(text);
+		let b = new Uint8Array(t.length + 1);
+		b[0] = tag;
+		b.set(t, 1);
+		this._send_obj(b);
+	}
+
 	_tx(text)
 	{
-		this._send_obj_data(text, this.params.wsDataTag);
+		if (this.binary) {
+			this._send_binary(0, text);
+		}
+		else {
+			this._send_obj_data(text, this.params.wsDataTag);
+		}
 	}
 
 	_set_size(nlines, ncolumns)
 	{
 		let q = this.params.wsSizeData.replace("?lines?", nlines).replace("?columns?", ncolumns);
-		this._send_obj_data(q, this.params.wsSizeTag);
+		if (this.binary) {
+			this._send_binary(1, q);
+		}
+		else {
+			this._send_obj_data(q, this.params.wsSizeTag);
+		}
 	}
 
 }